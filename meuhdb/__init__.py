@@ -3,3 +3,4 @@ __version__ = '0.3.0'
 __url__ = "https://github.com/brunobord/meuhdb/"
 
 from meuhdb.core import MeuhDb  # noqa
+from meuhdb.sharding import ShardedMeuhDb  # noqa
@@ -0,0 +1,262 @@
+#-*- coding: utf-8 -*-
+"""
+Aggregates of the records, computed by ``MeuhDb.aggregate()``.
+
+Grouped counts come straight from the index bucket sizes when they can. The
+other aggregates are computed in a single pass over the matching records, or
+vectorized over cached columns of numeric values if NumPy is installed.
+"""
+from __future__ import division, unicode_literals
+
+import six
+
+from .lookups import indexable_values, resolve
+from .planner import QueryPlan
+from .query import Query
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#: The aggregates computed over the numeric values of a field.
+AGGREGATES = ('sum', 'min', 'max', 'avg')
+
+# Larger integers aren't exact in a column of floats
+MAX_EXACT_INT = 2 ** 53
+
+
+def is_number(value):
+    "Return True if the value is a number (booleans aren't)."
+    return isinstance(value, six.integer_types + (float,)) and \
+        not isinstance(value, bool)
+
+
+class Accumulator(object):
+    "The aggregates of a group of records, updated one record at a time."
+    def __init__(self, fields):
+        self.fields = fields
+        self.count = 0
+        # For each field: number of values, sum, min and max
+        self.stats = dict(
+            (field, [0, 0, None, None]) for field in set(fields.values()))
+
+    def add(self, record):
+        self.count += 1
+        for field, stats in self.stats.items():
+            value = resolve(record, field)
+            if not is_number(value):
+                continue
+            if stats[0]:
+                stats[2] = min(stats[2], value)
+                stats[3] = max(stats[3], value)
+            else:
+                stats[2] = stats[3] = value
+            stats[0] += 1
+            stats[1] += value
+
+    def result(self, count):
+        result = {'count': self.count} if count else {}
+        for name, field in self.fields.items():
+            values, total, low, high = self.stats[field]
+            result[name] = {
+                'sum': total,
+                'min': low,
+                'max': high,
+                'avg': total / values if values else None,
+            }[name]
+        return result
+
+
+def aggregate(db, group_by=None, count=False, where=None, **fields):
+    """
+    Return the aggregates of the records of `db` matching `where` (the
+    arguments of ``filter_keys()``), grouped by the values of the field
+    `group_by` if it's set.
+    """
+    fields = dict(
+        (name, field) for name, field in fields.items() if field is not None)
+    if not count and not fields:
+        raise ValueError('Nothing to aggregate')
+    where = where or {}
+    if not fields:
+        if group_by is None:
+            return {'count': Query(db, where).count()}
+        counts = index_counts(db, group_by, where)
+        if counts is not None:
+            return dict(
+                (value, {'count': number}) for value, number in counts.items())
+    plan = QueryPlan(db, where)
+    if numpy is not None and fields:
+        result = vectorized(db, plan, group_by, count, fields)
+        if result is not None:
+            return result
+    return streamed(db, plan, group_by, count, fields)
+
+
+def index_counts(db, group_by, where):
+    """Return the number of matching records for each value of the index
+    `group_by`, or None if there's no such index."""
+    if group_by not in db.indexes or 'fields' in db.index_defs[group_by]:
+        return None
+    index = db.indexes[group_by]
+    if not where:
+        return dict(
+            (value, len(keys)) for value, keys in index.items() if keys)
+    matching = db.filter_keys(**where)
+    counts = {}
+    for value, keys in index.items():
+        number = len(matching & keys)
+        if number:
+            counts[value] = number
+    return counts
+
+
+def streamed(db, plan, group_by, count, fields):
+    "Compute the aggregates in a single pass over the matching records."
+    data = db.data
+    groups = {}
+    for key in plan.iterkeys():
+        record = data[key]
+        if group_by is None:
+            values = (None,)
+        else:
+            # Like in an index, each element of a list is a group
+            values = indexable_values(resolve(record, group_by))
+        for value in values:
+            accumulator = groups.get(value)
+            if accumulator is None:
+                accumulator = groups[value] = Accumulator(fields)
+            accumulator.add(record)
+    if group_by is None:
+        return groups.get(None, Accumulator(fields)).result(count)
+    return dict(
+        (value, accumulator.result(count))
+        for value, accumulator in groups.items())
+
+
+def _rows(db):
+    "Return the keys of the records, in the order of the cached columns."
+    columns = db._columns
+    if None not in columns:
+        keys = list(db.data)
+        columns[None] = (
+            keys, dict((key, row) for row, key in enumerate(keys)))
+    return columns[None]
+
+
+def numeric_column(db, field):
+    """
+    Return the cached column of the values of `field`, as an array of floats
+    (NaN if the value isn't a number), and whether they're all integers.
+    Return None if the values can't be stored exactly as floats.
+    """
+    columns = db._columns
+    if field not in columns:
+        data = db.data
+        values = []
+        integral = True
+        total = 0
+        for key in _rows(db)[0]:
+            value = resolve(data[key], field)
+            if not is_number(value):
+                value = float('nan')
+            elif isinstance(value, float):
+                integral = False
+            else:
+                total += abs(value)
+            values.append(value)
+        column = None
+        if total < MAX_EXACT_INT:
+            column = (numpy.array(values, dtype=float), integral)
+        columns[field] = column
+    return columns[field]
+
+
+def group_column(db, field):
+    """
+    Return the cached column of the group numbers of the records (-1 if the
+    record isn't in any group), and the value of each group. Return None if a
+    record is in several groups.
+    """
+    columns = db._columns
+    name = ('group', field)
+    if name not in columns:
+        data = db.data
+        numbers = {}
+        codes = []
+        for key in _rows(db)[0]:
+            values = indexable_values(resolve(data[key], field))
+            if len(values) > 1:
+                break
+            if values:
+                codes.append(numbers.setdefault(values[0], len(numbers)))
+            else:
+                codes.append(-1)
+        else:
+            values = [None] * len(numbers)
+            for value, number in numbers.items():
+                values[number] = value
+            columns[name] = (numpy.array(codes, dtype=numpy.intp), values)
+        columns.setdefault(name, None)
+    return columns[name]
+
+
+def vectorized(db, plan, group_by, count, fields):
+    """Compute the aggregates with NumPy, over the cached columns. Return None
+    if they can't be."""
+    columns = {}
+    for field in set(fields.values()):
+        columns[field] = numeric_column(db, field)
+        if columns[field] is None:
+            return None
+    if group_by is None:
+        codes, values = numpy.zeros(len(_rows(db)[0]), numpy.intp), [None]
+    else:
+        groups = group_column(db, group_by)
+        if groups is None:
+            return None
+        codes, values = groups
+    rows = None
+    if plan.index_steps or plan.scan_criteria:
+        positions = _rows(db)[1]
+        rows = numpy.fromiter(
+            (positions[key] for key in plan.iterkeys()), numpy.intp)
+        codes = codes[rows]
+    grouped = codes >= 0
+    codes = codes[grouped]
+    size = len(values)
+    counts = numpy.bincount(codes, minlength=size)
+    stats = {}
+    for field, (column, integral) in columns.items():
+        if rows is not None:
+            column = column[rows]
+        column = column[grouped]
+        numbers = ~numpy.isnan(column)
+        field_codes, column = codes[numbers], column[numbers]
+        low = numpy.full(size, numpy.inf)
+        numpy.minimum.at(low, field_codes, column)
+        high = numpy.full(size, -numpy.inf)
+        numpy.maximum.at(high, field_codes, column)
+        stats[field] = (
+            numpy.bincount(field_codes, minlength=size),
+            numpy.bincount(field_codes, weights=column, minlength=size),
+            low, high, int if integral else float)
+    results = {}
+    for number, value in enumerate(values):
+        if group_by is not None and not counts[number]:
+            continue
+        result = {'count': int(counts[number])} if count else {}
+        for name, field in fields.items():
+            found, total, low, high, cast = stats[field]
+            found = int(found[number])
+            result[name] = {
+                'sum': cast(total[number]),
+                'min': cast(low[number]) if found else None,
+                'max': cast(high[number]) if found else None,
+                'avg': float(total[number]) / found if found else None,
+            }[name]
+        results[value] = result
+    if group_by is None:
+        return results[None]
+    return results
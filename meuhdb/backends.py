@@ -1,57 +1,292 @@
+"""
+Serialization backends.
+
+A backend encodes the database, and the records of its journal. The JSON
+backends encode to text, the other ones to bytes. New backends can be added
+with ``register_backend()``.
+"""
 import json
+import marshal
+
+from six.moves import cPickle as pickle
+
+from .binary import LENGTH
+from .storage import to_bytes
+
+
+#: The number of bytes needed to detect the backend of a file.
+HEAD_SIZE = 16
+
+
+def is_json(head):
+    "Return True if `head` is the start of a JSON object or array."
+    head = head.lstrip()
+    if head[:1] not in (b'{', b'['):
+        return False
+    return head[1:].lstrip()[:1] in (b'"', b'}', b']', b'')
+
+
+class Backend(object):
+    """
+    A serialization backend.
+
+    Subclasses define ``dumps()`` and ``loads()``. ``loads()`` raises a
+    ``ValueError`` if the data can't be decoded.
+    """
+    #: The name of the backend, used by the ``backend`` option.
+    name = None
+    #: True if the backend encodes to text (i.e. JSON), False for bytes.
+    text = True
+    #: The types that are encoded and decoded as they are, e.g. ``set`` or
+    #: ``tuple``. Index values don't have to be converted for them.
+    native_types = ()
+    #: False if decoding crafted data can run code: such a backend is never
+    #: detected, it has to be set by the ``backend`` option.
+    safe = True
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def recognizes(self, head):
+        """Return True if `head`, the start of an encoded dict or list, has
+        been encoded by this backend, False if it hasn't, and None if it
+        can't tell."""
+        if self.text:
+            return is_json(head)
+        return None
+
+    def decode(self, data):
+        "Decode bytes read from a file."
+        if self.text:
+            data = data.decode('utf-8')
+        return self.loads(data)
+
+    def dump(self, obj, fd):
+        "Encode `obj` to the binary file `fd`."
+        fd.write(to_bytes(self.dumps(obj)))
+
+    def load(self, fd):
+        "Decode the content of the binary file `fd`."
+        return self.decode(fd.read())
+
+    def dump_record(self, obj):
+        "Return `obj` encoded as a record of a journal file."
+        data = to_bytes(self.dumps(obj))
+        if self.text:
+            # JSON has no line break
+            return data + b'\n'
+        return LENGTH.pack(len(data)) + data
+
+    def load_records(self, fd):
+        """Iterate over the records of the journal file `fd`. Raise a
+        ``ValueError`` if a record is incomplete."""
+        if self.text:
+            for line in iter(fd.readline, b''):
+                if not line.endswith(b'\n'):
+                    # The line break ends the record
+                    raise ValueError('Incomplete record')
+                line = line.strip()
+                if line:
+                    yield self.decode(line)
+            return
+        while True:
+            header = fd.read(LENGTH.size)
+            if not header:
+                return
+            if len(header) < LENGTH.size:
+                raise ValueError('Incomplete record')
+            size = LENGTH.unpack(header)[0]
+            data = fd.read(size)
+            if len(data) < size:
+                raise ValueError('Incomplete record')
+            yield self.loads(data)
+
+
+class FunctionsBackend(Backend):
+    "A backend made of a pair of ``dumps``/``loads`` functions."
+    def __init__(self, name, dumps, loads, text=True, native_types=()):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.text = text
+        self.native_types = native_types
+
+
+class PickleBackend(Backend):
+    """
+    The ``pickle`` backend: fast, and sets and tuples are native.
+
+    Only open files you trust: unpickling can run arbitrary code.
+    """
+    name = 'pickle'
+    text = False
+    native_types = (set, tuple, bytes)
+    safe = False
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            raise ValueError('Unable to unpickle the data: {}'.format(e))
+
+    def recognizes(self, head):
+        # The PROTO opcode (protocol 2 and above)
+        return head[:1] == b'\x80' and len(head) > 1
+
+    def dump(self, obj, fd):
+        # Pickled straight to the file
+        pickle.dump(obj, fd, pickle.HIGHEST_PROTOCOL)
 
-BACKENDS = {
-    'json': {
-        'dumper': json.dumps,
-        'loader': json.loads,
-    }
-}
+    def load(self, fd):
+        try:
+            return pickle.load(fd)
+        except Exception as e:
+            raise ValueError('Unable to unpickle the data: {}'.format(e))
+
+
+class MarshalBackend(Backend):
+    """
+    The ``marshal`` backend: the fastest, sets and tuples are native.
+
+    Its format depends on the Python version.
+    """
+    name = 'marshal'
+    text = False
+    native_types = (set, tuple, bytes)
+    safe = False
+
+    def dumps(self, obj):
+        return marshal.dumps(obj)
+
+    def recognizes(self, head):
+        # Dict and list types, with or without the reference flag
+        return head[:1] in (b'{', b'[', b'\xfb', b'\xdb') and \
+            not is_json(head)
+
+    def loads(self, data):
+        try:
+            return marshal.loads(data)
+        except (EOFError, TypeError) as e:
+            raise ValueError('Unable to unmarshal the data: {}'.format(e))
+
+
+class MsgpackBackend(Backend):
+    "The ``msgpack`` backend: compact, and portable."
+    name = 'msgpack'
+    text = False
+    native_types = (bytes,)
+
+    def __init__(self, msgpack):
+        self.msgpack = msgpack
+        self.unpack_options = {'raw': False}
+        try:
+            # Index values may be numbers (msgpack >= 1.0)
+            msgpack.unpackb(msgpack.packb({1: 1}), strict_map_key=False)
+            self.unpack_options['strict_map_key'] = False
+        except TypeError:
+            pass
+
+    def dumps(self, obj):
+        return self.msgpack.packb(obj, use_bin_type=True)
+
+    def recognizes(self, head):
+        if head == b'\x80' or head == b'\x90':
+            # Empty map or array
+            return True
+        first = bytearray(head[:1])
+        return bool(first) and (
+            0x81 <= first[0] <= 0x9f or 0xdc <= first[0] <= 0xdf)
+
+    def loads(self, data):
+        try:
+            return self.msgpack.unpackb(data, **self.unpack_options)
+        except Exception as e:
+            raise ValueError('Unable to unpack the data: {}'.format(e))
+
+
+BACKENDS = {}
 DEFAULT_BACKEND = 'json'
 
+
+def register_backend(backend, default=False):
+    """
+    Make the `backend` available, by its name.
+
+    If `default` is True, it becomes the ``DEFAULT_BACKEND``.
+    """
+    global DEFAULT_BACKEND
+    BACKENDS[backend.name] = backend
+    if default:
+        DEFAULT_BACKEND = backend.name
+
+
+register_backend(FunctionsBackend('json', json.dumps, json.loads))
+register_backend(PickleBackend())
+register_backend(MarshalBackend())
+
 try:
     import simplejson
-    BACKENDS.update({
-        'simplejson': {
-            'dumper': simplejson.dumps,
-            'loader': simplejson.loads,
-        }
-    })
-    DEFAULT_BACKEND = 'simplejson'
+    register_backend(FunctionsBackend(
+        'simplejson', simplejson.dumps, simplejson.loads), default=True)
 except ImportError:
     pass
 
 try:
     import yajl
-    BACKENDS.update({
-        'yajl': {
-            'dumper': yajl.dumps,
-            'loader': yajl.loads,
-        }
-    })
-    DEFAULT_BACKEND = 'yajl'
+    register_backend(FunctionsBackend(
+        'yajl', yajl.dumps, yajl.loads), default=True)
 except ImportError:
     pass
 
 try:
     import jsonlib
-    BACKENDS.update({
-        'jsonlib': {
-            'dumper': jsonlib.dumps,
-            'loader': jsonlib.loads,
-        }
-    })
-    DEFAULT_BACKEND = 'jsonlib'
+    register_backend(FunctionsBackend(
+        'jsonlib', jsonlib.dumps, jsonlib.loads), default=True)
 except ImportError:
     pass
 
 try:
     import ujson
-    BACKENDS.update({
-        'ujson': {
-            'dumper': ujson.dumps,
-            'loader': ujson.loads,
-        }
-    })
-    DEFAULT_BACKEND = 'ujson'
+    register_backend(FunctionsBackend(
+        'ujson', ujson.dumps, ujson.loads), default=True)
 except ImportError:
     pass
+
+try:
+    import msgpack
+    register_backend(MsgpackBackend(msgpack))
+except ImportError:
+    pass
+
+
+def detect(head, backend, records=False):
+    """
+    Return the backend that encoded `head`, the start of a DB file: the given
+    `backend` unless another one recognizes it. Only the safe backends are
+    detected: raise a ``ValueError`` if the file hasn't been encoded by one of
+    them.
+
+    If `records` is True, `head` is the start of a journal file, whose records
+    are prefixed by their length, unless they're encoded to text.
+    """
+    def recognizes(candidate):
+        if records and not candidate.text:
+            return candidate.recognizes(head[LENGTH.size:])
+        return candidate.recognizes(head)
+
+    if not head.strip() or recognizes(backend) is not False:
+        return backend
+    names = sorted(BACKENDS, key=lambda name: name != DEFAULT_BACKEND)
+    for name in names:
+        candidate = BACKENDS[name]
+        if candidate.safe and recognizes(candidate):
+            return candidate
+    raise ValueError(
+        'The data has not been encoded by the {} backend'.format(
+            backend.name))
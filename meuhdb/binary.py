@@ -0,0 +1,93 @@
+#-*- coding: utf-8 -*-
+"""
+Binary file format, read through a memory map.
+
+A binary DB file is made of:
+
+* the ``MAGIC`` bytes,
+* the records, each one encoded by the backend, and prefixed by its length,
+* the index section: a JSON object with the index definitions and values,
+* the directory: a JSON object giving the position of each record,
+* the footer: the positions of the index section and the directory, and the
+  ``MAGIC`` bytes again.
+"""
+from __future__ import unicode_literals
+import os
+import struct
+
+from .storage import to_bytes
+
+MAGIC = b'MEUHDB1\n'
+
+#: Length prefix of a record.
+LENGTH = struct.Struct('>I')
+
+#: Positions of the index section and of the directory, followed by `MAGIC`.
+FOOTER = struct.Struct('>QQ{}s'.format(len(MAGIC)))
+
+
+def is_binary(path):
+    "Return True if the file at `path` is a binary DB file."
+    with open(path, 'rb') as fd:
+        return fd.read(len(MAGIC)) == MAGIC
+
+
+def read_index_head(path, size):
+    """Return the first `size` bytes of the index section of the binary DB
+    file at `path`, or an empty string if its footer is invalid."""
+    with open(path, 'rb') as fd:
+        fd.seek(0, os.SEEK_END)
+        end = fd.tell() - FOOTER.size
+        if end < len(MAGIC):
+            return b''
+        fd.seek(end)
+        index_position, _, magic = FOOTER.unpack(fd.read(FOOTER.size))
+        if magic != MAGIC or not len(MAGIC) <= index_position <= end:
+            return b''
+        fd.seek(index_position)
+        return fd.read(size)
+
+
+def read_blob(buf, offset):
+    "Return the encoded record found at `offset`."
+    size, = LENGTH.unpack_from(buf, offset)
+    start = offset + LENGTH.size
+    return buf[start:start + size]
+
+
+def write_records(fd, items, dumps):
+    """Write the (key, value) pairs to the binary file `fd`, after the
+    ``MAGIC`` bytes. Return the position of each record."""
+    fd.write(MAGIC)
+    offsets = {}
+    for key, value in items:
+        blob = to_bytes(dumps(value))
+        offsets[key] = fd.tell()
+        fd.write(LENGTH.pack(len(blob)))
+        fd.write(blob)
+    return offsets
+
+
+def write_footer(fd, index_position, directory_position):
+    fd.write(FOOTER.pack(index_position, directory_position, MAGIC))
+
+
+def scan(buf, decode):
+    """
+    Read the index section and the directory of a binary DB file.
+
+    Return the position of each record, as a {key: offset} dict, and the
+    index section (decoded).
+    """
+    end = len(buf) - FOOTER.size
+    if end < len(MAGIC) or buf[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a binary DB file')
+    index_position, directory_position, magic = FOOTER.unpack_from(buf, end)
+    if magic != MAGIC or not \
+            len(MAGIC) <= index_position <= directory_position <= end:
+        raise ValueError('Invalid footer, the file may be truncated')
+    sections = decode(buf[index_position:directory_position])
+    offsets = decode(buf[directory_position:end])
+    if not isinstance(sections, dict) or not isinstance(offsets, dict):
+        raise ValueError('Invalid index section or directory')
+    return offsets, sections
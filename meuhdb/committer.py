@@ -0,0 +1,133 @@
+#-*- coding: utf-8 -*-
+"""
+Background commits.
+"""
+from __future__ import unicode_literals
+import threading
+import warnings
+
+from .policies import clock
+
+
+class BackgroundCommitter(object):
+    """
+    A thread committing the database in the background.
+
+    Commit requests are merged: every request made while a commit is running
+    is served by a single commit, made as soon as the running one is over.
+    """
+    def __init__(self, db):
+        self.db = db
+        self._condition = threading.Condition()
+        # Commit requests are numbered, to know which ones have been served
+        self._requested = 0
+        self._done = 0
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name='meuhdb-committer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def request(self):
+        "Ask for a commit, without waiting for it. Return the request number."
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('The background committer is closed')
+            self._requested += 1
+            self._condition.notify_all()
+            return self._requested
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._done == self._requested and not self._closed:
+                    self._condition.wait()
+                if self._done == self._requested:
+                    # Closed, and nothing left to commit
+                    return
+                target = self._requested
+            error = None
+            try:
+                self.db._commit_now(copy=True)
+            except Exception as e:
+                error = e
+            with self._condition:
+                self._done = target
+                if error is not None:
+                    self._error = error
+                self._condition.notify_all()
+
+    def flush(self):
+        """Commit, and wait until every write made so far is written to the
+        storage. Raise the error of a failed background commit, if any.
+        """
+        target = self.request()
+        with self._condition:
+            while self._done < target:
+                self._condition.wait()
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        "Flush, then stop the thread."
+        try:
+            self.flush()
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            self._thread.join()
+
+
+class CommitTimer(object):
+    """
+    A thread committing the database at the deadline of its commit policy
+    (see ``meuhdb.policies``), so that the last writes are committed even if
+    no write operation comes after them.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.policy = db._meta.policy
+        self._condition = threading.Condition()
+        self._closed = False
+        # A failed commit is retried after the next write
+        self._failed = False
+        self._thread = threading.Thread(target=self._run, name='meuhdb-timer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        "Tell the thread the deadline may have changed, after a write."
+        with self._condition:
+            self._failed = False
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    deadline = None if self._failed else self.policy.deadline()
+                    if deadline is None:
+                        self._condition.wait()
+                        continue
+                    delay = deadline - clock()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if self._closed:
+                    return
+            try:
+                self.db._timed_commit()
+            except Exception as e:
+                warnings.warn('Timed commit failed: {}'.format(e))
+                with self._condition:
+                    self._failed = True
+
+    def close(self):
+        "Stop the thread."
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
@@ -0,0 +1,168 @@
+#-*- coding: utf-8 -*-
+"""
+Transparent compression of the DB file.
+
+The DB file is compressed as a stream when it's written, and decompressed as
+a stream when it's loaded. The compression is detected by the magic bytes at
+the start of the file.
+"""
+from __future__ import unicode_literals
+import bz2
+import gzip
+import zlib
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Compression(object):
+    """
+    A compression codec.
+
+    Subclasses define ``compressor(level)``, returning an object with the
+    ``compress()`` and ``flush()`` methods of ``zlib`` compressors, and
+    ``open(path)``, returning a binary file decompressing the file at `path`.
+    """
+    #: The name of the codec, used by the ``compression`` option.
+    name = None
+    #: The bytes starting a compressed file.
+    magic = None
+    #: The exceptions raised when reading an invalid or truncated file.
+    errors = (IOError, EOFError)
+
+    def compressor(self, level=None):
+        raise NotImplementedError
+
+    def open(self, path):
+        raise NotImplementedError
+
+
+class GzipCompression(Compression):
+    name = 'gzip'
+    magic = b'\x1f\x8b'
+    errors = (IOError, EOFError, zlib.error)
+
+    def compressor(self, level=None):
+        # zlib's default level (6) is much faster than gzip's (9)
+        return zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+            zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def open(self, path):
+        return gzip.open(path, 'rb')
+
+
+class Bz2Compression(Compression):
+    name = 'bz2'
+    magic = b'BZh'
+
+    def compressor(self, level=None):
+        return bz2.BZ2Compressor(9 if level is None else level)
+
+    def open(self, path):
+        return bz2.BZ2File(path, 'rb')
+
+
+class LzmaCompression(Compression):
+    name = 'lzma'
+    magic = b'\xfd7zXZ\x00'
+    errors = (IOError, EOFError, lzma.LZMAError if lzma else IOError)
+
+    def compressor(self, level=None):
+        return lzma.LZMACompressor(preset=level)
+
+    def open(self, path):
+        return lzma.open(path, 'rb')
+
+
+class ZstdCompression(Compression):
+    name = 'zstd'
+    magic = b'\x28\xb5\x2f\xfd'
+    errors = (IOError, EOFError, zstandard.ZstdError if zstandard else IOError)
+
+    def compressor(self, level=None):
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level).compressobj()
+
+    def open(self, path):
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), closefd=True)
+
+
+COMPRESSIONS = {}
+
+
+def register_compression(compression):
+    "Make the `compression` codec available, by its name."
+    COMPRESSIONS[compression.name] = compression
+
+
+register_compression(GzipCompression())
+register_compression(Bz2Compression())
+if lzma is not None:
+    register_compression(LzmaCompression())
+if zstandard is not None:
+    register_compression(ZstdCompression())
+
+# The longest magic bytes
+MAGIC_SIZE = 6
+
+
+def detect(path):
+    "Return the codec the file at `path` is compressed with, or None."
+    with open(path, 'rb') as fd:
+        start = fd.read(MAGIC_SIZE)
+    for compression in COMPRESSIONS.values():
+        if start.startswith(compression.magic):
+            return compression
+
+
+class CompressedWriter(object):
+    "A binary file compressing what's written to the binary file `fd`."
+    def __init__(self, fd, compressor):
+        self.fd = fd
+        self.compressor = compressor
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.fd.write(compressed)
+
+    def close(self):
+        "Write the end of the compressed stream. `fd` is left open."
+        self.fd.write(self.compressor.flush())
+
+
+class DecompressedFile(object):
+    """A binary file reading the decompressed content of the file at `path`.
+    Decompression errors raise a ``ValueError``."""
+    def __init__(self, compression, path):
+        self.compression = compression
+        self.fd = compression.open(path)
+
+    def read(self, size=-1):
+        try:
+            return self.fd.read(size)
+        except self.compression.errors as e:
+            raise ValueError('Unable to decompress the file: {}'.format(e))
+
+    def readline(self):
+        try:
+            return self.fd.readline()
+        except self.compression.errors as e:
+            raise ValueError('Unable to decompress the file: {}'.format(e))
+
+    def close(self):
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,34 +3,102 @@
 MeuhDB, a database that says "meuh".
 """
 from __future__ import unicode_literals
-from copy import deepcopy
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from copy import copy, deepcopy
 from functools import wraps
+from itertools import islice, product
 import os
+import threading
 from uuid import uuid4
 import warnings
 
 import six
 
 from .backends import DEFAULT_BACKEND, BACKENDS
-from .exceptions import BadValueError
+from .committer import BackgroundCommitter, CommitTimer
+from .compression import COMPRESSIONS
+from .exceptions import BadValueError, CorruptedDatabaseError
+from .lookups import LOOKUPS, MISSING, PATH_SEP, RANGE_LOOKUPS
+from .lookups import indexable_values, resolve
+from .lookups import sort_key, sorted_keys, sorted_range
+from .planner import QueryPlan
+from .query import Query
+from .policies import clock
+from .storage import atomic_write, generation_path, to_bytes
+from .views import READ_POLICIES, FrozenMapping, copy_value
+from . import aggregation, backends, binary, compression, lazy, policies
+from . import streaming
 
 
 def autocommit(f):
-    "A decorator to commit to the storage if autocommit is set to True."
+    """
+    A decorator to commit to the storage if autocommit is set to True.
+
+    A write operation made by another one (e.g. ``update()`` calling
+    ``set()``) isn't accounted for: only the outermost one is.
+    """
     @wraps(f)
     def wrapper(self, *args, **kwargs):
-        result = f(self, *args, **kwargs)
-        if self._meta.commit_ready():
-            self.commit()
+        with self._lock:
+            self._write_depth += 1
+            try:
+                result = f(self, *args, **kwargs)
+            finally:
+                self._write_depth -= 1
+            if self._write_depth:
+                # Part of another write operation
+                return result
+            if self._batch_depth:
+                # Accounted for at the end of the batch
+                self._batch_writes += 1
+                return result
+            if self._replaying:
+                return result
+            self._stats['writes'] += 1
+            ready = self._meta.commit_ready()
+        if self._timer is not None:
+            self._timer.wake()
+        if ready:
+            self._autocommit()
         return result
     return wrapper
 
 
+def index_name(name):
+    "Return the name of the index on a field, or on a tuple of fields."
+    if isinstance(name, (tuple, list)):
+        return COMPOUND_INDEX_SEP.join(name)
+    return name
+
+
 def intersect(d1, d2):
     """Intersect dictionaries d1 and d2 by key *and* value."""
     return dict((k, d1[k]) for k in d1 if k in d2 and d1[k] == d2[k])
 
 
+#: Separator of the field names in the name of a compound index.
+COMPOUND_INDEX_SEP = ','
+
+#: Number of records serialized at once when writing a snapshot.
+SNAPSHOT_CHUNK_SIZE = 1000
+
+#: Index types whose values aren't stored, but built when loading the DB.
+UNSTORED_INDEX_TYPES = ('lazy', 'sorted')
+
+EMPTY_BUCKET = frozenset()
+
+#: Formats of the DB file.
+FORMATS = ('json', 'binary')
+
+#: Counters returned by ``MeuhDb.stats()``.
+STATS = ('writes', 'commits_triggered', 'commits', 'commits_skipped',
+         'bytes_written', 'commit_time')
+
+#: Write operations that can be found in a journal file.
+JOURNAL_OPERATIONS = ('set', 'delete', 'build_index', 'remove_index')
+
+
 class Meta(object):
     """Meta-information, not directly related to the database itself, but
     the way it's being accessed.
@@ -38,19 +106,50 @@ class Meta(object):
     def __init__(self,
                  path=None, autocommit=False, autocommit_after=None,
                  lazy_indexes=False,
-                 backend=DEFAULT_BACKEND):
+                 backend=DEFAULT_BACKEND,
+                 journal=False, keep_generations=0,
+                 background_commit=False, streaming_load=False,
+                 lazy_open=False, lazy_cache_size=lazy.CACHE_SIZE,
+                 format='json', compression=None, compression_level=None,
+                 commit_policy=None, copy_on_write=True, read_policy='live'):
         self.path = path
         self.lazy_indexes = lazy_indexes
+        self.journal = journal
+        self.keep_generations = int(keep_generations)
+        self.background_commit = background_commit
+        self.streaming_load = streaming_load
+        self.lazy_open = lazy_open
+        self.lazy_cache_size = int(lazy_cache_size)
+        if format not in FORMATS:
+            raise ValueError('Unknown file format: {}'.format(format))
+        self.format = format
+        if compression is not None:
+            if compression not in COMPRESSIONS:
+                raise ValueError(
+                    'Unknown compression: {}'.format(compression))
+            # The memory map needs the file as it is
+            if lazy_open or format == 'binary':
+                raise ValueError(
+                    'A compressed DB file can\'t be opened lazily')
+        self.compression = compression
+        self.compression_level = compression_level
+        self.copy_on_write = copy_on_write
+        if read_policy not in READ_POLICIES:
+            raise ValueError('Unknown read policy: {}'.format(read_policy))
+        self.read_policy = read_policy
 
         # Commits / Autocommit
         self.autocommit = autocommit
         self.autocommit_after = autocommit_after
-        # Counter
-        self.uses_counter = False
-        if self.autocommit_after is not None:
-            self.uses_counter = True
-            self.init_counter = int(self.autocommit_after)
-            self.counter = self.init_counter
+        if commit_policy is not None:
+            # The policy keeps track of the writes of this DB only
+            self.policy = copy(commit_policy)
+        elif autocommit:
+            self.policy = policies.EveryWrite()
+        elif autocommit_after is not None:
+            self.policy = policies.EveryNWrites(autocommit_after)
+        else:
+            self.policy = policies.CommitPolicy()
 
         if backend not in BACKENDS:
             warnings.warn('{} backend not available, falling '
@@ -58,25 +157,28 @@ class Meta(object):
             backend = "json"
         self.backend = backend
 
+    @property
+    def journal_path(self):
+        "Return the path of the journal file, stored next to the DB file."
+        if self.path:
+            return '{}.journal'.format(self.path)
+
+    @property
+    def codec(self):
+        "Return the backend object, see ``meuhdb.backends``."
+        return BACKENDS[self.backend]
+
     @property
     def serializer(self):
-        return BACKENDS[self.backend]['dumper']
+        return self.codec.dumps
 
     @property
     def deserializer(self):
-        return BACKENDS[self.backend]['loader']
-
-    def commit_ready(self):
-        if self.autocommit:
-            return True
-        if self.uses_counter:
-            self.counter -= 1
-            if self.counter:
-                return False
-            else:
-                # counter == 0 -> reset and commit
-                self.counter = self.init_counter
-                return True
+        return self.codec.loads
+
+    def commit_ready(self, writes=1):
+        "Account for `writes` write operations. Return True to commit now."
+        return self.policy.written(writes)
 
 
 class MeuhDb(object):
@@ -86,7 +188,12 @@ class MeuhDb(object):
     def __init__(self,
                  path=None, autocommit=False, autocommit_after=None,
                  lazy_indexes=False,
-                 backend=DEFAULT_BACKEND):
+                 backend=DEFAULT_BACKEND,
+                 journal=False, keep_generations=0,
+                 background_commit=False, streaming_load=False,
+                 lazy_open=False, lazy_cache_size=lazy.CACHE_SIZE,
+                 format='json', compression=None, compression_level=None,
+                 commit_policy=None, copy_on_write=True, read_policy='live'):
         """
         Options:
 
@@ -101,25 +208,234 @@ class MeuhDb(object):
           will load slower, because we'll need to rebuild all indexes,
         * ``backend``: Set which backend to use. Will default to the fastest
           backend available, or the stdlib ``json`` module.
+        * ``journal``: When set to True, a commit only appends the write
+          operations made since the last commit to a journal file stored next
+          to the DB file, instead of rewriting the whole database. The journal
+          is replayed when the DB is opened, and folded into the DB file by
+          ``compact()``.
+        * ``keep_generations``: The number of previous versions of the DB file
+          to keep (as ``<path>.1``, ``<path>.2``...) when it's written.
+          They're used as a fallback if the DB file is corrupted.
+        * ``background_commit``: When set to True, the commits triggered by
+          ``autocommit`` or ``autocommit_after`` are made by a background
+          thread, and the commit requests made while a commit is running are
+          merged into a single one. Use ``flush()`` to wait until every write
+          is stored, and ``close()`` to stop the thread.
+        * ``streaming_load``: When set to True, the DB file is parsed by
+          chunks, record after record, instead of being read and decoded at
+          once. Loading is a bit slower, but the whole file content is never
+          held in memory. The file is always parsed as JSON.
+        * ``lazy_open``: When set to True, the DB file is memory-mapped, and
+          only the positions of the records in the file are read when it's
+          opened. Records are decoded on demand, and the most recently used
+          ones are cached (``lazy_cache_size`` of them). Written records are
+          kept in memory until the next commit.
+        * ``format``: The format of the DB file when it's written: ``json``
+          (the default), or ``binary``, where each record is stored
+          separately, along with a directory of their positions. A binary DB
+          file is always memory-mapped, and its records decoded on demand,
+          like with ``lazy_open``. Both formats can be loaded, whatever the
+          option is.
+        * ``compression``: The codec compressing the DB file when it's
+          written: ``gzip``, ``bz2``, ``lzma`` or ``zstd`` (if installed).
+          The compression of a DB file is detected when it's loaded, whatever
+          the option is. It can't be used with ``lazy_open``, or the
+          ``binary`` format, which need a memory map of the file.
+        * ``compression_level``: The compression level, trading the commit
+          speed for the file size. Defaults to the default level of the
+          codec.
+        * ``commit_policy``: A ``meuhdb.policies.CommitPolicy``, deciding
+          when the write operations are committed, overriding ``autocommit``
+          and ``autocommit_after``. Time-based policies commit the pending
+          writes with a timer.
+        * ``copy_on_write``: When set to False, the values given to the write
+          methods are stored as they are, instead of deep copies. Neither
+          these values nor the ones returned by the DB must then be modified
+          in place.
+        * ``read_policy``: How ``get()``, ``all()`` and ``filter()`` return
+          the records: ``live`` (the default) returns the stored records,
+          which must not be modified in place, ``copy`` returns copies of
+          them, and ``frozen`` read-only views of them, made without copying
+          anything.
 
         """
         self._meta = Meta(
             path,
             autocommit=autocommit, autocommit_after=autocommit_after,
             lazy_indexes=lazy_indexes,
-            backend=backend)
+            backend=backend,
+            journal=journal, keep_generations=keep_generations,
+            background_commit=background_commit,
+            streaming_load=streaming_load,
+            lazy_open=lazy_open, lazy_cache_size=lazy_cache_size,
+            format=format, compression=compression,
+            compression_level=compression_level, commit_policy=commit_policy,
+            copy_on_write=copy_on_write, read_policy=read_policy)
         self.raw = {}
         self.raw['indexes'] = {}
         self.raw['data'] = {}
         self.raw['index_defs'] = {}
+        # Write operations waiting to be appended to the journal
+        self._journal = []
+        # Ordered values of the sorted indexes (see ``lookups.sort_key()``)
+        self._sorted_keys = {}
+        # Plan of the last query
+        self._last_plan = None
+        # Write operations hold `_lock`, commits hold `_io_lock`
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+        self._committer = None
+        self._timer = None
+        # Number of nested write operations being run
+        self._write_depth = 0
+        # Batches: number of nested batches, writes made in the batch, and
+        # the thread running it
+        self._batch_depth = 0
+        self._batch_writes = 0
+        self._batch_thread = None
+        self._stats = dict.fromkeys(STATS, 0)
+        # Undo logs of the running transactions
+        self._transactions = []
+        # Whether the DB has been modified since the last commit, and the
+        # keys of the records modified
+        self._dirty = False
+        self._dirty_keys = set()
+        # Columns of the records' values, cached by aggregate()
+        self._columns = {}
+        # The backends that encoded the loaded DB file and journal
+        self._file_codec = self._meta.codec
+        self._foreign_journal = False
+        self._replaying = True
         if path:
-            if os.path.exists(path):
+            self._load()
+        self._clean_index()
+        self._replay_journal()
+        self._replaying = False
+        self._start_commits()
+
+    def _start_commits(self):
+        "Start the background commit thread and the timer, if needed."
+        if not self._meta.path:
+            return
+        if self._meta.background_commit:
+            self._committer = BackgroundCommitter(self)
+        if self._meta.policy.timed:
+            self._timer = CommitTimer(self)
+
+    def _load_file(self, path):
+        "Return the DB content found in the file, if it exists and not empty."
+        if not os.path.exists(path):
+            return None
+        codec = self._file_codec = self._stored_codec(path)
+        compressed = compression.detect(path)
+        if compressed is not None:
+            fd = compression.DecompressedFile(compressed, path)
+        else:
+            # Lazy open and streaming load parse JSON
+            if binary.is_binary(path) or (self._meta.lazy_open and codec.text):
+                return self._open_mapped(path, codec)
+            if not os.path.getsize(path):
+                return None
+            fd = open(path, 'rb')
+        with fd:
+            if self._meta.streaming_load and codec.text:
+                return streaming.load(fd)
+            if not codec.text:
+                return codec.load(fd)
+            content = fd.read().decode('utf-8')
+        if content.strip():
+            return codec.loads(content)
+
+    def _stored_codec(self, path):
+        """Return the backend that encoded the DB file: the configured one,
+        unless the file has been encoded by another one."""
+        compressed = compression.detect(path)
+        if compressed is not None:
+            with compression.DecompressedFile(compressed, path) as fd:
+                head = fd.read(backends.HEAD_SIZE)
+        elif binary.is_binary(path):
+            head = binary.read_index_head(path, backends.HEAD_SIZE)
+        else:
+            with open(path, 'rb') as fd:
+                head = fd.read(backends.HEAD_SIZE)
+        return backends.detect(head, self._meta.codec)
+
+    def _open_mapped(self, path, codec):
+        "Return the DB content found in the file, with lazy-loaded records."
+        mapped = self._map_file(path, codec)
+        if mapped is None:
+            return None
+        buf, offsets, content, read = mapped
+        content['data'] = lazy.LazyData(
+            buf, offsets, codec.decode, self._meta.lazy_cache_size, read)
+        return content
+
+    def _map_file(self, path, codec):
+        """
+        Memory-map the DB file, and find its records, encoded by `codec`.
+
+        Return the memory map, the positions of the records, the other
+        sections of the file, and the function reading a record from the
+        memory map. Return None if the file is empty.
+        """
+        buf = lazy.open_mapping(path)
+        if buf is None:
+            return None
+        try:
+            if buf[:len(binary.MAGIC)] == binary.MAGIC:
+                offsets, content = binary.scan(buf, codec.decode)
+                read = binary.read_blob
+            else:
+                offsets, content = lazy.scan(buf)
+                read = lazy.read_slice
+        except ValueError:
+            buf.close()
+            raise
+        return buf, offsets, content, read
+
+    def _load(self):
+        """
+        Load the DB file.
+
+        If it's corrupted, fall back to the most recent generation that can be
+        loaded, or raise a ``CorruptedDatabaseError``.
+        """
+        path = self._meta.path
+        try:
+            data = self._load_file(path)
+        except ValueError:
+            for generation in range(1, self._meta.keep_generations + 1):
                 try:
-                    data = self.deserialize(open(path).read())
-                    self.raw.update(data)
+                    data = self._load_file(generation_path(path, generation))
                 except ValueError:
-                    pass
-        self._clean_index()
+                    continue
+                if data is not None:
+                    warnings.warn(
+                        '{} is corrupted, loaded its generation #{} '
+                        'instead'.format(path, generation))
+                    # The corrupted file is replaced on the next commit
+                    self._dirty = True
+                    break
+            else:
+                raise CorruptedDatabaseError(
+                    'Unable to load the database file {}'.format(path))
+        else:
+            if data and not self._stored_as_configured(path):
+                # Converted on the next commit
+                self._dirty = True
+        if data:
+            self.raw.update(data)
+
+    def _stored_as_configured(self, path):
+        """Return True if the DB file has the backend, the format and the
+        compression set by the options."""
+        if self._file_codec is not self._meta.codec:
+            return False
+        compressed = compression.detect(path)
+        if compressed is not None:
+            return compressed.name == self._meta.compression
+        return self._meta.compression is None and \
+            binary.is_binary(path) == (self._meta.format == 'binary')
 
     def serialize(self, obj):
         return self._meta.serializer(obj)
@@ -151,7 +467,16 @@ class MeuhDb(object):
         Return value of 'key' if it's in the database.
         Raise KeyError if not.
         """
-        return self.data[key]
+        return self._read(self.data[key])
+
+    def _read(self, record):
+        "Return the stored record, as the read policy wants it."
+        policy = self._meta.read_policy
+        if policy == 'frozen':
+            return FrozenMapping(record)
+        if policy == 'copy':
+            return copy_value(record)
+        return record
 
     @autocommit
     def set(self, key, value):
@@ -161,11 +486,229 @@ class MeuhDb(object):
             raise BadValueError(
                 'The value {} is incorrect.'
                 ' Values should be strings'.format(value))
-        _value = deepcopy(value)
+        _value = self._own(value)
+        self._remember(key)
         if key in self.data:
             self.delete_from_index(key)
         self.data[key] = _value
         self.update_index(key, _value)
+        self._log('set', key, _value)
+
+    def _own(self, value):
+        """Return the value to be stored: a deep copy of it, unless
+        ``copy_on_write`` is False."""
+        if self._meta.copy_on_write:
+            return deepcopy(value)
+        return value
+
+    def _patch(self, key, record, fields):
+        """
+        Store the new version of an existing record, where only the
+        (top-level) `fields` have changed.
+
+        Only the indexes on these fields are updated.
+        """
+        old = self.data[key]
+        self._remember(key)
+        idx_names = [
+            idx_name for idx_name in self.indexes
+            if not fields.isdisjoint(self._indexed_fields(idx_name))]
+        for idx_name in idx_names:
+            self._remove_from_index(idx_name, key, old)
+        self.data[key] = record
+        for idx_name in idx_names:
+            self._add_to_index(idx_name, key, record)
+        self._log('set', key, record)
+
+    def _indexed_fields(self, idx_name):
+        """Return the top-level fields of the records the index depends on
+        (e.g. ``user`` for an index on ``user.country``)."""
+        fields = self.index_defs[idx_name].get('fields', [idx_name])
+        top_fields = set(fields)
+        top_fields.update(field.split(PATH_SEP)[0] for field in fields)
+        return top_fields
+
+    @autocommit
+    def set_many(self, mapping):
+        """
+        Set several values to the key store, from a dict or a list of
+        (key, value) pairs.
+
+        The indexes are updated one after the other, and it's accounted for a
+        single write operation by autocommit.
+        """
+        items = list(mapping.items() if isinstance(mapping, dict) else mapping)
+        self._set_many(items)
+
+    @autocommit
+    def insert_many(self, values):
+        "Insert several values in the keystore. Return the list of UUID keys."
+        values = list(values)
+        keys = [str(uuid4()) for value in values]
+        self._set_many(list(zip(keys, values)))
+        return keys
+
+    def _set_many(self, items):
+        "Set the list of (key, value) pairs."
+        for key, value in items:
+            if not isinstance(value, dict):
+                raise BadValueError(
+                    'The value {} is incorrect.'
+                    ' Values should be strings'.format(value))
+        items = [(key, self._own(value)) for key, value in items]
+        for key, value in items:
+            self._remember(key)
+        for idx_name in list(self.indexes):
+            for key, value in items:
+                if key in self.data:
+                    self._remove_from_index(idx_name, key, self.data[key])
+        data = self.data
+        for key, value in items:
+            data[key] = value
+            self._log('set', key, value)
+        for idx_name in list(self.indexes):
+            for key, value in items:
+                # The last value of a key wins
+                if data[key] is value:
+                    self._add_to_index(idx_name, key, value)
+
+    @autocommit
+    def delete_many(self, keys):
+        "Delete several keys from the keystore."
+        keys = list(keys)
+        for key in keys:
+            if key not in self.data:
+                raise KeyError(key)
+        keys = list(set(keys))
+        for key in keys:
+            self._remember(key)
+        for idx_name in list(self.indexes):
+            for key in keys:
+                self._remove_from_index(idx_name, key, self.data[key])
+        for key in keys:
+            del self.data[key]
+            self._log('delete', key)
+
+    @contextmanager
+    def batch(self):
+        """
+        Group write operations: within the block, autocommit is suspended,
+        and the DB is committed at most once, at the end of the block.
+
+        The DB is locked during the block, a background commit won't see
+        a part of its writes only, and the DB can't be committed within it.
+        If an exception is raised, the writes already made are kept but not
+        committed.
+        """
+        with self._lock:
+            self._batch_depth += 1
+            self._batch_thread = threading.current_thread()
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                writes = 0
+                if not self._batch_depth:
+                    writes, self._batch_writes = self._batch_writes, 0
+                    self._batch_thread = None
+            self._stats['writes'] += writes
+            ready = writes and self._meta.commit_ready(writes)
+        if writes and self._timer is not None:
+            self._timer.wake()
+        if ready:
+            self._autocommit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the block as a transaction: if an exception is raised, every
+        write operation made in the block is rolled back.
+
+        Only the original values of the modified records are kept. When the
+        outermost transaction succeeds, the DB is committed once, whatever
+        the autocommit options are (unless the transaction is run within a
+        ``batch()``). Transactions can be nested.
+        """
+        with self.batch():
+            outermost = not self._transactions
+            within_batch = self._batch_depth > 1
+            undo = {
+                'records': {},
+                'indexes': {},
+                'journal': len(self._journal),
+            }
+            self._transactions.append(undo)
+            try:
+                yield self
+            except BaseException:
+                self._transactions.pop()
+                self._rollback(undo)
+                raise
+            self._transactions.pop()
+            if self._transactions:
+                # The enclosing transaction may roll these writes back
+                parent = self._transactions[-1]
+                for key, value in undo['records'].items():
+                    parent['records'].setdefault(key, value)
+                for idx_name, index_def in undo['indexes'].items():
+                    parent['indexes'].setdefault(idx_name, index_def)
+        if outermost and not within_batch and self.dirty:
+            # Unless the batch has already been autocommitted
+            self.commit()
+
+    def _remember(self, key):
+        "Keep the original value of a record modified in a transaction."
+        if self._transactions:
+            records = self._transactions[-1]['records']
+            if key not in records:
+                # Stored values are never modified in place, no need to copy
+                records[key] = self.data.get(key, MISSING)
+
+    def _remember_index(self, idx_name):
+        "Keep the original definition of an index modified in a transaction."
+        if self._transactions:
+            indexes = self._transactions[-1]['indexes']
+            if idx_name not in indexes:
+                index_def = MISSING
+                if idx_name in self.indexes:
+                    index_def = deepcopy(self.index_defs[idx_name])
+                indexes[idx_name] = index_def
+
+    def _rollback(self, undo):
+        "Restore the records and indexes modified in a transaction."
+        self._columns.clear()
+        data = self.data
+        for key, value in undo['records'].items():
+            # Written again by the next commit, whatever has been committed
+            self._dirty = True
+            self._dirty_keys.add(key)
+            if key in data:
+                self.delete_from_index(key)
+                del data[key]
+            if value is not MISSING:
+                data[key] = value
+                self.update_index(key, value)
+        # The modified indexes are built again, from the restored records
+        for idx_name, index_def in undo['indexes'].items():
+            self.indexes.pop(idx_name, None)
+            self.index_defs.pop(idx_name, None)
+            self._sorted_keys.pop(idx_name, None)
+            if index_def is not MISSING:
+                self.index_defs[idx_name] = index_def
+                self.indexes[idx_name] = self._compute_index(idx_name)[0]
+                if index_def['type'] == 'sorted':
+                    self._sorted_keys[idx_name] = sorted_keys(
+                        self.indexes[idx_name])
+        del self._journal[undo['journal']:]
+
+    def _autocommit(self):
+        "Commit, or request a commit if it's made in the background."
+        with self._lock:
+            self._stats['commits_triggered'] += 1
+        if self._committer is not None:
+            self._committer.request()
+        else:
+            self.commit()
 
     @autocommit
     def insert(self, value):
@@ -178,8 +721,10 @@ class MeuhDb(object):
     def delete(self, key):
         "Delete a `key` from the keystore."
         if key in self.data:
+            self._remember(key)
             self.delete_from_index(key)
         del self.data[key]
+        self._log('delete', key)
 
     @autocommit
     def update(self, key, value):
@@ -190,81 +735,582 @@ class MeuhDb(object):
             raise BadValueError(
                 'The value {} is incorrect.'
                 ' Values should be strings'.format(value))
-        if key in self.data:
-            v = self.get(key)
-            v.update(value)
-        else:
-            v = value
-        self.set(key, v)
+        if key not in self.data:
+            self.set(key, value)
+            return
+        # Stored values are never modified in place, they may be being
+        # written by a background commit. The unchanged fields are shared.
+        old = self.data[key]
+        patch = self._own(value)
+        v = dict(old)
+        v.update(patch)
+        changed = set(
+            field for field, field_value in patch.items()
+            if field not in old or old[field] != field_value)
+        self._patch(key, v, changed)
 
     @property
     def lazy_indexes(self):
+        "Return the names of the indexes whose values aren't stored."
         return set([
             idx_name for (idx_name, value) in self.raw['index_defs'].items()
-            if value['type'] == 'lazy'
+            if value['type'] in UNSTORED_INDEX_TYPES
         ])
 
     @autocommit
     def del_key(self, key, key_to_delete):
         "Delete the `key_to_delete` for the record found with `key`."
-        v = self.get(key)
+        v = self.data[key]
         if key_to_delete in v:
+            v = dict(v)
             del v[key_to_delete]
-            self.set(key, v)
+            self._patch(key, v, set([key_to_delete]))
+
+    def _log(self, *operation):
+        """Keep track of a write operation: the DB is marked as dirty, and the
+        operation is kept to be appended to the journal."""
+        self._columns.clear()
+        if self._replaying:
+            return
+        self._dirty = True
+        if operation[0] in ('set', 'delete'):
+            self._dirty_keys.add(operation[1])
+            policy = self._meta.policy
+            if policy.measures_size:
+                size = len(to_bytes(operation[1]))
+                if operation[0] == 'set':
+                    size += len(to_bytes(self.serialize(operation[2])))
+                policy.measured(size)
+        if self._meta.journal and self._meta.path:
+            self._journal.append(operation)
+
+    @property
+    def dirty(self):
+        "Return True if the DB has been modified since the last commit."
+        return self._dirty
+
+    @property
+    def dirty_keys(self):
+        """Return the set of the keys of the records written or deleted since
+        the last commit."""
+        with self._lock:
+            return set(self._dirty_keys)
+
+    def _take_dirty(self):
+        """Mark the DB as clean. Return the keys of the records modified since
+        the last commit, or None if it was clean."""
+        if not self._dirty:
+            return None
+        keys, self._dirty_keys = self._dirty_keys, set()
+        self._dirty = False
+        return keys
+
+    def _restore_dirty(self, keys):
+        "Mark the DB as dirty again, after a failed commit."
+        with self._lock:
+            self._dirty = True
+            self._dirty_keys.update(keys)
+
+    def _replay_journal(self):
+        "Apply the write operations found in the journal file, if any."
+        journal_path = self._meta.journal_path
+        if not journal_path or not os.path.exists(journal_path):
+            return
+        torn = None
+        with open(journal_path, 'rb') as fd:
+            try:
+                codec = backends.detect(
+                    fd.read(backends.HEAD_SIZE), self._meta.codec,
+                    records=True)
+            except ValueError:
+                raise CorruptedDatabaseError(
+                    'Unable to load the journal file {}'.format(journal_path))
+            fd.seek(0)
+            records = codec.load_records(fd)
+            while True:
+                # The end of the last complete record
+                end = fd.tell()
+                try:
+                    operation = next(records)
+                except StopIteration:
+                    break
+                except ValueError:
+                    # A write has been interrupted, ignore the torn record
+                    warnings.warn(
+                        'Incomplete record found in {}, the journal is '
+                        'truncated before it'.format(journal_path))
+                    torn = end
+                    break
+                name, args = operation[0], operation[1:]
+                if name not in JOURNAL_OPERATIONS:
+                    raise ValueError(
+                        'Unknown journal operation: {}'.format(name))
+                if name == 'delete' and not self.exists(args[0]):
+                    continue
+                getattr(self, name)(*args)
+        if codec is not self._meta.codec:
+            # Converted on the next commit, instead of appending to it
+            self._foreign_journal = True
+            self._dirty = True
+        if torn is not None:
+            # The next operations are appended after the last complete one
+            with open(journal_path, 'r+b') as fd:
+                fd.truncate(torn)
+                fd.flush()
+                os.fsync(fd.fileno())
+
+    def _remove_journal(self):
+        """Remove the journal file: its operations are in the DB file, once
+        it's been written."""
+        journal_path = self._meta.journal_path
+        if journal_path and os.path.exists(journal_path):
+            os.unlink(journal_path)
+
+    def _append_journal(self, operations):
+        """Append the write operations to the journal file. Return the number
+        of bytes written."""
+        size = 0
+        with open(self._meta.journal_path, 'ab') as fd:
+            for operation in operations:
+                record = self._meta.codec.dump_record(list(operation))
+                fd.write(record)
+                size += len(record)
+            fd.flush()
+            os.fsync(fd.fileno())
+        return size
 
     def commit(self):
-        "Commit data to the storage."
-        if self._meta.path:
-            with open(self._meta.path, 'wb') as fd:
-                raw = deepcopy(self.raw)
-                # LAZY INDEX PROCESSING
-                # Save indexes only if not lazy
-                lazy_indexes = self.lazy_indexes  # Keep this list safe
-                if not self._meta.lazy_indexes:
-                    # Remove indexes if needed
-                    for idx_name in lazy_indexes:
-                        del raw['indexes'][idx_name]
-                    for index_name, values in raw['indexes'].items():
-                        for value, keys in values.items():
-                            raw['indexes'][index_name][value] = list(keys)
-                # don't store indexes if not needed
-                if not raw['indexes'] or self._meta.lazy_indexes:
-                    del raw['indexes']
+        """
+        Commit data to the storage. Nothing is written if the DB hasn't been
+        modified since the last commit.
+
+        When the journal is enabled, only the pending write operations are
+        appended to the journal file. With background commits, the commit is
+        made by the background thread, this method waits until it's done.
+
+        Raise a ``RuntimeError`` within a ``batch()`` or a ``transaction()``.
+        """
+        self._check_batch()
+        if self._committer is not None:
+            self._committer.flush()
+        else:
+            self._commit_now()
+
+    def flush(self):
+        "Wait until every write operation made so far is committed."
+        self.commit()
+
+    def _check_batch(self):
+        "Raise a ``RuntimeError`` if the current thread is running a batch."
+        if self._batch_thread is threading.current_thread():
+            # The batch holds the lock the commit waits for
+            raise RuntimeError('Unable to commit the DB within a batch')
+
+    def close(self):
+        """Commit, and stop the background commit thread, if any. Close the
+        lazy-loaded DB file.
+
+        With a time-based commit policy, the timer is stopped, and the
+        pending writes are committed."""
+        self._check_batch()
+        if self._timer is not None:
+            timer, self._timer = self._timer, None
+            timer.close()
+            self.commit()
+        if self._committer is not None:
+            committer, self._committer = self._committer, None
+            committer.close()
+        if isinstance(self.data, lazy.LazyData):
+            self.data.close()
+
+    def _commit_now(self, copy=False):
+        """
+        Commit data to the storage, in the current thread.
+
+        When `copy` is True, the data is copied (as a shallow copy), so the
+        write operations aren't blocked while it's being written.
+        """
+        if not self._meta.path:
+            return
+        with self._io_lock:
+            start = clock()
+            with self._lock:
+                self._meta.policy.committed()
+                dirty_keys = self._take_dirty()
+                if dirty_keys is None:
+                    self._stats['commits_skipped'] += 1
+                    return
+                journal = self._meta.journal and not self._foreign_journal
+                if journal:
+                    operations, self._journal = self._journal, []
+                else:
+                    self._journal = []
+                    snapshot = self._snapshot(copy)
+                    written = self._pending_records()
+            size = 0
+            if not journal:
+                try:
+                    size = self._write_snapshot(snapshot)
+                except BaseException:
+                    self._restore_dirty(dirty_keys)
+                    raise
+                self._reopen(written)
+                # A journal left by a previous session is stale now
+                self._remove_journal()
+                self._foreign_journal = False
+            elif operations:
                 try:
-                    fd.write(six.u(self.serialize(raw)))
-                except TypeError:
-                    fd.write(six.b(self.serialize(raw)))
+                    size = self._append_journal(operations)
+                except BaseException:
+                    with self._lock:
+                        self._journal[:0] = operations
+                    self._restore_dirty(dirty_keys)
+                    raise
+            self._count_commit(size, start)
+
+    def compact(self):
+        "Write the whole DB to the storage, and empty the journal."
+        self._check_batch()
+        if self._committer is not None:
+            # Pending commits first
+            self._committer.flush()
+        with self._io_lock:
+            start = clock()
+            with self._lock:
+                snapshot = self._snapshot(copy=self._committer is not None)
+                written = self._pending_records()
+                self._journal = []
+                self._meta.policy.committed()
+                dirty_keys = self._take_dirty() or set()
+            try:
+                size = self._write_snapshot(snapshot)
+            except BaseException:
+                self._restore_dirty(dirty_keys)
+                raise
+            self._reopen(written)
+            self._count_commit(size, start)
+            self._remove_journal()
+            self._foreign_journal = False
+
+    def _timed_commit(self):
+        "Commit the pending writes, at the deadline of the commit policy."
+        with self._lock:
+            self._stats['commits_triggered'] += 1
+        if self._committer is not None:
+            self.commit()
+        else:
+            # Writes aren't blocked while the DB is written
+            self._commit_now(copy=True)
+
+    def _count_commit(self, size, start):
+        "Account for a commit, writing `size` bytes, started at `start`."
+        with self._lock:
+            self._stats['commits'] += 1
+            self._stats['bytes_written'] += size
+            self._stats['commit_time'] += clock() - start
+
+    def stats(self):
+        """
+        Return the I/O counters of the DB, as a dict:
+
+        * ``writes``: write operations (a batch counts as its writes),
+        * ``commits_triggered``: commits triggered by the commit policy,
+        * ``commits``: commits writing to the storage,
+        * ``commits_skipped``: commits skipped, nothing had been modified,
+        * ``bytes_written``: bytes written to the DB and journal files,
+        * ``commit_time``: seconds spent committing.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _write_snapshot(self, snapshot):
+        """
+        Write the whole DB to the storage file. Return the size of the file.
+
+        The file is atomically replaced, so that it's never left truncated.
+        """
+        if not self._meta.path:
+            return 0
+        atomic_write(
+            self._meta.path,
+            lambda fd: self._dump_compressed(snapshot, fd),
+            generations=self._meta.keep_generations)
+        return os.path.getsize(self._meta.path)
+
+    def _dump_compressed(self, snapshot, fd):
+        "Serialize the DB snapshot to `fd`, compressed if required."
+        if self._meta.compression is None:
+            return self._dump_snapshot(snapshot, fd)
+        writer = compression.CompressedWriter(
+            fd, COMPRESSIONS[self._meta.compression].compressor(
+                self._meta.compression_level))
+        self._dump_snapshot(snapshot, writer)
+        writer.close()
+
+    def _pending_records(self):
+        "Return the records written since the lazy-loaded file was written."
+        if isinstance(self.data, lazy.LazyData):
+            return self.data.pending()
+
+    def _reopen(self, written):
+        """Switch the lazy-loaded records to the DB file that's just been
+        written, where the `written` records are stored."""
+        if written is None:
+            return
+        codec = self._meta.codec
+        if self._meta.format != 'binary' and not (
+                self._meta.lazy_open and codec.text):
+            # The file has been converted to a backend or a format that
+            # can't be memory-mapped
+            with self._lock:
+                data = self.data
+                self.raw['data'] = dict(data.items())
+                data.close()
+            return
+        buf, offsets, content, read = self._map_file(self._meta.path, codec)
+        with self._lock:
+            self.data.reopen(buf, offsets, written, read, codec.decode)
+
+    def _snapshot(self, copy=False):
+        """
+        Return the parts of the DB to be written to the storage.
+
+        Unless `copy` is True, they're the live structures.
+        """
+        indexes = self._stored_indexes()
+        copy_keys = set if set in self._meta.codec.native_types else list
+        if not copy:
+            return {
+                'data': self.data,
+                'index_defs': self.index_defs,
+                'indexes': indexes,
+            }
+        return {
+            # Stored values are never modified in place
+            'data': dict(self.data.items()),
+            'index_defs': deepcopy(self.index_defs),
+            'indexes': dict(
+                (idx_name, dict(
+                    (value, copy_keys(keys))
+                    for value, keys in values.items()))
+                for idx_name, values in indexes.items()
+            ),
+        }
+
+    def _stored_indexes(self):
+        "Return the indexes to be written to the storage, if any."
+        if self._meta.lazy_indexes:
+            return {}
+        lazy_indexes = self.lazy_indexes
+        return dict(
+            (idx_name, values) for idx_name, values in self.indexes.items()
+            if idx_name not in lazy_indexes
+        )
+
+    def _dump_snapshot(self, snapshot, fd):
+        """
+        Serialize the DB snapshot to the binary file `fd`.
+
+        The document is written straight from the snapshot, by chunks,
+        instead of serializing a copy of ``raw`` where index sets would be
+        turned into lists.
+        """
+        if self._meta.format == 'binary':
+            return self._dump_binary(snapshot, fd)
+        codec = self._meta.codec
+        if not codec.text:
+            document = self._index_sections(snapshot)
+            data = snapshot['data']
+            document['data'] = data if isinstance(data, dict) \
+                else dict(data.items())
+            codec.dump(document, fd)
+            return
+        fd.write(b'{"data": ')
+        self._dump_mapping(six.iteritems(snapshot['data']), fd)
+        fd.write(b', ')
+        self._dump_index_sections(snapshot, fd)
+        fd.write(b'}')
+
+    def _dump_binary(self, snapshot, fd):
+        "Serialize the DB snapshot to `fd`, in the binary format."
+        offsets = binary.write_records(
+            fd, six.iteritems(snapshot['data']), self.serialize)
+        codec = self._meta.codec
+        index_position = fd.tell()
+        if codec.text:
+            fd.write(b'{')
+            self._dump_index_sections(snapshot, fd)
+            fd.write(b'}')
+        else:
+            codec.dump(self._index_sections(snapshot), fd)
+        directory_position = fd.tell()
+        if codec.text:
+            self._dump_mapping(six.iteritems(offsets), fd)
+        else:
+            codec.dump(offsets, fd)
+        binary.write_footer(fd, index_position, directory_position)
+
+    def _index_sections(self, snapshot):
+        """Return the index definitions and the stored index values of the DB
+        snapshot, ready to be serialized by a binary backend."""
+        sections = {'index_defs': snapshot['index_defs']}
+        if snapshot['indexes']:
+            sections['indexes'] = dict(
+                (idx_name, dict(self._stored_index_items(
+                    values, snapshot['index_defs'][idx_name])))
+                for idx_name, values in snapshot['indexes'].items())
+        return sections
+
+    def _stored_index_items(self, values, index_def):
+        """
+        Iterate over the (value, keys) pairs of an index, as they're stored.
+
+        Unless the backend handles them, sets of keys are turned into lists,
+        and compound values are encoded (JSON keys are strings).
+        """
+        native_types = self._meta.codec.native_types
+        encode = 'fields' in index_def and tuple not in native_types
+        keep_sets = set in native_types
+        for value, keys in values.items():
+            if encode:
+                value = self.serialize(list(value))
+            yield value, keys if keep_sets else list(keys)
+
+    def _dump_index_sections(self, snapshot, fd):
+        """Serialize the index definitions and the stored index values of the
+        DB snapshot, as members of a JSON object."""
+        fd.write(b'"index_defs": ')
+        fd.write(to_bytes(self.serialize(snapshot['index_defs'])))
+        indexes = snapshot['indexes']
+        # don't store indexes if not needed
+        if indexes:
+            fd.write(b', "indexes": {')
+            for i, (idx_name, values) in enumerate(indexes.items()):
+                if i:
+                    fd.write(b', ')
+                fd.write(to_bytes(self.serialize(idx_name)))
+                fd.write(b': ')
+                self._dump_mapping(self._stored_index_items(
+                    values, snapshot['index_defs'][idx_name]), fd)
+            fd.write(b'}')
+
+    def _dump_mapping(self, items, fd):
+        """
+        Serialize the (key, value) pairs as a mapping to the binary file `fd`.
+
+        The pairs are serialized by chunks, to keep the memory footprint low
+        while still using the (fast) serializer of the backend.
+        """
+        fd.write(b'{')
+        first = True
+        while True:
+            chunk = dict(islice(items, SNAPSHOT_CHUNK_SIZE))
+            if not chunk:
+                break
+            if not first:
+                fd.write(b', ')
+            first = False
+            # Strip the curly brackets of the chunk
+            fd.write(to_bytes(self.serialize(chunk)).strip()[1:-1])
+        fd.write(b'}')
 
     def all(self):
-        "Retrieve the data from the keystore"
+        """
+        Retrieve the data from the keystore.
+
+        Depending on the read policy, it's the stored data, a copy of it, or
+        a read-only view of it.
+        """
+        policy = self._meta.read_policy
+        if policy == 'frozen':
+            return FrozenMapping(self.data)
+        if policy == 'copy':
+            return dict(
+                (key, copy_value(value)) for key, value in self.data.items())
         return self.data
 
     def keys_to_values(self, keys):
         "Return the items in the keystore with keys in `keys`."
-        return dict((k, v) for k, v in self.data.items() if k in keys)
+        data = self.data
+        if self._meta.read_policy == 'live':
+            return dict((k, data[k]) for k in keys if k in data)
+        read = self._read
+        return dict((k, read(data[k])) for k in keys if k in data)
 
     def filter_keys(self, **kwargs):
-        "Return a set of keys filtered according to the given arguments."
-        self._used_index = False
-        keys = set(self.data.keys())
-        for key_filter, v_filter in kwargs.items():
-            if key_filter in self.indexes:
-                self._used_index = True
-                if v_filter not in self.indexes[key_filter]:
-                    keys = set([])
-                else:
-                    keys = keys.intersection(
-                        self.indexes[key_filter][v_filter])
-            else:
-                keys = keys.intersection(
-                    self.simple_filter(key_filter, v_filter))
+        """
+        Return a set of keys filtered according to the given arguments.
+
+        Arguments are field names, optionally followed by a lookup, e.g.
+        ``score__gt=10`` (see ``meuhdb.lookups.LOOKUPS``).
+
+        Indexed arguments are evaluated first, starting with the most
+        selective one. The other ones only check the remaining records, in a
+        single pass (see ``meuhdb.planner.QueryPlan``).
+        """
+        self._last_plan = QueryPlan(self, kwargs)
+        return self._last_plan.execute()
+
+    def explain(self, **kwargs):
+        """
+        Run the query and return its plan: the index used by each step, the
+        estimated and actual number of keys, and whether a full scan happened.
+        """
+        plan = QueryPlan(self, kwargs)
+        plan.execute()
+        return plan.explain()
+
+    @property
+    def _used_index(self):
+        "Return True if the last query used an index."
+        return self._last_plan is not None and not self._last_plan.full_scan
+
+    def index_filter(self, idx_name, value, lookup='exact'):
+        "Search keys whose values match using the index `idx_name`."
+        return set(self._index_keys(idx_name, value, lookup))
+
+    def _index_keys(self, idx_name, value, lookup='exact'):
+        """Return the keys whose values match using the index `idx_name`.
+        The result may be an index bucket, it must not be modified.
+        """
+        index = self.indexes[idx_name]
+        multi = self.index_defs[idx_name].get('multi')
+        if lookup == 'exact' or (lookup == 'contains' and multi):
+            try:
+                return index.get(value, EMPTY_BUCKET)
+            except TypeError:
+                # Unhashable values can't be found in the index
+                return EMPTY_BUCKET
+        if lookup == 'in':
+            values = value
+        elif lookup in RANGE_LOOKUPS and idx_name in self._sorted_keys:
+            values = sorted_range(self._sorted_keys[idx_name], lookup, value)
+        else:
+            # Only the distinct values of the index are checked
+            predicate = LOOKUPS[lookup]
+            values = [v for v in index if predicate(v, value)]
+        keys = set([])
+        for v in values:
+            try:
+                keys.update(index.get(v, ()))
+            except TypeError:
+                pass
         return keys
 
-    def simple_filter(self, key, value):
-        "Search keys whose values match with the searched values"
-        searched = {key: value}
-        return set([k for k, v in self.data.items() if
-                    intersect(searched, v) == searched])
+    def simple_filter(self, key, value, lookup='exact', keys=None):
+        """Search keys whose values match with the searched values.
+        If `keys` is given, only these keys are checked.
+        """
+        predicate = LOOKUPS[lookup]
+        data = self.data
+        if keys is None:
+            items = six.iteritems(data)
+        else:
+            items = ((k, data[k]) for k in keys if k in data)
+        return set([
+            k for k, v in items
+            if resolve(v, key) is not MISSING
+            and predicate(resolve(v, key), value)])
 
     def filter(self, **kwargs):
         """
@@ -273,66 +1319,216 @@ class MeuhDb(object):
         keys = self.filter_keys(**kwargs)
         return self.keys_to_values(keys)
 
+    def query(self, **kwargs):
+        """
+        Return a lazy query over the records matching the arguments (the
+        ones of ``filter_keys()``), supporting ``order_by()``, ``limit()``,
+        ``offset()``, ``count()``, ``keys()`` and ``first()``.
+        """
+        return Query(self, kwargs)
+
+    def aggregate(self, group_by=None, count=False, sum=None, min=None,
+                  max=None, avg=None, where=None):
+        """
+        Return aggregates of the records matching `where` (a dict of
+        ``filter_keys()`` arguments): their ``count``, and the ``sum``,
+        ``min``, ``max`` or ``avg`` of the numeric values of a field.
+
+        If `group_by` is set, return the aggregates for each value of this
+        field. Grouped counts come from its index, if there's one.
+        """
+        return aggregation.aggregate(
+            self, group_by=group_by, count=count, where=where, sum=sum,
+            min=min, max=max, avg=avg)
+
+    def _index_values(self, idx_name, record):
+        """
+        Return the values of the record for the index (an empty list if the
+        record isn't indexed), and whether one of its fields is a list.
+
+        Fields may be paths to nested fields, and every element of a list is
+        indexed. The values of a compound index are the tuples of the values
+        of its fields, a record is indexed if it has every field.
+        """
+        fields = self.index_defs[idx_name].get('fields')
+        if fields is None:
+            value = resolve(record, idx_name)
+            return indexable_values(value), isinstance(value, list)
+        values = [resolve(record, field) for field in fields]
+        multi = any(isinstance(value, list) for value in values)
+        return list(product(*map(indexable_values, values))), multi
+
     def delete_from_index(self, key):
         "Delete references from the index of the key old value(s)."
         old_value = self.data[key]
-        keys = set(old_value.keys()).intersection(self.indexes.keys())
-        for index_name in keys:
-            if old_value[index_name] in self.indexes[index_name]:
-                del self.indexes[index_name][old_value[index_name]]
+        for index_name in self.indexes:
+            self._remove_from_index(index_name, key, old_value)
+
+    def _remove_from_index(self, idx_name, key, value):
+        "Remove the key from the index buckets of its value."
+        index = self.indexes[idx_name]
+        for v in self._index_values(idx_name, value)[0]:
+            keys = index.get(v)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                # Prune the empty buckets
+                del index[v]
+                if idx_name in self._sorted_keys:
+                    self._discard_sorted_key(idx_name, v)
 
     def update_index(self, key, value):
         "Update the index with the new key/values."
-        for k, v in value.items():
-            if k in self.indexes:
-                # A non-string index value switches it into a lazy one.
-                if not isinstance(v, six.string_types):
-                    self.index_defs[k]['type'] = 'lazy'
-                if v not in self.indexes[k]:
-                    self.indexes[k][v] = set([])
-                self.indexes[k][v].add(key)
+        for idx_name in self.indexes:
+            self._add_to_index(idx_name, key, value)
+
+    def _add_to_index(self, idx_name, key, value):
+        "Add the key to the index buckets of its value."
+        index = self.indexes[idx_name]
+        values, multi = self._index_values(idx_name, value)
+        index_def = self.index_defs[idx_name]
+        if multi:
+            index_def['multi'] = True
+        for v in values:
+            # A non-string index value switches it into a lazy one.
+            if not isinstance(v, six.string_types) and \
+                    index_def['type'] == 'default' and \
+                    'fields' not in index_def:
+                index_def['type'] = 'lazy'
+            if v not in index:
+                index[v] = set([])
+                if idx_name in self._sorted_keys:
+                    self._add_sorted_key(idx_name, v)
+            index[v].add(key)
+
+    def _add_sorted_key(self, idx_name, value):
+        "Add a new value to the sorted keys of the index."
+        key = sort_key(value)
+        if key is not None:
+            insort(self._sorted_keys[idx_name], key)
+
+    def _discard_sorted_key(self, idx_name, value):
+        "Discard a value from the sorted keys of the index."
+        key = sort_key(value)
+        sorted_keys = self._sorted_keys[idx_name]
+        if key is not None:
+            position = bisect_left(sorted_keys, key)
+            if position < len(sorted_keys) and sorted_keys[position] == key:
+                del sorted_keys[position]
 
     @autocommit
     def create_index(self, name, recreate=False, _type='default'):
         """
         Create an index.
         If recreate is True, recreate even if already there.
+
+        `name` is a field name, or a tuple of field names to create a compound
+        index, used by the queries filtering on all these fields.
+
+        Index types are ``default``, ``lazy`` (not stored, rebuilt when
+        loading the DB) or ``sorted`` (a lazy index that also keeps its values
+        ordered, to serve range lookups such as ``score__gt=10``).
         """
-        if name not in self.indexes or recreate:
+        if index_name(name) not in self.indexes or recreate:
             self.build_index(name, _type)
 
     @autocommit
     def build_index(self, idx_name, _type='default'):
         "Build the index related to the `name`."
+        fields = None
+        if isinstance(idx_name, (tuple, list)):
+            fields = list(idx_name)
+            idx_name = index_name(idx_name)
+        self._remember_index(idx_name)
+        self.index_defs[idx_name] = index_def = {'type': _type}
+        if fields is not None:
+            index_def['fields'] = fields
+        indexes, multi = self._compute_index(idx_name)
+        if multi:
+            index_def['multi'] = True
+        # A non-string index value switches it into a lazy one.
+        has_non_string_values = not all(
+            isinstance(value, six.string_types) for value in indexes)
+        self.indexes[idx_name] = indexes
+        if _type == 'sorted':
+            self._sorted_keys[idx_name] = sorted_keys(indexes)
+        else:
+            self._sorted_keys.pop(idx_name, None)
+            # Compound index values are encoded as strings when stored
+            if self._meta.lazy_indexes or \
+                    (has_non_string_values and fields is None):
+                # Every index is lazy
+                index_def['type'] = _type = 'lazy'
+        self._log('build_index', fields or idx_name, _type)
+
+    def _compute_index(self, idx_name):
+        """Return the index values computed from the data, and whether a list
+        has been found.
+        """
         indexes = {}
-        has_non_string_values = False
+        has_lists = False
         for key, item in self.data.items():
-            if idx_name in item:
-                value = item[idx_name]
-                # A non-string index value switches it into a lazy one.
-                if not isinstance(value, six.string_types):
-                    has_non_string_values = True
+            values, multi = self._index_values(idx_name, item)
+            has_lists = has_lists or multi
+            for value in values:
                 if value not in indexes:
                     indexes[value] = set([])
                 indexes[value].add(key)
-        self.indexes[idx_name] = indexes
-        if self._meta.lazy_indexes or has_non_string_values:
-            # Every index is lazy
-            _type = 'lazy'
-        self.index_defs[idx_name] = {'type': _type}
+        return indexes, has_lists
 
     @autocommit
     def remove_index(self, idx_name):
         "Remove an index from the database."
+        idx_name = index_name(idx_name)
         if idx_name in self.indexes:
+            self._remember_index(idx_name)
             del self.indexes[idx_name]
+            self.index_defs.pop(idx_name, None)
+            self._sorted_keys.pop(idx_name, None)
+            self._log('remove_index', idx_name)
+
+    def verify_indexes(self):
+        """
+        Check that the indexes are consistent with the data.
+
+        Return the list of the problems found, empty if everything is fine.
+        """
+        errors = []
+        for idx_name, index in self.indexes.items():
+            expected = self._compute_index(idx_name)[0]
+            for value in set(index) | set(expected):
+                keys = index.get(value, set([]))
+                expected_keys = expected.get(value, set([]))
+                if value in index and not keys:
+                    errors.append('{}: empty bucket for {!r}'.format(
+                        idx_name, value))
+                for key in sorted(expected_keys - keys):
+                    errors.append('{}: {!r} missing for {!r}'.format(
+                        idx_name, key, value))
+                for key in sorted(keys - expected_keys):
+                    errors.append('{}: {!r} should not be indexed for '
+                                  '{!r}'.format(idx_name, key, value))
+            if idx_name in self._sorted_keys:
+                if self._sorted_keys[idx_name] != sorted_keys(expected):
+                    errors.append('{}: sorted values mismatch'.format(
+                        idx_name))
+        return errors
 
     def _clean_index(self):
         "Clean index values after loading."
-        for idx_name, idx_def in self.index_defs.items():
-            if idx_def['type'] == 'lazy':
-                self.build_index(idx_name)
-        for index_name, values in self.indexes.items():
+        for idx_name, idx_def in list(self.index_defs.items()):
+            if idx_def['type'] in UNSTORED_INDEX_TYPES:
+                self.build_index(
+                    idx_def.get('fields', idx_name), idx_def['type'])
+        for idx_name, values in self.indexes.items():
+            if 'fields' in self.index_defs[idx_name]:
+                if values and not isinstance(next(iter(values)), tuple):
+                    # Stored compound values are encoded
+                    loads = self._file_codec.loads
+                    self.indexes[idx_name] = values = dict(
+                        (tuple(loads(value)), keys)
+                        for value, keys in values.items())
             for value in values:
                 if not isinstance(values[value], set):
                     values[value] = set(values[value])
@@ -3,3 +3,7 @@
 
 class BadValueError(Exception):
     pass
+
+
+class CorruptedDatabaseError(Exception):
+    pass
@@ -0,0 +1,287 @@
+#-*- coding: utf-8 -*-
+"""
+Lazy-open mode: records are decoded on demand, from a memory-mapped file.
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+import codecs
+import json
+import mmap
+import re
+
+try:
+    from collections.abc import ItemsView, MutableMapping
+except ImportError:  # Python 2
+    from collections import ItemsView, MutableMapping
+
+#: Default number of decoded records kept in the cache.
+CACHE_SIZE = 1000
+
+#: Number of bytes decoded at first to find the end of a nested value.
+WINDOW_SIZE = 512
+# The patterns below are "unrolled loops", that can't backtrack much.
+SPACE = br'[ \t\n\r]*'
+# Anything but strings, lists and objects
+PLAIN = br'[^"\[\]{}]*'
+STRING_CONTENT = br'[^"\\]*(?:\\.[^"\\]*)*'
+STRING = br'"' + STRING_CONTENT + br'"'
+# Numbers, true, false and null
+SCALAR = br'[^"{}\[\], \t\n\r][^"{}\[\],]*'
+FLAT_LIST = br'\[' + PLAIN + br'(?:' + STRING + PLAIN + br')*\]'
+FLAT_OBJECT = (
+    br'\{' + PLAIN + br'(?:(?:' + STRING + br'|' + FLAT_LIST + br')' +
+    PLAIN + br')*\}')
+# An object nesting flat lists and objects, e.g. most records
+RECORD = (
+    br'\{' + PLAIN + br'(?:(?:' + STRING + br'|' + FLAT_LIST + br'|' +
+    FLAT_OBJECT + br')' + PLAIN + br')*\}')
+
+KEY = re.compile(
+    SPACE + br'"(' + STRING_CONTENT + br')"' + SPACE + br':' + SPACE)
+# An object member, followed by a comma or the end of the object
+MEMBER = re.compile(
+    SPACE + br'"(' + STRING_CONTENT + br')"' + SPACE + br':' + SPACE +
+    br'(' + STRING + br'|' + RECORD + br'|' + FLAT_LIST + br'|' + SCALAR +
+    br')' + SPACE + br'([,}])')
+CHAR = re.compile(SPACE + br'([^ \t\n\r]?)')
+
+DECODER = json.JSONDecoder()
+
+
+def decode_key(raw):
+    "Decode the content of a JSON string, as found in the file."
+    if b'\\' in raw:
+        return json.loads('"{}"'.format(raw.decode('utf-8')))
+    return raw.decode('utf-8')
+
+
+def expect(buf, pos, chars):
+    """Check that the next non-blank character is one of `chars`. Return it,
+    and the position after it."""
+    match = CHAR.match(buf, pos)
+    char = match.group(1)
+    if not char or char not in chars:
+        raise ValueError('Expecting one of {!r} at {}'.format(chars, pos))
+    return char, match.end()
+
+
+def decode_value(buf, pos):
+    """Decode the JSON value starting at `pos`. Return it, and the position
+    of its end."""
+    pos = CHAR.match(buf, pos).start(1)
+    size = WINDOW_SIZE
+    while True:
+        # A multi-byte character may be cut at the end of the window
+        text = codecs.getincrementaldecoder('utf-8')().decode(
+            buf[pos:pos + size])
+        more = pos + size < len(buf)
+        try:
+            value, end = DECODER.scan_once(text, 0)
+        except (StopIteration, ValueError):
+            if not more:
+                raise ValueError('Invalid value at {}'.format(pos))
+        else:
+            # A number may go on after the window
+            if end < len(text) or not more:
+                return value, pos + len(text[:end].encode('utf-8'))
+        size *= 2
+
+
+def scan_object(buf, pos, offsets):
+    """
+    Scan the JSON object starting at `pos`, without decoding its values
+    (unless they're too nested for the fast path).
+
+    The (start, end) positions of its values are stored by key in `offsets`.
+    Return the position after the object.
+    """
+    char, pos = expect(buf, pos, b'{')
+    match = CHAR.match(buf, pos)
+    if match.group(1) == b'}':
+        return match.end()
+    member = MEMBER.match
+    while True:
+        match = member(buf, pos)
+        if match is not None:
+            # Fast path: one regular expression match
+            start, end = match.span(2)
+            char, pos = match.group(3), match.end()
+        else:
+            # The value is too nested for the fast path
+            match = KEY.match(buf, pos)
+            if match is None:
+                raise ValueError('Expecting a key at {}'.format(pos))
+            start = CHAR.match(buf, match.end()).start(1)
+            end = decode_value(buf, start)[1]
+            char, pos = expect(buf, end, b',}')
+        offsets[decode_key(match.group(1))] = (start, end)
+        if char == b'}':
+            return pos
+
+
+def scan(buf):
+    """
+    Scan a DB document without decoding its records.
+
+    Return the offsets of the records, as a {key: (start, end)} dict, and the
+    other sections of the document (decoded).
+    """
+    offsets = {}
+    sections = {}
+    char, pos = expect(buf, 0, b'{')
+    if CHAR.match(buf, pos).group(1) == b'}':
+        char, pos = expect(buf, pos, b'}')
+    while char != b'}':
+        match = KEY.match(buf, pos)
+        if match is None:
+            raise ValueError('Expecting a key at {}'.format(pos))
+        name = decode_key(match.group(1))
+        if name == 'data':
+            end = scan_object(buf, match.end(), offsets)
+        else:
+            sections[name], end = decode_value(buf, match.end())
+        char, pos = expect(buf, end, b',}')
+    if CHAR.match(buf, pos).group(1):
+        raise ValueError('Extra data after the document')
+    return offsets, sections
+
+
+def open_mapping(path):
+    "Return a read-only memory map of the file, or None if it's empty."
+    with open(path, 'rb') as fd:
+        fd.seek(0, 2)
+        if not fd.tell():
+            return None
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_slice(buf, position):
+    "Return the encoded record found at `position`, a (start, end) pair."
+    start, end = position
+    return buf[start:end]
+
+
+class LazyItemsView(ItemsView):
+    "The items of a ``LazyData``, iterated without filling its cache."
+    def __iter__(self):
+        return self._mapping.iteritems()
+
+
+class LazyData(MutableMapping):
+    """
+    The records of a DB file, decoded on demand.
+
+    Only the positions of the records in the (memory-mapped) file are kept,
+    the most recently used records are kept decoded in a bounded cache.
+    Written records are kept in an overlay, until the DB is written again.
+
+    ``read(buf, position)`` returns the encoded record found at a position,
+    and ``decode(encoded)`` decodes it.
+    """
+    def __init__(self, buf, offsets, decode, cache_size=CACHE_SIZE,
+                 read=read_slice):
+        self._buf = buf
+        self._offsets = offsets
+        self._decode_record = decode
+        self._read = read
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        # Records written, and deleted, since the file has been written
+        self._overlay = {}
+        self._deleted = set()
+
+    def _decode(self, key):
+        return self._decode_record(self._read(self._buf, self._offsets[key]))
+
+    def __getitem__(self, key):
+        if key in self._overlay:
+            return self._overlay[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        cache = self._cache
+        if key in cache:
+            value = cache.pop(key)
+        else:
+            value = self._decode(key)
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        cache[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._overlay[key] = value
+        self._cache.pop(key, None)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._overlay.pop(key, None)
+        self._cache.pop(key, None)
+        if key in self._offsets:
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self._overlay or (
+            key in self._offsets and key not in self._deleted)
+
+    def __iter__(self):
+        overlay, deleted = self._overlay, self._deleted
+        for key in self._offsets:
+            if key not in deleted and key not in overlay:
+                yield key
+        for key in list(overlay):
+            yield key
+
+    def __len__(self):
+        offsets = self._offsets
+        added = sum(1 for key in self._overlay if key not in offsets)
+        return len(offsets) - len(self._deleted) + added
+
+    def iteritems(self):
+        "Iterate over the (key, value) pairs, without filling the cache."
+        overlay, deleted, cache = self._overlay, self._deleted, self._cache
+        for key in list(self._offsets):
+            if key in deleted or key in overlay:
+                continue
+            if key in cache:
+                yield key, cache[key]
+            else:
+                yield key, self._decode(key)
+        for item in list(overlay.items()):
+            yield item
+
+    def items(self):
+        return LazyItemsView(self)
+
+    def pending(self):
+        "Return a copy of the records written since the file was written."
+        return dict(self._overlay)
+
+    def reopen(self, buf, offsets, written, read=read_slice, decode=None):
+        """
+        Switch to a new version of the file (whose records are decoded by
+        `decode`, if it's set).
+
+        `written` are the pending records (see ``pending()``) found in it,
+        they're dropped from the overlay unless they've been written again.
+        """
+        self.close()
+        self._buf = buf
+        self._offsets = offsets
+        self._read = read
+        if decode is not None:
+            self._decode_record = decode
+        overlay = self._overlay
+        for key, value in written.items():
+            if overlay.get(key) is value:
+                del overlay[key]
+        # Records deleted since the snapshot was taken are still in the file
+        self._deleted = set(
+            key for key in self._deleted if key in offsets)
+
+    def close(self):
+        "Close the memory map of the file."
+        if self._buf is not None:
+            self._buf.close()
+            self._buf = None
@@ -0,0 +1,180 @@
+#-*- coding: utf-8 -*-
+"""
+Filter lookups, e.g. ``db.filter(score__gt=10)``.
+"""
+from __future__ import unicode_literals
+from bisect import bisect_left, bisect_right
+from numbers import Number
+
+import six
+
+LOOKUP_SEP = '__'
+
+#: Separator of the keys in the path of a nested field, e.g. ``user.country``.
+PATH_SEP = '.'
+
+#: Marks a value missing from a record.
+MISSING = object()
+
+
+def resolve(record, field):
+    """
+    Return the value of the field in the record, or ``MISSING``.
+
+    The field may be the path of a nested field, e.g. ``user.country``.
+    """
+    if field in record:
+        return record[field]
+    if PATH_SEP not in field:
+        return MISSING
+    value = record
+    for key in field.split(PATH_SEP):
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+def is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def indexable_values(value):
+    """
+    Return the list of index values for a field value.
+
+    Each (hashable) element of a list is indexed separately.
+    """
+    if value is MISSING:
+        return []
+    if isinstance(value, list):
+        values = []
+        for item in value:
+            if is_hashable(item) and item not in values:
+                values.append(item)
+        return values
+    if is_hashable(value):
+        return [value]
+    return []
+
+
+def sort_key(value):
+    """
+    Return the key used to order `value` in a sorted index, or None if the
+    value can't be ordered.
+
+    Values are grouped by type (None, numbers, strings), so that values of
+    different types can be stored in the same sorted index. Booleans are
+    numbers, like in Python: ``True`` and ``1`` share an index bucket.
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, Number):
+        return (2, value)
+    if isinstance(value, six.string_types):
+        return (3, value)
+
+
+def sorted_keys(values):
+    "Return the sorted list of the keys of the values that can be ordered."
+    return sorted(key for key in map(sort_key, values) if key is not None)
+
+
+def comparable(value, other):
+    "Return True if `value` and `other` can be compared."
+    key, other_key = sort_key(value), sort_key(other)
+    return key is not None and other_key is not None \
+        and key[0] == other_key[0]
+
+
+def between(value, bounds):
+    low, high = bounds
+    return comparable(value, low) and comparable(value, high) \
+        and low <= value <= high
+
+
+def startswith(value, prefix):
+    return isinstance(value, six.string_types) and value.startswith(prefix)
+
+
+def contains(value, item):
+    if isinstance(value, list):
+        return item in value
+    return isinstance(value, six.string_types) and \
+        isinstance(item, six.string_types) and item in value
+
+
+LOOKUPS = {
+    'exact': lambda value, other: value == other,
+    'gt': lambda value, other: comparable(value, other) and value > other,
+    'gte': lambda value, other: comparable(value, other) and value >= other,
+    'lt': lambda value, other: comparable(value, other) and value < other,
+    'lte': lambda value, other: comparable(value, other) and value <= other,
+    'between': between,
+    'startswith': startswith,
+    'in': lambda value, values: value in values,
+    'contains': contains,
+}
+
+#: Lookups that can be served by a binary search in a sorted index.
+RANGE_LOOKUPS = ('gt', 'gte', 'lt', 'lte', 'between', 'startswith')
+
+
+def parse_lookup(name):
+    """
+    Split a filter argument name into a (field, lookup) pair.
+
+    >>> parse_lookup('score__gt')
+    ('score', 'gt')
+    >>> parse_lookup('score')
+    ('score', 'exact')
+    """
+    field, sep, lookup = name.rpartition(LOOKUP_SEP)
+    if field and lookup in LOOKUPS:
+        return field, lookup
+    return name, 'exact'
+
+
+def sorted_range(sorted_keys, lookup, argument):
+    """
+    Return the values of the sorted keys of an index matching the lookup.
+
+    `sorted_keys` is a sorted list of ``sort_key()`` values. The matching
+    values are found with a binary search.
+    """
+    if lookup == 'between':
+        low, high = sort_key(argument[0]), sort_key(argument[1])
+        if low is None or high is None or low[0] != high[0]:
+            return []
+        start = bisect_left(sorted_keys, low)
+        end = bisect_right(sorted_keys, high)
+    elif lookup == 'startswith':
+        if not isinstance(argument, six.string_types):
+            return []
+        start = bisect_left(sorted_keys, (3, argument))
+        end = start
+        while end < len(sorted_keys) and \
+                sorted_keys[end][1].startswith(argument):
+            end += 1
+    else:
+        key = sort_key(argument)
+        if key is None:
+            return []
+        # Bounds of the values of the same type
+        type_start = bisect_left(sorted_keys, (key[0],))
+        type_end = bisect_left(sorted_keys, (key[0] + 1,))
+        if lookup == 'gt':
+            start, end = bisect_right(sorted_keys, key), type_end
+        elif lookup == 'gte':
+            start, end = bisect_left(sorted_keys, key), type_end
+        elif lookup == 'lt':
+            start, end = type_start, bisect_left(sorted_keys, key)
+        elif lookup == 'lte':
+            start, end = type_start, bisect_right(sorted_keys, key)
+        else:
+            raise ValueError('Unsupported range lookup: {}'.format(lookup))
+    return [value for _, value in sorted_keys[start:end]]
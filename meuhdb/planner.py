@@ -0,0 +1,191 @@
+#-*- coding: utf-8 -*-
+"""
+Query planner for ``MeuhDb.filter_keys()``.
+"""
+from __future__ import unicode_literals
+
+import six
+
+from .lookups import LOOKUPS, MISSING, is_hashable, parse_lookup, resolve
+
+
+class Criterion(object):
+    "A filter argument, e.g. ``score__gt=10``."
+    def __init__(self, name, value):
+        self.name = name
+        self.field, self.lookup = parse_lookup(name)
+        self.value = value
+        self.predicate = LOOKUPS[self.lookup]
+
+    def match(self, record):
+        "Return True if the record matches the criterion."
+        value = resolve(record, self.field)
+        return value is not MISSING and self.predicate(value, self.value)
+
+    @property
+    def indexable(self):
+        "Return True if the criterion can be served by an index."
+        # Lists and dicts aren't index values
+        return self.lookup != 'exact' or is_hashable(self.value)
+
+
+class IndexStep(object):
+    "Criteria served by an index."
+    def __init__(self, index, criteria, keys):
+        self.index = index
+        self.criteria = criteria
+        # May be an index bucket, must not be modified
+        self.keys = keys
+        self.estimated = len(keys)
+        self.actual = None
+
+    def explain(self):
+        return {
+            'index': self.index,
+            'criteria': [criterion.name for criterion in self.criteria],
+            'estimated': self.estimated,
+            'actual': self.actual,
+        }
+
+
+class QueryPlan(object):
+    """
+    The plan of a query.
+
+    Criteria that can be served by an index are evaluated first, starting with
+    the most selective index (the one giving the fewest keys). The other
+    criteria are then checked in a single pass over the remaining records, or
+    over the whole DB if no index could be used.
+    """
+    def __init__(self, db, criteria):
+        self.db = db
+        self.index_steps = []
+        self.scan_criteria = []
+        criteria = [Criterion(name, value) for name, value in criteria.items()]
+        criteria = self.plan_compound_indexes(criteria)
+        for criterion in criteria:
+            index_def = db.index_defs.get(criterion.field)
+            if criterion.field in db.indexes and 'fields' not in index_def \
+                    and criterion.indexable:
+                keys = db._index_keys(
+                    criterion.field, criterion.value, criterion.lookup)
+                self.index_steps.append(
+                    IndexStep(criterion.field, [criterion], keys))
+                if index_def.get('multi'):
+                    # The index gives the records having *an element* of a
+                    # list matching, the criterion has to be checked.
+                    self.scan_criteria.append(criterion)
+            else:
+                self.scan_criteria.append(criterion)
+        self.index_steps.sort(key=lambda step: step.estimated)
+        self.full_scan = not self.index_steps
+        self.scanned = None
+        self.result = None
+
+    def plan_compound_indexes(self, criteria):
+        """
+        Use the compound indexes whose fields are all filtered with an exact
+        lookup, the largest ones first. Return the remaining criteria.
+        """
+        db = self.db
+        exact = dict(
+            (criterion.field, criterion) for criterion in criteria
+            if criterion.lookup == 'exact' and criterion.indexable)
+        compound = [
+            (idx_def['fields'], idx_name)
+            for idx_name, idx_def in db.index_defs.items()
+            if 'fields' in idx_def and idx_name in db.indexes]
+        compound.sort(key=lambda item: (-len(item[0]), item[1]))
+        used_fields = set()
+        used_criteria = []
+        for fields, idx_name in compound:
+            if not all(field in exact and field not in used_fields
+                       for field in fields):
+                continue
+            step_criteria = [exact[field] for field in fields]
+            value = tuple(criterion.value for criterion in step_criteria)
+            keys = db._index_keys(idx_name, value)
+            self.index_steps.append(IndexStep(idx_name, step_criteria, keys))
+            used_fields.update(fields)
+            if not db.index_defs[idx_name].get('multi'):
+                used_criteria.extend(step_criteria)
+        return [
+            criterion for criterion in criteria
+            if criterion not in used_criteria]
+
+    @property
+    def estimated(self):
+        "Return the estimated number of matching records."
+        if self.index_steps:
+            return self.index_steps[0].estimated
+        return len(self.db.data)
+
+    def execute(self):
+        "Return the set of keys matching the criteria."
+        keys = None
+        for step in self.index_steps:
+            if keys is None:
+                keys = set(step.keys)
+            elif keys:
+                keys.intersection_update(step.keys)
+            step.actual = len(keys)
+            # Don't keep the keys around, the plan may be kept
+            step.keys = None
+        if self.scan_criteria:
+            data = self.db.data
+            if keys is None:
+                items = six.iteritems(data)
+                self.scanned = len(data)
+            else:
+                items = ((k, data[k]) for k in keys if k in data)
+                self.scanned = len(keys)
+            criteria = self.scan_criteria
+            keys = set([
+                k for k, v in items
+                if all(criterion.match(v) for criterion in criteria)
+            ])
+        elif keys is None:
+            keys = set(self.db.data)
+        self.result = len(keys)
+        return keys
+
+    def matches(self, key):
+        "Return True if the record stored at `key` matches the criteria."
+        data = self.db.data
+        if key not in data:
+            return False
+        for step in self.index_steps:
+            if key not in step.keys:
+                return False
+        if self.scan_criteria:
+            record = data[key]
+            return all(criterion.match(record)
+                       for criterion in self.scan_criteria)
+        return True
+
+    def iterkeys(self):
+        """
+        Iterate over the keys matching the criteria, without building the set
+        of them: the keys of the most selective index step (or of the whole
+        DB) are checked one by one.
+
+        The DB must not be modified during the iteration.
+        """
+        if self.index_steps:
+            keys = self.index_steps[0].keys
+        else:
+            keys = self.db.data
+        for key in keys:
+            if self.matches(key):
+                yield key
+
+    def explain(self):
+        "Return a description of the plan, and of its execution."
+        return {
+            'steps': [step.explain() for step in self.index_steps],
+            'scan': [criterion.name for criterion in self.scan_criteria],
+            'full_scan': self.full_scan,
+            'scanned': self.scanned,
+            'estimated': self.estimated,
+            'actual': self.result,
+        }
@@ -0,0 +1,144 @@
+#-*- coding: utf-8 -*-
+"""
+Commit policies: when the write operations are committed to the storage.
+"""
+from __future__ import unicode_literals
+import time
+
+#: A clock that never goes backwards (if available).
+clock = getattr(time, 'monotonic', time.time)
+
+
+class CommitPolicy(object):
+    """
+    Decides when the DB is committed, after write operations.
+
+    ``written()`` is called after each write operation (a batch counts as
+    one), ``committed()`` after each commit. A DB using a policy whose
+    ``deadline()`` can be set runs a timer, committing the pending writes at
+    the deadline even if no write operation comes after them.
+
+    A DB works on its own copy of the policy it's given.
+    """
+    #: True if the policy has a deadline, and needs a timer.
+    timed = False
+    #: True if the policy needs the size of the written records.
+    measures_size = False
+
+    def measured(self, size):
+        "Account for `size` bytes of written records."
+
+    def written(self, writes=1):
+        "Account for `writes` write operations. Return True to commit now."
+        return False
+
+    def committed(self):
+        "Called after a commit: there's nothing pending anymore."
+
+    def deadline(self):
+        "Return the time (see ``clock()``) of the next commit, or None."
+        return None
+
+
+class EveryWrite(CommitPolicy):
+    "Commit after every write operation (the ``autocommit`` option)."
+    def written(self, writes=1):
+        return True
+
+
+class EveryNWrites(CommitPolicy):
+    "Commit every `writes` write operations (the ``autocommit_after`` option)."
+    def __init__(self, writes):
+        self.writes = int(writes)
+        self.counter = self.writes
+
+    def written(self, writes=1):
+        self.counter -= writes
+        if self.counter > 0:
+            return False
+        # Reset, even if the DB isn't stored (and never committed)
+        self.counter = self.writes
+        return True
+
+    def committed(self):
+        self.counter = self.writes
+
+
+class Interval(CommitPolicy):
+    """Commit at most every `seconds` seconds. Writes made in between are
+    committed by the timer."""
+    timed = True
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.last_commit = None
+        self.pending = False
+
+    def written(self, writes=1):
+        self.pending = True
+        return self.last_commit is None or \
+            clock() >= self.last_commit + self.seconds
+
+    def committed(self):
+        self.last_commit = clock()
+        self.pending = False
+
+    def deadline(self):
+        if self.pending and self.last_commit is not None:
+            return self.last_commit + self.seconds
+
+
+class WritesOrInterval(CommitPolicy):
+    """Commit after `writes` write operations, or `seconds` seconds after the
+    first write that's not committed yet, whichever comes first."""
+    timed = True
+
+    def __init__(self, writes, seconds):
+        self.writes = int(writes)
+        self.seconds = seconds
+        self.counter = 0
+        self.first_write = None
+
+    def written(self, writes=1):
+        if self.first_write is None:
+            self.first_write = clock()
+        self.counter += writes
+        return self.counter >= self.writes
+
+    def committed(self):
+        self.counter = 0
+        self.first_write = None
+
+    def deadline(self):
+        if self.first_write is not None:
+            return self.first_write + self.seconds
+
+
+class PendingSize(CommitPolicy):
+    """Commit when the written records that are not committed yet weigh more
+    than `size` bytes, once serialized. If `seconds` is set, they're committed
+    at most `seconds` seconds after the first one anyway."""
+    measures_size = True
+
+    def __init__(self, size, seconds=None):
+        self.size = int(size)
+        self.seconds = seconds
+        self.timed = seconds is not None
+        self.pending_size = 0
+        self.first_write = None
+
+    def measured(self, size):
+        self.pending_size += size
+
+    def written(self, writes=1):
+        if self.first_write is None:
+            self.first_write = clock()
+        return self.pending_size >= self.size
+
+    def committed(self):
+        self.pending_size = 0
+        self.first_write = None
+
+    def deadline(self):
+        if self.seconds is not None and self.first_write is not None:
+            return self.first_write + self.seconds
@@ -0,0 +1,165 @@
+#-*- coding: utf-8 -*-
+"""
+Lazy queries, returned by ``MeuhDb.query()``.
+"""
+from __future__ import unicode_literals
+from copy import copy
+import heapq
+from itertools import islice
+
+from .lookups import resolve, sort_key
+from .planner import QueryPlan
+
+
+class Query(object):
+    """
+    A query over the records matching some criteria (the arguments of
+    ``MeuhDb.filter_keys()``).
+
+    Nothing is computed until the query is iterated over: the matching keys
+    are streamed, and the records are only read for the page that's
+    returned. ``order_by()``, ``limit()`` and ``offset()`` return new queries,
+    so they can be chained.
+
+    The DB must not be modified while a query is iterated over.
+    """
+    def __init__(self, db, criteria=None):
+        self.db = db
+        self.criteria = dict(criteria or {})
+        self.ordering = None
+        self.descending = False
+        self.start = 0
+        self.stop = None
+
+    def _clone(self, **attrs):
+        query = copy(self)
+        query.criteria = dict(self.criteria)
+        for name, value in attrs.items():
+            setattr(query, name, value)
+        return query
+
+    def filter(self, **kwargs):
+        "Return the query, restricted to the records matching the arguments."
+        criteria = dict(self.criteria)
+        criteria.update(kwargs)
+        return self._clone(criteria=criteria)
+
+    def order_by(self, field):
+        """Return the query, ordered by `field` (descending if it starts with
+        ``-``). Records without an orderable value come last."""
+        descending = field.startswith('-')
+        return self._clone(
+            ordering=field.lstrip('-'), descending=descending)
+
+    def offset(self, count):
+        "Return the query, skipping its first `count` records."
+        count = int(count)
+        if count < 0:
+            raise ValueError('The offset must be positive')
+        stop = self.stop
+        if stop is not None:
+            stop = max(stop, self.start + count)
+        return self._clone(start=self.start + count, stop=stop)
+
+    def limit(self, count):
+        "Return the query, returning at most `count` records."
+        count = int(count)
+        if count < 0:
+            raise ValueError('The limit must be positive')
+        stop = self.start + count
+        if self.stop is not None:
+            stop = min(stop, self.stop)
+        return self._clone(stop=stop)
+
+    def _plan(self):
+        return QueryPlan(self.db, self.criteria)
+
+    def _sort_key(self, key):
+        "Return the key ordering the record stored at `key`."
+        value = sort_key(resolve(self.db.data[key], self.ordering))
+        if value is None:
+            # Last, in both orders
+            return (1,) if not self.descending else (-1,)
+        return (0, value, key)
+
+    def _use_sorted_index(self, plan):
+        """Return True if the sorted index of the ordering field should be
+        walked, instead of sorting the matching records."""
+        db = self.db
+        field = self.ordering
+        if field not in db._sorted_keys or field not in db.indexes:
+            return False
+        index_def = db.index_defs[field]
+        if index_def.get('multi') or 'fields' in index_def:
+            # A record may be in several buckets
+            return False
+        if self.stop is None:
+            # Everything is ordered, the index saves sorting the records
+            return not plan.index_steps
+        # Walking the index finds the page after about
+        # `stop * len(data) / matches` keys, sorting reads every match.
+        return self.stop * len(db.data) <= plan.estimated ** 2
+
+    def _index_order(self, plan):
+        "Iterate over the matching keys, walking the sorted index."
+        db = self.db
+        index = db.indexes[self.ordering]
+        values = db._sorted_keys[self.ordering]
+        if self.descending:
+            values = reversed(values)
+        for rank, value in values:
+            # None is stored as (0, 0)
+            bucket = index.get(None if rank == 0 else value, ())
+            for key in sorted(bucket, reverse=self.descending):
+                if plan.matches(key):
+                    yield key
+        # The records without an orderable value aren't in the sorted index
+        data = db.data
+        for key in plan.iterkeys():
+            if sort_key(resolve(data[key], self.ordering)) is None:
+                yield key
+
+    def _ordered_keys(self, plan):
+        "Iterate over the matching keys, in order."
+        if self.ordering is None:
+            return plan.iterkeys()
+        if self._use_sorted_index(plan):
+            return self._index_order(plan)
+        keys = plan.iterkeys()
+        if self.stop is not None:
+            # Keep the top `stop` keys only, in a heap
+            select = heapq.nlargest if self.descending else heapq.nsmallest
+            return iter(select(self.stop, keys, key=self._sort_key))
+        return iter(sorted(keys, key=self._sort_key, reverse=self.descending))
+
+    def keys(self):
+        "Iterate over the keys of the records returned by the query."
+        return islice(self._ordered_keys(self._plan()), self.start, self.stop)
+
+    def __iter__(self):
+        "Iterate over the (key, value) pairs returned by the query."
+        db = self.db
+        data = db.data
+        for key in self.keys():
+            yield key, db._read(data[key])
+
+    def count(self):
+        """Return the number of records returned by the query, without reading
+        them if an index can count them."""
+        plan = self._plan()
+        if len(plan.index_steps) == 1 and not plan.scan_criteria:
+            total = plan.estimated
+        elif not plan.index_steps and not plan.scan_criteria:
+            total = len(self.db.data)
+        else:
+            total = sum(1 for key in plan.iterkeys())
+        total = max(total - self.start, 0)
+        if self.stop is not None:
+            total = min(total, self.stop - self.start)
+        return total
+
+    def first(self):
+        "Return the first (key, value) pair returned by the query, or None."
+        for item in self.limit(1):
+            return item
+        return None
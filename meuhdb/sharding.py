@@ -0,0 +1,347 @@
+#-*- coding: utf-8 -*-
+"""
+Sharded database: the keys are hash-partitioned across several DB files,
+committed and loaded in parallel.
+"""
+from __future__ import unicode_literals
+import multiprocessing
+import os
+import zlib
+from uuid import uuid4
+
+from .core import MeuhDb
+from .lookups import sorted_keys
+from .policies import clock
+from . import binary
+
+#: Default number of shards.
+SHARDS = 8
+
+# The shards of the DB being committed, inherited by the forked workers
+_shards = None
+
+
+def shard_path(path, number):
+    "Return the path of the n-th shard file of the DB."
+    return '{}.shard{}'.format(path, number)
+
+
+def shard_number(key, shards):
+    "Return the number of the shard storing `key`."
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    # crc32() is stable, unlike hash() on strings
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+def _fork_pool(processes, shards=None):
+    """Return a pool of forked processes, inheriting the `shards`. Return None
+    if processes can't be forked on this platform."""
+    if hasattr(multiprocessing, 'get_context'):
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            return None
+    elif os.name == 'posix':  # Python 2
+        context = multiprocessing
+    else:
+        return None
+    return context.Pool(
+        processes, initializer=_init_worker, initargs=(shards,))
+
+
+def _init_worker(shards):
+    global _shards
+    _shards = shards
+
+
+def _write_shard(number):
+    "Write the whole n-th shard to its file. Return the size of the file."
+    shard = _shards[number]
+    size = shard._write_snapshot(shard._snapshot())
+    shard._remove_journal()
+    return size
+
+
+def _load_shard(args):
+    """Load a shard file. Return its content, whether it has to be written
+    (e.g. to be converted), and whether its journal has to be."""
+    path, options = args
+    shard = MeuhDb(path, **options)
+    return shard.raw, shard._dirty, shard._foreign_journal
+
+
+class ShardedMeuhDb(object):
+    """
+    A MeuhDb whose keys are hash-partitioned across several MeuhDb shards,
+    each one stored in its own file (``<path>.shard<n>``).
+
+    A commit only writes the shards modified since the last commit, and they
+    are written in parallel, by forked processes. The shard files are loaded
+    in parallel too.
+    """
+    def __init__(self, path=None, shards=SHARDS, processes=None, **options):
+        """
+        Options:
+
+        * ``path``: Path prefix of the shard files,
+        * ``shards``: The number of shards. It can't be changed once the DB
+          is stored,
+        * ``processes``: The number of processes committing and loading the
+          shards. Defaults to the number of CPUs, ``1`` disables the parallel
+          commits and loads.
+
+        The other options are the ones of ``MeuhDb``, except
+        ``background_commit``.
+        """
+        if options.get('background_commit'):
+            raise ValueError('Sharded DBs are committed in parallel, not in '
+                             'the background')
+        self.path = path
+        self.processes = processes or multiprocessing.cpu_count()
+        self.options = options
+        self.shards = self._load(int(shards))
+
+    def _paths(self, shards):
+        if self.path is None:
+            return [None] * shards
+        return [shard_path(self.path, number) for number in range(shards)]
+
+    def _load(self, shards):
+        "Return the shards, loaded in parallel if possible."
+        paths = self._paths(shards)
+        existing = [path for path in paths if path and os.path.exists(path)]
+        # Lazy-loaded records can't be sent from a process to another
+        parallel = self.processes > 1 and len(existing) > 1 and not (
+            self.options.get('lazy_open') or any(
+                binary.is_binary(path) for path in existing))
+        pool = parallel and _fork_pool(self.processes)
+        if not pool:
+            return [MeuhDb(path, **self.options) for path in paths]
+        try:
+            contents = pool.map(
+                _load_shard, [(path, self.options) for path in existing])
+        finally:
+            pool.close()
+            pool.join()
+        contents = dict(zip(existing, contents))
+        return [self._shard(path, contents.get(path)) for path in paths]
+
+    def _shard(self, path, loaded):
+        """Return the shard stored at `path`, loaded by ``_load_shard()`` (or
+        loaded now if it's None)."""
+        if loaded is None:
+            return MeuhDb(path, **self.options)
+        raw, dirty, foreign_journal = loaded
+        shard = MeuhDb(**self.options)
+        shard._meta.path = path
+        shard.raw.update(raw)
+        shard._dirty = dirty
+        shard._foreign_journal = foreign_journal
+        for idx_name, index_def in shard.index_defs.items():
+            if index_def['type'] == 'sorted':
+                shard._sorted_keys[idx_name] = sorted_keys(
+                    shard.indexes[idx_name])
+        # Not started without a path, e.g. the commit timer
+        shard._start_commits()
+        return shard
+
+    def shard(self, key):
+        "Return the shard storing `key`."
+        return self.shards[shard_number(key, len(self.shards))]
+
+    def _group(self, items):
+        "Group the (key, value) pairs by shard number."
+        groups = {}
+        for key, value in items:
+            groups.setdefault(
+                shard_number(key, len(self.shards)), []).append((key, value))
+        return groups
+
+    def exists(self, key):
+        "Return True if key is in the keystore."
+        return self.shard(key).exists(key)
+
+    def get(self, key):
+        """
+        Return value of 'key' if it's in the database.
+        Raise KeyError if not.
+        """
+        return self.shard(key).get(key)
+
+    def set(self, key, value):
+        "Set value to the key store."
+        self.shard(key).set(key, value)
+
+    def insert(self, value):
+        "Insert value in the keystore. Return the UUID key."
+        key = str(uuid4())
+        self.set(key, value)
+        return key
+
+    def delete(self, key):
+        "Delete a `key` from the keystore."
+        self.shard(key).delete(key)
+
+    def update(self, key, value):
+        """Update a `key` in the keystore.
+        If the key is non-existent, it's being created
+        """
+        self.shard(key).update(key, value)
+
+    def del_key(self, key, key_to_delete):
+        "Delete the `key_to_delete` for the record found with `key`."
+        self.shard(key).del_key(key, key_to_delete)
+
+    def set_many(self, mapping):
+        """Set several values to the key store, from a dict or a list of
+        (key, value) pairs."""
+        items = mapping.items() if isinstance(mapping, dict) else mapping
+        for number, items in self._group(items).items():
+            self.shards[number].set_many(items)
+
+    def insert_many(self, values):
+        "Insert several values in the keystore. Return the list of UUID keys."
+        values = list(values)
+        keys = [str(uuid4()) for value in values]
+        self.set_many(list(zip(keys, values)))
+        return keys
+
+    def delete_many(self, keys):
+        "Delete several keys from the keystore."
+        keys = list(keys)
+        for key in keys:
+            if not self.exists(key):
+                raise KeyError(key)
+        groups = self._group((key, None) for key in keys)
+        for number, items in groups.items():
+            self.shards[number].delete_many(key for key, _ in items)
+
+    def all(self):
+        "Retrieve the data from the keystore, merged from all the shards."
+        data = {}
+        for shard in self.shards:
+            data.update(shard.all().items())
+        return data
+
+    def keys_to_values(self, keys):
+        "Return the items in the keystore with keys in `keys`."
+        values = {}
+        for shard in self.shards:
+            values.update(shard.keys_to_values(keys))
+        return values
+
+    def filter_keys(self, **kwargs):
+        "Return the set of keys matching the arguments, in all the shards."
+        keys = set()
+        for shard in self.shards:
+            keys.update(shard.filter_keys(**kwargs))
+        return keys
+
+    def filter(self, **kwargs):
+        "Filter data according to the given arguments, in all the shards."
+        values = {}
+        for shard in self.shards:
+            values.update(shard.filter(**kwargs))
+        return values
+
+    def create_index(self, name, recreate=False, _type='default'):
+        "Create an index, in every shard."
+        for shard in self.shards:
+            shard.create_index(name, recreate=recreate, _type=_type)
+
+    def remove_index(self, idx_name):
+        "Remove an index, from every shard."
+        for shard in self.shards:
+            shard.remove_index(idx_name)
+
+    def verify_indexes(self):
+        "Check the indexes of every shard. Return the problems found."
+        errors = []
+        for number, shard in enumerate(self.shards):
+            errors.extend(
+                'shard {}: {}'.format(number, error)
+                for error in shard.verify_indexes())
+        return errors
+
+    @property
+    def dirty_shards(self):
+        "Return the numbers of the shards modified since the last commit."
+        return set(
+            number for number, shard in enumerate(self.shards) if shard.dirty)
+
+    def commit(self):
+        """
+        Write the shards modified since the last commit.
+
+        They're written in parallel by forked processes, unless the journal
+        is enabled (appending to a journal is cheap).
+        """
+        if self.path is None:
+            return
+        dirty = sorted(self.dirty_shards)
+        parallel = self.processes > 1 and len(dirty) > 1 and \
+            not self.options.get('journal')
+        if parallel:
+            shards = [self.shards[number] for number in dirty]
+            locks = []
+            try:
+                # Neither modified nor committed by their timers until they're
+                # written, like in MeuhDb.commit()
+                for shard in shards:
+                    for lock in (shard._io_lock, shard._lock):
+                        lock.acquire()
+                        locks.append(lock)
+                if self._commit_parallel(dirty):
+                    return
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+        for number in dirty:
+            self.shards[number].commit()
+
+    def _commit_parallel(self, dirty):
+        """Write the `dirty` shards in parallel, their locks being held.
+        Return False if processes can't be forked."""
+        start = clock()
+        numbers = []
+        written = []
+        dirty_keys = []
+        for number in dirty:
+            shard = self.shards[number]
+            shard._meta.policy.committed()
+            keys = shard._take_dirty()
+            if keys is not None:
+                numbers.append(number)
+                written.append(shard._pending_records())
+                dirty_keys.append(keys)
+        shards = [self.shards[number] for number in numbers]
+        # Forked once the snapshots to write are settled
+        pool = _fork_pool(min(self.processes, len(dirty)), self.shards)
+        if not pool:
+            for shard, keys in zip(shards, dirty_keys):
+                shard._restore_dirty(keys)
+            return False
+        try:
+            sizes = pool.map(_write_shard, numbers)
+        except BaseException:
+            for shard, keys in zip(shards, dirty_keys):
+                shard._restore_dirty(keys)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        for shard, records, size in zip(shards, written, sizes):
+            shard._reopen(records)
+            shard._count_commit(size, start)
+        return True
+
+    def compact(self):
+        "Write every shard, and empty their journals."
+        for shard in self.shards:
+            shard.compact()
+
+    def close(self):
+        "Close the lazy-loaded shard files."
+        for shard in self.shards:
+            shard.close()
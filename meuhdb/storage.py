@@ -0,0 +1,109 @@
+#-*- coding: utf-8 -*-
+"""
+File storage helpers.
+"""
+from __future__ import unicode_literals
+import errno
+import os
+import shutil
+import stat
+from uuid import uuid4
+
+import six
+
+# ``os.replace`` is atomic on every platform, ``os.rename`` only on POSIX.
+replace = getattr(os, 'replace', os.rename)
+
+
+def to_bytes(value):
+    "Return the serialized `value` as bytes, ready to be written to a file."
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def generation_path(path, generation):
+    "Return the path of the n-th previous generation of the DB file."
+    return '{}.{}'.format(path, generation)
+
+
+def rotate_generations(path, generations):
+    """Keep the current DB file as the most recent generation, and shift the
+    older ones. Only the `generations` most recent ones are kept.
+    """
+    if not generations or not os.path.exists(path):
+        return
+    for generation in range(generations - 1, 0, -1):
+        older = generation_path(path, generation)
+        if os.path.exists(older):
+            replace(older, generation_path(path, generation + 1))
+    latest = generation_path(path, 1)
+    if os.path.exists(latest):
+        os.unlink(latest)
+    try:
+        # A hard link doesn't copy anything
+        os.link(path, latest)
+    except (AttributeError, OSError):
+        shutil.copy2(path, latest)
+
+
+def fsync_directory(path):
+    "Make sure a rename in the directory of `path` is durable."
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except (AttributeError, OSError):
+        # Not possible on every platform (e.g. Windows)
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def create_temporary(path):
+    """
+    Create a new file in the directory of `path`, opened for writing. Return
+    its descriptor and its path.
+
+    Unlike ``mkstemp()``, the file has the permissions ``open()`` would give
+    it: the kernel applies the umask.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        tmp_path = os.path.join(
+            dirname, '.{}.{}.tmp'.format(basename, uuid4().hex[:8]))
+        try:
+            return os.open(tmp_path, flags, 0o666), tmp_path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def atomic_write(path, write, generations=0):
+    """
+    Atomically replace the file at `path`.
+
+    `write` is called with a binary file object pointing to a temporary file
+    in the same directory. The file is synced to the disk, then renamed over
+    the old one, which means that a crash or an error while writing leaves
+    the old file untouched.
+    """
+    handle, tmp_path = create_temporary(path)
+    try:
+        with os.fdopen(handle, 'wb') as fd:
+            write(fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        # Keep the original permissions
+        if os.path.exists(path):
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        rotate_generations(path, generations)
+        replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    fsync_directory(path)
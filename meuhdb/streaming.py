@@ -0,0 +1,137 @@
+#-*- coding: utf-8 -*-
+"""
+Streaming loader: the DB file is parsed by chunks, record after record,
+instead of being read and decoded at once.
+"""
+from __future__ import unicode_literals
+import codecs
+import json
+import re
+
+import six
+
+#: Number of bytes read from the file at once.
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+SIMPLE_KEY = re.compile(r'[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*:')
+
+
+class StreamReader(object):
+    """
+    Read JSON values from a binary file, one after the other.
+
+    Only the part of the file that hasn't been decoded yet is kept in memory,
+    i.e. a chunk of the file, or a value being read if it's larger.
+    """
+    def __init__(self, fd, chunk_size=CHUNK_SIZE):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        # Share the keys of the objects, like a single ``json.loads()`` does
+        keys = {}
+        share = keys.setdefault
+        self.scan = json.JSONDecoder(object_pairs_hook=lambda pairs: dict([
+            (share(key, key), value) for key, value in pairs])).scan_once
+        self.buffer = ''
+        self.pos = 0
+
+    def _read(self, size=None):
+        "Read more of the file. Return False at the end of the file."
+        chunk = self.fd.read(size or self.chunk_size)
+        # Drop what's been read already
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(
+            chunk, final=not chunk)
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        "Return the next non-blank character, or '' at the end of the file."
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self._read():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        "Read the next character, which must be one of `chars`."
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expecting one of {!r}, got {!r}'.format(
+                chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        "Read a JSON value."
+        self.peek()
+        while True:
+            try:
+                value, end = self.scan(self.buffer, self.pos)
+            except (StopIteration, ValueError):
+                # The value may be incomplete: read at least as much again
+                if not self._read(
+                        max(len(self.buffer) - self.pos, self.chunk_size)):
+                    raise ValueError('Invalid value at the end of the file')
+                continue
+            # A number may go on in the next chunk
+            if end == len(self.buffer) and self._read():
+                continue
+            self.pos = end
+            return value
+
+    def key(self):
+        "Read the key of an object member, and the colon after it."
+        match = SIMPLE_KEY.match(self.buffer, self.pos)
+        if match is not None:
+            # Fast path, for keys without escaped characters
+            self.pos = match.end()
+            return match.group(1)
+        key = self.value()
+        if not isinstance(key, six.string_types):
+            raise ValueError('Expecting a string key, got {!r}'.format(key))
+        self.expect(':')
+        return key
+
+    def mapping(self, read_value=None):
+        """
+        Iterate over the (key, value) pairs of a JSON object.
+
+        Values are read by ``read_value(key)``, or as a whole by default.
+        """
+        read_value = read_value or (lambda key: self.value())
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.key()
+            yield key, read_value(key)
+            if self.expect(',}') == '}':
+                return
+
+
+def load(fd):
+    """
+    Load a DB document from the binary file `fd`, section by section.
+
+    Records are decoded one by one, and the keys of the index values are
+    turned into sets as they're read. Return None if the file is empty.
+    """
+    reader = StreamReader(fd)
+    if not reader.peek():
+        return None
+
+    def read_index(idx_name):
+        return dict((value, set(keys)) for value, keys in reader.mapping())
+
+    def read_section(name):
+        if name == 'data':
+            return dict(reader.mapping())
+        if name == 'indexes':
+            return dict(reader.mapping(read_index))
+        return reader.value()
+
+    document = dict(reader.mapping(read_section))
+    if reader.peek():
+        raise ValueError('Extra data after the document')
+    return document
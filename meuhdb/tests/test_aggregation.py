@@ -0,0 +1,137 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from unittest import skipIf
+
+from meuhdb import aggregation
+from meuhdb.tests import InMemoryDatabase
+
+
+class AggregationTest(InMemoryDatabase):
+
+    def setUp(self):
+        super(AggregationTest, self).setUp()
+        self.db.set('one', {'status': 'paid', 'amount': 10, 'country': 'fr'})
+        self.db.set('two', {'status': 'paid', 'amount': 2.5, 'country': 'fr'})
+        self.db.set('three', {'status': 'paid', 'amount': 'n/a'})
+        self.db.set('four', {'status': 'new', 'amount': 7, 'country': 'de'})
+        self.db.set('five', {'status': 'new', 'amount': True})
+        self.db.set('six', {'amount': 1})
+
+    def test_count(self):
+        self.assertEquals(self.db.aggregate(count=True), {'count': 6})
+        self.assertEquals(
+            self.db.aggregate(count=True, where={'status': 'paid'}),
+            {'count': 3})
+        expected = {'paid': {'count': 3}, 'new': {'count': 2}}
+        self.assertEquals(
+            self.db.aggregate(group_by='status', count=True), expected)
+        self.db.create_index('status')
+        self.db.create_index('country')
+        self.assertEquals(
+            self.db.aggregate(group_by='status', count=True), expected)
+        self.assertEquals(
+            self.db.aggregate(group_by='status', count=True,
+                              where={'country': 'fr'}),
+            {'paid': {'count': 2}})
+
+    def test_index_counts(self):
+        self.db.create_index('status')
+        # Counted from the index, no record is read
+        data, self.db.raw['data'] = self.db.data, None
+        try:
+            self.assertEquals(
+                self.db.aggregate(group_by='status', count=True),
+                {'paid': {'count': 3}, 'new': {'count': 2}})
+        finally:
+            self.db.raw['data'] = data
+
+    def test_aggregates(self):
+        self.assertEquals(
+            self.db.aggregate(count=True, sum='amount', min='amount',
+                              max='amount', avg='amount'),
+            {'count': 6, 'sum': 20.5, 'min': 1, 'max': 10, 'avg': 5.125})
+        self.assertEquals(
+            self.db.aggregate(group_by='status', sum='amount', max='amount',
+                              where={'amount__gt': 2}),
+            {'paid': {'sum': 12.5, 'max': 10}, 'new': {'sum': 7, 'max': 7}})
+        # Only numbers are aggregated
+        self.assertEquals(
+            self.db.aggregate(group_by='status', count=True, sum='amount',
+                              avg='amount', min='country'),
+            {'paid': {'count': 3, 'sum': 12.5, 'avg': 6.25, 'min': None},
+             'new': {'count': 2, 'sum': 7, 'avg': 7.0, 'min': None}})
+        self.assertEquals(
+            self.db.aggregate(sum='amount', avg='amount',
+                              where={'status': 'closed'}),
+            {'sum': 0, 'avg': None})
+
+    def test_lists(self):
+        self.db.set('seven', {'tags': ['a', 'b'], 'amount': 3})
+        self.db.set('eight', {'tags': ['b'], 'amount': 4})
+        expected = {'a': {'count': 1, 'sum': 3}, 'b': {'count': 2, 'sum': 7}}
+        self.assertEquals(
+            self.db.aggregate(group_by='tags', count=True, sum='amount'),
+            expected)
+        self.db.create_index('tags')
+        self.assertEquals(
+            self.db.aggregate(group_by='tags', count=True),
+            {'a': {'count': 1}, 'b': {'count': 2}})
+
+    def test_nothing(self):
+        with self.assertRaises(ValueError):
+            self.db.aggregate(group_by='status')
+
+
+@skipIf(aggregation.numpy is None, 'NumPy is not installed')
+class VectorizedAggregationTest(InMemoryDatabase):
+
+    def setUp(self):
+        super(VectorizedAggregationTest, self).setUp()
+        for x in range(100):
+            record = {'status': 'status-%d' % (x % 3), 'amount': x}
+            if x % 5:
+                record['price'] = x / 4.
+            self.db.set('%d' % x, record)
+        self.db.create_index('status')
+
+    def compare(self, **kwargs):
+        vectorized = self.db.aggregate(**kwargs)
+        numpy, aggregation.numpy = aggregation.numpy, None
+        try:
+            streamed = self.db.aggregate(**kwargs)
+        finally:
+            aggregation.numpy = numpy
+        self.assertEquals(vectorized, streamed)
+        return vectorized
+
+    def test_vectorized(self):
+        aggregates = {'count': True, 'sum': 'amount', 'min': 'price',
+                      'max': 'amount', 'avg': 'price'}
+        self.compare(**aggregates)
+        self.compare(group_by='status', **aggregates)
+        self.compare(where={'amount__lt': 50}, **aggregates)
+        result = self.compare(
+            group_by='status', where={'status': 'status-1'}, **aggregates)
+        self.assertEquals(list(result), ['status-1'])
+        self.assertIn(('group', 'status'), self.db._columns)
+        self.assertIn('price', self.db._columns)
+
+    def test_invalidated(self):
+        self.compare(sum='amount')
+        self.db.update('12', {'amount': 1000})
+        self.assertEquals(self.db._columns, {})
+        self.assertEquals(self.compare(sum='amount')['sum'], 5938)
+        with self.assertRaises(KeyError):
+            with self.db.transaction():
+                self.db.delete('12')
+                self.compare(sum='amount')
+                raise KeyError('12')
+        self.assertEquals(self.compare(sum='amount')['sum'], 5938)
+
+    def test_not_vectorized(self):
+        # Records in several groups, huge integers
+        self.db.set('100', {'status': ['a', 'b'], 'amount': 2 ** 60})
+        self.compare(group_by='status', count=True, sum='price')
+        self.assertIsNone(self.db._columns[('group', 'status')])
+        self.compare(count=True, sum='amount', avg='amount')
+        self.assertIsNone(self.db._columns['amount'])
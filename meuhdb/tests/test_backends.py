@@ -0,0 +1,237 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from io import BytesIO
+import json
+import logging
+from os import unlink
+from os.path import exists
+import pickle
+
+from meuhdb.backends import BACKENDS, Backend, FunctionsBackend
+from meuhdb.backends import HEAD_SIZE, detect, register_backend
+from meuhdb.binary import LENGTH
+from meuhdb.core import MeuhDb
+from meuhdb.exceptions import CorruptedDatabaseError
+from meuhdb.storage import to_bytes
+from meuhdb.tests import TempStorageDatabase
+
+logging.captureWarnings(True)
+
+BINARY_BACKENDS = [
+    name for name, backend in BACKENDS.items() if not backend.text]
+
+
+class BackendTest(TempStorageDatabase):
+
+    def test_registry(self):
+        self.assertIn('pickle', BINARY_BACKENDS)
+        self.assertIn('marshal', BINARY_BACKENDS)
+        self.assertTrue(BACKENDS['json'].text)
+        self.assertEquals(BACKENDS['pickle'].native_types,
+                          (set, tuple, bytes))
+
+    def test_register(self):
+        backend = FunctionsBackend(
+            'sorted-json',
+            lambda obj: json.dumps(obj, sort_keys=True), json.loads)
+        register_backend(backend)
+        try:
+            db = MeuhDb(self.filename, backend='sorted-json')
+            db.set('one', {'b': 1, 'a': 2})
+            db.commit()
+            with open(self.filename) as fd:
+                self.assertEquals(
+                    fd.read(), '{"data": {"one": {"a": 2, "b": 1}}, '
+                               '"index_defs": {}}')
+        finally:
+            del BACKENDS['sorted-json']
+
+    def test_records(self):
+        for name, backend in BACKENDS.items():
+            fd = BytesIO()
+            fd.write(backend.dump_record(['set', 'one', {'a': 1}]))
+            fd.write(backend.dump_record(['delete', 'one']))
+            fd.write(backend.dump_record(['delete', 'two'])[:-2])
+            fd.seek(0)
+            records = backend.load_records(fd)
+            self.assertEquals(next(records), ['set', 'one', {'a': 1}])
+            self.assertEquals(next(records), ['delete', 'one'])
+            with self.assertRaises(ValueError):
+                next(records)
+
+    def test_detect(self):
+        for name, backend in BACKENDS.items():
+            for obj in ({'data': {}}, ['set', 'one', {'a': 1}]):
+                head = to_bytes(backend.dumps(obj))[:HEAD_SIZE]
+                record = backend.dump_record(obj)[:HEAD_SIZE]
+                self.assertIs(detect(head, backend), backend)
+                self.assertIs(
+                    detect(record, backend, records=True), backend)
+                if backend.text:
+                    self.assertIs(detect(head, BACKENDS['pickle']).text, True)
+                elif backend.safe:
+                    self.assertIs(detect(head, BACKENDS['json']), backend)
+                    self.assertIs(detect(record, BACKENDS['json'],
+                                         records=True), backend)
+                else:
+                    # Decoding it could run code
+                    with self.assertRaises(ValueError):
+                        detect(head, BACKENDS['json'])
+                    with self.assertRaises(ValueError):
+                        detect(record, BACKENDS['json'], records=True)
+        # Unknown content: the given backend
+        self.assertIs(detect(b'', BACKENDS['pickle']), BACKENDS['pickle'])
+
+    def test_not_implemented(self):
+        with self.assertRaises(NotImplementedError):
+            Backend().dumps({})
+
+
+class BinaryBackendsTest(TempStorageDatabase):
+
+    def tearDown(self):
+        journal_path = self.db._meta.journal_path
+        if exists(journal_path):
+            unlink(journal_path)
+        super(BinaryBackendsTest, self).tearDown()
+
+    def empty(self):
+        with open(self.filename, 'w'):
+            pass
+
+    def fill(self, db):
+        db.set('one', {'name': 'Alice', 'score': 12, 'tags': ['a']})
+        db.set('two', {'name': 'Bob', 'score': 8, 'tags': ['a', 'b']})
+        db.create_index('name')
+        db.create_index('score', _type='sorted')
+        db.create_index('tags')
+        db.create_index(('name', 'score'))
+
+    def check(self, db):
+        self.assertEquals(dict(db.all().items()), {
+            'one': {'name': 'Alice', 'score': 12, 'tags': ['a']},
+            'two': {'name': 'Bob', 'score': 8, 'tags': ['a', 'b']},
+        })
+        self.assertEquals(db.verify_indexes(), [])
+        self.assertEquals(
+            db.indexes['name,score'],
+            {('Alice', 12): set(['one']), ('Bob', 8): set(['two'])})
+        self.assertEquals(db.filter_keys(score__gt=10), set(['one']))
+
+    def test_commit(self):
+        for backend in BINARY_BACKENDS:
+            for file_format in ('json', 'binary'):
+                self.empty()
+                db = MeuhDb(self.filename, backend=backend, format=file_format)
+                self.fill(db)
+                db.commit()
+                db = MeuhDb(self.filename, backend=backend)  # reload
+                self.check(db)
+                db.close()
+
+    def test_journal(self):
+        for backend in BINARY_BACKENDS:
+            self.empty()
+            db = MeuhDb(self.filename, backend=backend, journal=True)
+            self.fill(db)
+            db.commit()
+            db = MeuhDb(self.filename, backend=backend, journal=True)
+            self.check(db)
+            db.compact()
+            db = MeuhDb(self.filename, backend=backend, journal=True)
+            self.check(db)
+
+    def test_native_sets(self):
+        db = MeuhDb(self.filename, backend='pickle')
+        self.fill(db)
+        db.commit()
+        with open(self.filename, 'rb') as fd:
+            document = pickle.load(fd)
+        # Stored as they are
+        self.assertEquals(document['indexes']['name']['Alice'], set(['one']))
+        self.assertIn(('Alice', 12), document['indexes']['name,score'])
+
+    def test_switch_backend(self):
+        backends = ['json'] + BINARY_BACKENDS
+        for stored in backends:
+            for backend in backends:
+                for options in ({}, {'format': 'binary'},
+                                {'lazy_open': True}, {'compression': 'gzip'}):
+                    if options.get('lazy_open') and stored != 'json':
+                        continue
+                    self.empty()
+                    db = MeuhDb(self.filename, backend=stored, **options)
+                    self.fill(db)
+                    db.commit()
+                    db.close()
+                    if stored != backend and not BACKENDS[stored].safe:
+                        # Never detected
+                        with self.assertRaises(CorruptedDatabaseError):
+                            MeuhDb(self.filename, backend=backend, **options)
+                        continue
+                    # Detected, and converted on the next commit
+                    db = MeuhDb(self.filename, backend=backend, **options)
+                    self.check(db)
+                    self.assertEquals(db.dirty, stored != backend)
+                    db.commit()
+                    db.close()
+                    self.assertIs(db._stored_codec(self.filename),
+                                  BACKENDS[backend])
+                    db = MeuhDb(self.filename, backend=backend, **options)
+                    self.check(db)
+                    self.assertFalse(db.dirty)
+                    db.close()
+
+    def test_switch_journal_backend(self):
+        self.empty()
+        db = MeuhDb(self.filename, journal=True)
+        self.fill(db)
+        db.commit()
+        db = MeuhDb(self.filename, backend='pickle', journal=True)
+        self.check(db)
+        db.set('three', {'name': 'Carl'})
+        # The JSON journal is folded into the DB, not appended to
+        db.commit()
+        self.assertFalse(exists(db._meta.journal_path))
+        db.set('four', {'name': 'Dave'})
+        db.commit()
+        db = MeuhDb(self.filename, backend='pickle', journal=True)
+        self.assertEquals(db.get('three'), {'name': 'Carl'})
+        self.assertEquals(db.get('four'), {'name': 'Dave'})
+
+    def test_corrupted(self):
+        with open(self.filename, 'wb') as fd:
+            fd.write(b'\x80\x05garbage')
+        for backend in ['json'] + BINARY_BACKENDS:
+            with self.assertRaises(CorruptedDatabaseError):
+                MeuhDb(self.filename, backend=backend)
+
+    def unpickled(self):
+        "Return a pickle setting a flag when it's unpickled."
+        return b'\x80\x02cmeuhdb.tests.test_backends\nunpickle\nq\x00)R.'
+
+    def test_not_unpickled(self):
+        with open(self.filename, 'wb') as fd:
+            fd.write(self.unpickled())
+        with self.assertRaises(CorruptedDatabaseError):
+            MeuhDb(self.filename)
+        self.empty()
+        journal_path = self.filename + '.journal'
+        with open(journal_path, 'wb') as fd:
+            fd.write(LENGTH.pack(len(self.unpickled())) + self.unpickled())
+        try:
+            with self.assertRaises(CorruptedDatabaseError):
+                MeuhDb(self.filename, journal=True)
+            # The journal is left as it is
+            with open(journal_path, 'rb') as fd:
+                self.assertEquals(fd.read()[LENGTH.size:], self.unpickled())
+        finally:
+            unlink(journal_path)
+        self.assertEquals(UNPICKLED, [])
+
+
+UNPICKLED = []
+
+
+def unpickle():
+    UNPICKLED.append(True)
@@ -107,6 +107,11 @@ class DatabaseFilter(InMemoryDatabaseData):
         self.assertFalse('two' in result2)
         self.assertTrue('three' in result2)
 
+    def test_keys_to_values(self):
+        self.assertEquals(
+            self.db.keys_to_values(['one', 'missing']),
+            {'one': {'name': 'Alice', 'good': True, 'chief': True}})
+
     def test_and(self):
         result1 = self.db.filter_keys(good=True)
         result2 = self.db.filter_keys(name='Carl')
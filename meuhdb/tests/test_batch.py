@@ -0,0 +1,134 @@
+from meuhdb.core import MeuhDb
+from meuhdb.exceptions import BadValueError
+from meuhdb.tests import InMemoryDatabase, TempStorageDatabase
+
+
+class BatchTest(InMemoryDatabase):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.db.create_index('name')
+        self.db.set('one', {'name': 'Alice'})
+
+    def test_set_many(self):
+        value = {'name': 'Bob'}
+        self.db.set_many({'one': {'name': 'Carl'}, 'two': value})
+        value['name'] = 'Changed'
+        self.assertEquals(self.db.get('two'), {'name': 'Bob'})
+        self.assertEquals(self.db.indexes['name'], {
+            'Bob': set(['two']), 'Carl': set(['one'])})
+        self.db.set_many([('three', {'name': 'A'}), ('three', {'name': 'B'})])
+        self.assertEquals(self.db.get('three'), {'name': 'B'})
+        self.assertNotIn('A', self.db.indexes['name'])
+        self.assertEquals(self.db.verify_indexes(), [])
+
+    def test_set_many_bad_value(self):
+        with self.assertRaises(BadValueError):
+            self.db.set_many({'two': {'name': 'Bob'}, 'three': 'Carl'})
+        self.assertFalse(self.db.exists('two'))
+
+    def test_insert_many(self):
+        keys = self.db.insert_many([{'name': 'Bob'}, {'name': 'Carl'}])
+        self.assertEquals(len(keys), 2)
+        self.assertEquals(self.db.get(keys[0]), {'name': 'Bob'})
+        self.assertEquals(self.db.get(keys[1]), {'name': 'Carl'})
+        # From a generator
+        keys = self.db.insert_many({'i': i} for i in range(3))
+        self.assertEquals([self.db.get(key) for key in keys],
+                          [{'i': 0}, {'i': 1}, {'i': 2}])
+
+    def test_delete_many(self):
+        self.db.set_many({'two': {'name': 'Alice'}, 'three': {'name': 'B'}})
+        with self.assertRaises(KeyError):
+            self.db.delete_many(['one', 'missing'])
+        self.assertTrue(self.db.exists('one'))
+        self.db.delete_many(['one', 'three'])
+        self.assertEquals(list(self.db.all()), ['two'])
+        self.assertEquals(self.db.indexes['name'], {'Alice': set(['two'])})
+
+
+class BatchCommitTest(TempStorageDatabase):
+
+    options = {'autocommit': True}
+
+    def setUp(self):
+        super(BatchCommitTest, self).setUp()
+        self.commits = []
+        commit = self.db.commit
+
+        def counting_commit():
+            self.commits.append(len(self.db.data))
+            commit()
+        self.db.commit = counting_commit
+
+    def test_batch(self):
+        with self.db.batch():
+            self.db.set('one', {'name': 'Alice'})
+            self.db.update('one', {'age': 42})
+            with self.db.batch():
+                self.db.insert({'name': 'Bob'})
+            self.assertEquals(self.commits, [])
+            db = MeuhDb(self.filename)  # reload
+            self.assertFalse(db.exists('one'))
+        self.assertEquals(self.commits, [2])
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(db.get('one'), {'name': 'Alice', 'age': 42})
+
+    def test_empty_batch(self):
+        with self.db.batch():
+            pass
+        self.assertEquals(self.commits, [])
+
+    def test_batch_error(self):
+        with self.assertRaises(ValueError):
+            with self.db.batch():
+                self.db.set('one', {'name': 'Alice'})
+                raise ValueError()
+        self.assertEquals(self.commits, [])
+        self.assertTrue(self.db.exists('one'))
+
+    def test_set_many(self):
+        self.db.set_many({'one': {'name': 'Alice'}, 'two': {'name': 'Bob'}})
+        self.db.insert_many([{'name': 'Carl'}])
+        self.db.delete_many(['one'])
+        self.assertEquals(self.commits, [2, 3, 2])
+
+
+class BatchCounterTest(TempStorageDatabase):
+
+    options = {'autocommit_after': 3}
+
+    def test_batch(self):
+        with self.db.batch():
+            self.db.set('one', {'name': 'Alice'})
+            self.db.set('two', {'name': 'Bob'})
+        db = MeuhDb(self.filename)  # reload
+        self.assertFalse(db.exists('one'))
+        self.db.set('three', {'name': 'Carl'})
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(len(db.all()), 3)
+
+
+class BatchBackgroundCommitTest(TempStorageDatabase):
+
+    options = {'background_commit': True}
+
+    def tearDown(self):
+        self.db.close()
+        super(BatchBackgroundCommitTest, self).tearDown()
+
+    def test_commit_in_batch(self):
+        # The batch holds the lock the commit would wait for
+        with self.db.batch():
+            self.db.set('one', {'name': 'Alice'})
+            for method in (self.db.commit, self.db.flush, self.db.compact):
+                with self.assertRaises(RuntimeError):
+                    method()
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.set('two', {'name': 'Bob'})
+                self.db.commit()
+        self.assertFalse(self.db.exists('two'))
+        self.db.commit()
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(list(db.all()), ['one'])
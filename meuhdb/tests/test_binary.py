@@ -0,0 +1,114 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+from os import unlink
+from os.path import exists
+
+from meuhdb.binary import MAGIC, is_binary, read_blob, scan
+from meuhdb.core import MeuhDb
+from meuhdb.exceptions import CorruptedDatabaseError
+from meuhdb.lazy import LazyData
+from meuhdb.tests import TempStorageDatabase
+
+
+def decode(data):
+    return json.loads(data.decode('utf-8'))
+
+
+class BinaryFormatTest(TempStorageDatabase):
+
+    options = {'format': 'binary'}
+
+    def setUp(self):
+        super(BinaryFormatTest, self).setUp()
+        self.db.set('one', {'name': 'Alice', 'tags': ['a'], 'score': 12})
+        self.db.set('two', {'name': 'Zoë', 'tags': ['a', 'b'], 'score': 8})
+        self.db.create_index('name')
+        self.db.create_index('tags', _type='lazy')
+        self.db.create_index('score', _type='sorted')
+        self.db.create_index(('name', 'score'))
+        self.db.commit()
+
+    def test_file(self):
+        self.assertTrue(is_binary(self.filename))
+        with open(self.filename, 'rb') as fd:
+            buf = fd.read()
+        self.assertTrue(buf.endswith(MAGIC))
+        offsets, sections = scan(buf, decode)
+        self.assertEquals(sorted(offsets), ['one', 'two'])
+        self.assertEquals(
+            json.loads(read_blob(buf, offsets['two']).decode('utf-8')),
+            {'name': 'Zoë', 'tags': ['a', 'b'], 'score': 8})
+        self.assertEquals(sorted(sections['indexes']), ['name', 'name,score'])
+        self.assertEquals(sections['index_defs'], self.db.index_defs)
+
+    def test_load(self):
+        db = MeuhDb(self.filename)  # reload, whatever the format option
+        self.assertIsInstance(db.data, LazyData)
+        self.assertEquals(db.get('two')['name'], 'Zoë')
+        self.assertEquals(dict(db.all().items()), self.db.all())
+        self.assertEquals(db.indexes, self.db.indexes)
+        self.assertEquals(db.verify_indexes(), [])
+        self.assertEquals(db.filter_keys(name='Zoë', score=8), set(['two']))
+        self.assertEquals(db.filter_keys(score__gt=10), set(['one']))
+        db.close()
+
+    def test_write(self):
+        db = MeuhDb(self.filename, format='binary')
+        db.set('three', {'name': 'Carl'})
+        db.delete('one')
+        db.commit()
+        self.assertEquals(db.data._overlay, {})
+        self.assertEquals(db.get('three'), {'name': 'Carl'})
+        db.close()
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(sorted(db.all()), ['three', 'two'])
+        db.close()
+
+    def test_convert(self):
+        # binary -> json
+        db = MeuhDb(self.filename, format='json')
+        db.commit()
+        self.assertFalse(is_binary(self.filename))
+        with open(self.filename) as fd:
+            self.assertEquals(json.load(fd)['data'], self.db.all())
+        db.close()
+        # json -> binary
+        db = MeuhDb(self.filename, format='binary')
+        self.assertNotIsInstance(db.data, LazyData)
+        db.commit()
+        self.assertTrue(is_binary(self.filename))
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(dict(db.all().items()), self.db.all())
+        db.close()
+
+    def test_journal(self):
+        db = MeuhDb(self.filename, format='binary', journal=True)
+        db.set('three', {'name': 'Carl'})
+        db.commit()
+        db = MeuhDb(self.filename, format='binary', journal=True)  # reload
+        self.assertEquals(db.get('three'), {'name': 'Carl'})
+        db.compact()
+        self.assertFalse(exists(db._meta.journal_path))
+        db.close()
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(db.get('three'), {'name': 'Carl'})
+        db.close()
+
+    def test_truncated(self):
+        with open(self.filename, 'rb') as fd:
+            content = fd.read()
+        with open(self.filename, 'wb') as fd:
+            fd.write(content[:-5])
+        with self.assertRaises(CorruptedDatabaseError):
+            MeuhDb(self.filename)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            MeuhDb(format='xml')
+
+    def tearDown(self):
+        journal_path = self.db._meta.journal_path
+        if exists(journal_path):
+            unlink(journal_path)
+        super(BinaryFormatTest, self).tearDown()
@@ -0,0 +1,86 @@
+import json
+
+from meuhdb.core import MeuhDb
+from meuhdb.tests import InMemoryDatabase, TempStorageDatabase
+
+
+class CompoundIndexTest(InMemoryDatabase):
+
+    def setUp(self):
+        super(CompoundIndexTest, self).setUp()
+        self.db.set('1', {'tenant': 'acme', 'status': 'open'})
+        self.db.set('2', {'tenant': 'acme', 'status': 'closed'})
+        self.db.set('3', {'tenant': 'corp', 'status': 'open'})
+        self.db.set('4', {'tenant': 'acme'})
+        self.db.create_index(('tenant', 'status'))
+
+    def test_create(self):
+        self.assertIn('tenant,status', self.db.indexes)
+        self.assertEquals(
+            self.db.index_defs['tenant,status'],
+            {'type': 'default', 'fields': ['tenant', 'status']})
+        self.assertEquals(self.db.indexes['tenant,status'], {
+            ('acme', 'open'): set(['1']),
+            ('acme', 'closed'): set(['2']),
+            ('corp', 'open'): set(['3']),
+        })
+
+    def test_filter(self):
+        plan = self.db.explain(tenant='acme', status='open')
+        self.assertEquals(plan['steps'], [
+            {'index': 'tenant,status', 'criteria': ['tenant', 'status'],
+             'estimated': 1, 'actual': 1}])
+        self.assertEquals(plan['scan'], [])
+        self.assertEquals(
+            self.db.filter_keys(tenant='acme', status='open'), set(['1']))
+        self.assertEquals(
+            self.db.filter_keys(tenant='acme', status='open', other=1),
+            set([]))
+        self.assertEquals(
+            self.db.filter_keys(tenant='nobody', status='open'), set([]))
+
+    def test_partial_filter(self):
+        # Not every field of the index is filtered
+        self.assertEquals(
+            self.db.filter_keys(tenant='acme'), set(['1', '2', '4']))
+        self.assertFalse(self.db._used_index)
+        self.assertEquals(
+            self.db.filter_keys(tenant='acme', status__in=['open']),
+            set(['1']))
+        self.assertFalse(self.db._used_index)
+
+    def test_update(self):
+        self.db.update('4', {'status': 'open'})
+        self.db.set('5', {'tenant': 'corp', 'status': 'closed'})
+        self.db.delete('3')
+        self.assertEquals(
+            self.db.filter_keys(tenant='acme', status='open'),
+            set(['1', '4']))
+        self.assertEquals(
+            self.db.filter_keys(tenant='corp', status='closed'), set(['5']))
+        self.assertNotIn(('corp', 'open'), self.db.indexes['tenant,status'])
+
+    def test_remove(self):
+        self.db.remove_index(('tenant', 'status'))
+        self.assertNotIn('tenant,status', self.db.indexes)
+
+
+class CompoundIndexStorageTest(TempStorageDatabase):
+
+    def test_commit(self):
+        self.db.set('1', {'tenant': 'acme', 'status': 'open', 'n': 1})
+        self.db.set('2', {'tenant': 'acme', 'status': 2, 'n': 2})
+        self.db.create_index(('tenant', 'status'))
+        self.db.create_index(('tenant', 'n'), _type='lazy')
+        self.db.commit()
+        data = json.load(open(self.filename))
+        self.assertEquals(list(data['indexes']), ['tenant,status'])
+        values = [
+            json.loads(value) for value in data['indexes']['tenant,status']]
+        self.assertIn(['acme', 2], values)
+        self.assertIn(['acme', 'open'], values)
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(db.index_defs, self.db.index_defs)
+        self.assertEquals(db.indexes, self.db.indexes)
+        self.assertEquals(db.filter_keys(tenant='acme', status=2), set(['2']))
+        self.assertTrue(db._used_index)
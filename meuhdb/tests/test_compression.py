@@ -0,0 +1,75 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from meuhdb.compression import COMPRESSIONS, detect
+from meuhdb.core import MeuhDb
+from meuhdb.exceptions import CorruptedDatabaseError
+from meuhdb.tests import TempStorageDatabase
+
+
+class CompressionTest(TempStorageDatabase):
+
+    def fill(self, **options):
+        # Start from an empty file, whatever the backend was
+        open(self.filename, 'wb').close()
+        db = MeuhDb(self.filename, **options)
+        for x in range(100):
+            db.set('%d' % x, {'name': 'Zoë', 'score': x})
+        db.create_index('name')
+        db.commit()
+        return db
+
+    def test_compressions(self):
+        for name in COMPRESSIONS:
+            for backend in ('json', 'pickle'):
+                db = self.fill(compression=name, backend=backend)
+                self.assertEquals(detect(self.filename).name, name)
+                with open(self.filename, 'rb') as fd:
+                    self.assertTrue(
+                        fd.read().startswith(COMPRESSIONS[name].magic))
+                # Detected, whatever the option is
+                for options in ({}, {'streaming_load': True}):
+                    loaded = MeuhDb(self.filename, backend=backend, **options)
+                    self.assertEquals(loaded.all(), db.all())
+                    self.assertEquals(loaded.indexes, db.indexes)
+
+    def test_level(self):
+        self.fill(compression='gzip', compression_level=1)
+        with open(self.filename, 'rb') as fd:
+            fast = len(fd.read())
+        self.fill(compression='gzip', compression_level=9)
+        with open(self.filename, 'rb') as fd:
+            self.assertTrue(len(fd.read()) <= fast)
+
+    def test_uncompress(self):
+        db = self.fill(compression='bz2')
+        db = MeuhDb(self.filename)
+        db.set('100', {'name': 'Alice'})
+        db.commit()
+        self.assertIsNone(detect(self.filename))
+        self.assertEquals(len(MeuhDb(self.filename).all()), 101)
+
+    def test_lazy_open(self):
+        self.fill(compression='gzip')
+        # The file can't be memory-mapped, it's loaded as usual
+        db = MeuhDb(self.filename, lazy_open=True)
+        self.assertEquals(db.get('12'), {'name': 'Zoë', 'score': 12})
+        self.assertEquals(len(db.filter_keys(name='Zoë')), 100)
+
+    def test_options(self):
+        with self.assertRaises(ValueError):
+            MeuhDb(compression='rar')
+        with self.assertRaises(ValueError):
+            MeuhDb(compression='gzip', format='binary')
+        with self.assertRaises(ValueError):
+            MeuhDb(compression='gzip', lazy_open=True)
+
+    def test_corrupted(self):
+        self.fill(compression='gzip')
+        with open(self.filename, 'rb') as fd:
+            content = fd.read()
+        for data in (content[:len(content) // 2], content[:2] + b'meuh'):
+            with open(self.filename, 'wb') as fd:
+                fd.write(data)
+            with self.assertRaises(CorruptedDatabaseError):
+                MeuhDb(self.filename)
@@ -0,0 +1,100 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+
+from meuhdb.core import MeuhDb
+from meuhdb.tests import TempStorageDatabase
+
+
+class DirtyTrackingTest(TempStorageDatabase):
+
+    def setUp(self):
+        super(DirtyTrackingTest, self).setUp()
+        self.db.set('one', {'name': 'Alice', 'age': 42})
+        self.db.set('two', {'name': 'Bob'})
+        self.db.create_index('name')
+        self.db.commit()
+
+    def untouched(self):
+        "Return True if the DB file hasn't been written since `touch()`."
+        return os.path.getmtime(self.filename) == 0
+
+    def touch(self):
+        os.utime(self.filename, (0, 0))
+
+    def test_clean(self):
+        self.assertFalse(self.db.dirty)
+        self.assertEquals(self.db.dirty_keys, set())
+        self.touch()
+        self.db.commit()
+        self.assertTrue(self.untouched())
+        # Reading doesn't modify anything
+        self.db.get('one')
+        self.db.filter(name='Alice')
+        self.db.commit()
+        self.assertTrue(self.untouched())
+
+    def test_load(self):
+        db = MeuhDb(self.filename)
+        self.assertFalse(db.dirty)
+        db.create_index('name', _type='lazy')  # no-op, already there
+        self.assertFalse(db.dirty)
+
+    def test_writes(self):
+        db = self.db
+        db.set('three', {'name': 'Carl'})
+        db.update('one', {'age': 43})
+        db.del_key('two', 'name')
+        self.assertEquals(db.dirty_keys, set(['one', 'two', 'three']))
+        db.delete('three')
+        db.delete_many(['two'])
+        db.set_many({'four': {}})
+        self.assertEquals(db.dirty_keys, set(['one', 'two', 'three', 'four']))
+        self.touch()
+        db.commit()
+        self.assertFalse(self.untouched())
+        self.assertFalse(db.dirty)
+        self.assertEquals(db.dirty_keys, set())
+        self.assertEquals(
+            MeuhDb(self.filename).all(),
+            {'one': {'name': 'Alice', 'age': 43}, 'four': {}})
+
+    def test_indexes(self):
+        self.db.create_index('age')
+        self.assertTrue(self.db.dirty)
+        self.assertEquals(self.db.dirty_keys, set())
+        self.db.commit()
+        self.db.remove_index('age')
+        self.assertTrue(self.db.dirty)
+
+    def test_failed_commit(self):
+        self.db.set('three', {'name': 'Carl'})
+
+        def fail(snapshot):
+            raise IOError('disk full')
+        self.db._write_snapshot = fail
+        with self.assertRaises(IOError):
+            self.db.commit()
+        self.assertTrue(self.db.dirty)
+        self.assertEquals(self.db.dirty_keys, set(['three']))
+
+    def test_journal(self):
+        db = MeuhDb(self.filename, journal=True)
+        db.set('three', {'name': 'Carl'})
+        db.commit()
+        self.assertFalse(db.dirty)
+        db = MeuhDb(self.filename, journal=True)  # replays the journal
+        self.assertFalse(db.dirty)
+        self.assertEquals(db.get('three'), {'name': 'Carl'})
+
+    def test_conversion(self):
+        # Opened with other options: the file is converted on commit
+        db = MeuhDb(self.filename, format='binary')
+        self.assertTrue(db.dirty)
+        db.commit()
+        db.close()
+        db = MeuhDb(self.filename, format='binary')
+        self.assertFalse(db.dirty)
+        db.close()
+        db = MeuhDb(self.filename, compression='gzip')
+        self.assertTrue(db.dirty)
@@ -1,7 +1,8 @@
 import json
+import random
 
 from meuhdb.core import MeuhDb
-from meuhdb.tests import InMemoryDatabaseData
+from meuhdb.tests import InMemoryDatabase, InMemoryDatabaseData
 from meuhdb.tests import TempStorageDatabase, TempStorageDatabaseData
 
 
@@ -60,11 +61,131 @@ class DatabaseIndexDataTest(InMemoryDatabaseData):
         self.assertTrue(self.db._used_index)
         self.assertFalse(result)
 
+    def test_search_index_multiple(self):
+        self.db.create_index('name')
+        self.db.create_index('chief')
+        result = self.db.filter(name='Alice', chief=True, good=True)
+        self.assertTrue(self.db._used_index)
+        self.assertEquals(list(result), ['one'])
+        self.assertFalse(self.db.filter(name='Alice', good=False))
+        self.assertFalse(self.db.filter(name='Bob', chief=True))
+
+    def test_search_index_copy(self):
+        self.db.create_index('name')
+        result = self.db.filter_keys(name='Alice')
+        result.add('two')
+        # The index hasn't been modified
+        self.assertEquals(self.db.indexes['name']['Alice'], set(['one']))
+
+    def test_explain(self):
+        self.db.create_index('name')
+        self.db.create_index('good')
+        plan = self.db.explain(good=True, name='Alice', chief=True)
+        self.assertEquals(plan['steps'], [
+            {'index': 'name', 'criteria': ['name'],
+             'estimated': 1, 'actual': 1},
+            {'index': 'good', 'criteria': ['good'],
+             'estimated': 2, 'actual': 1},
+        ])
+        self.assertEquals(plan['scan'], ['chief'])
+        self.assertFalse(plan['full_scan'])
+        self.assertEquals(plan['scanned'], 1)
+        self.assertEquals(plan['estimated'], 1)
+        self.assertEquals(plan['actual'], 1)
+
+    def test_explain_full_scan(self):
+        plan = self.db.explain(good=True, name__startswith='A')
+        self.assertEquals(plan['steps'], [])
+        self.assertEquals(sorted(plan['scan']), ['good', 'name__startswith'])
+        self.assertTrue(plan['full_scan'])
+        self.assertEquals(plan['scanned'], 3)
+        self.assertEquals(plan['estimated'], 3)
+        self.assertEquals(plan['actual'], 1)
+
     def test_remove_index_name(self):
         self.db.create_index('name')
         self.assertTrue('name' in self.db.indexes)
         self.db.remove_index('name')
         self.assertFalse('name' in self.db.indexes)
+        self.assertFalse('name' in self.db.index_defs)
+
+    def test_delete_shared_value(self):
+        self.db.create_index('good')
+        self.db.delete('one')
+        self.assertEquals(self.db.indexes['good'][True], set(['two']))
+        self.db.set('two', {'name': 'Bob', 'good': False})
+        self.assertNotIn(True, self.db.indexes['good'])
+        self.assertEquals(
+            self.db.indexes['good'][False], set(['two', 'three']))
+        self.assertEquals(self.db.verify_indexes(), [])
+
+    def test_verify_indexes(self):
+        self.db.create_index('name', _type='sorted')
+        self.assertEquals(self.db.verify_indexes(), [])
+        self.db.indexes['name']['Alice'].add('two')
+        self.db.indexes['name']['Bob'].discard('two')
+        self.db.indexes['name']['Nobody'] = set([])
+        self.db._sorted_keys['name'].pop()
+        self.assertEquals(sorted(self.db.verify_indexes()), [
+            "name: 'two' missing for 'Bob'",
+            "name: 'two' should not be indexed for 'Alice'",
+            "name: empty bucket for 'Bob'",
+            "name: empty bucket for 'Nobody'",
+            "name: sorted values mismatch",
+        ])
+
+
+class DatabaseIndexConsistencyTest(InMemoryDatabase):
+
+    def random_value(self, rand):
+        value = {}
+        if rand.random() < 0.8:
+            value['name'] = rand.choice(['Alice', 'Bob', 'Carl', 'Dave'])
+        if rand.random() < 0.8:
+            value['score'] = rand.randrange(10)
+        if rand.random() < 0.5:
+            value['tags'] = rand.sample(['a', 'b', 'c'], rand.randrange(3))
+        if rand.random() < 0.5:
+            value['user'] = {'country': rand.choice(['FR', 'US'])}
+        return value
+
+    def test_random_mutations(self):
+        rand = random.Random(42)
+        self.db.create_index('name')
+        self.db.create_index('score', _type='sorted')
+        self.db.create_index('tags')
+        self.db.create_index('user.country')
+        self.db.create_index(('name', 'score'))
+        # Same data, without any index
+        scanned = MeuhDb()
+        keys = ['%d' % x for x in range(30)]
+        for x in range(2000):
+            key = rand.choice(keys)
+            action = rand.random()
+            field = rand.choice(['name', 'score'])
+            for db in (self.db, scanned):
+                if action < 0.4:
+                    db.set(key, self.random_value(random.Random(x)))
+                elif action < 0.6:
+                    db.update(key, self.random_value(random.Random(x)))
+                elif action < 0.8:
+                    if db.exists(key):
+                        db.del_key(key, field)
+                elif db.exists(key):
+                    db.delete(key)
+            queries = [
+                {'name': 'Alice'},
+                {'name': 'Bob', 'score': 3},
+                {'score__gt': 5},
+                {'score__between': (2, 4), 'tags__contains': 'a'},
+                {'tags__contains': 'b'},
+                {'user.country': 'FR', 'name__in': ['Carl', 'Dave']},
+            ]
+            for query in queries:
+                self.assertEqual(
+                    self.db.filter_keys(**query),
+                    scanned.filter_keys(**query))
+        self.assertEquals(self.db.verify_indexes(), [])
 
 
 class DatabaseStoreLazyIndexTest(TempStorageDatabase):
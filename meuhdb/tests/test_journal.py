@@ -0,0 +1,121 @@
+import json
+import warnings
+from os import unlink
+from os.path import exists
+
+from meuhdb.core import MeuhDb
+from meuhdb.tests import TempStorageDatabase
+
+
+class DatabaseJournalTest(TempStorageDatabase):
+
+    options = {'journal': True}
+
+    def tearDown(self):
+        if exists(self.db._meta.journal_path):
+            unlink(self.db._meta.journal_path)
+        super(DatabaseJournalTest, self).tearDown()
+
+    def journal(self):
+        with open(self.db._meta.journal_path) as fd:
+            return [json.loads(line) for line in fd]
+
+    def test_commit_appends(self):
+        self.db.set('key', {'hello': 'world'})
+        self.assertFalse(exists(self.db._meta.journal_path))
+        self.db.commit()
+        self.assertEquals(self.journal(), [['set', 'key', {'hello': 'world'}]])
+        # The DB file itself is left untouched
+        self.assertEquals(open(self.filename).read(), '')
+        self.db.delete('key')
+        self.db.commit()
+        self.assertEquals(len(self.journal()), 2)
+
+    def test_replay(self):
+        self.db.set('one', {'name': 'Alice'})
+        self.db.set('two', {'name': 'Bob'})
+        self.db.create_index('name')
+        self.db.update('two', {'age': 42})
+        self.db.delete('one')
+        self.db.commit()
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertFalse(db.exists('one'))
+        self.assertEquals(db.get('two'), {'name': 'Bob', 'age': 42})
+        self.assertEquals(db.indexes['name'], {'Bob': set(['two'])})
+        # Replaying doesn't add anything to the journal
+        self.assertEquals(db._journal, [])
+
+    def test_replay_remove_index(self):
+        self.db.set('one', {'name': 'Alice'})
+        self.db.create_index('name')
+        self.db.remove_index('name')
+        self.db.commit()
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertNotIn('name', db.indexes)
+
+    def test_torn_record(self):
+        self.db.set('one', {'name': 'Alice'})
+        self.db.commit()
+        with open(self.db._meta.journal_path, 'ab') as fd:
+            fd.write(b'["set", "two", {"na')
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertTrue(db.exists('one'))
+        self.assertFalse(db.exists('two'))
+
+    def test_torn_record_then_append(self):
+        self.db.set('one', {'name': 'Alice'})
+        self.db.commit()
+        with open(self.db._meta.journal_path, 'ab') as fd:
+            fd.write(b'["set", "two", {"na')
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            db = MeuhDb(self.filename, journal=True)  # restart
+        # The torn record is gone, the next ones are on their own lines
+        self.assertEquals(self.journal(), [['set', 'one', {'name': 'Alice'}]])
+        db.set('three', {'name': 'Carl'})
+        db.commit()
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertEquals(db.get('three'), {'name': 'Carl'})
+        self.assertFalse(db.exists('two'))
+
+    def test_snapshot_commit_removes_journal(self):
+        self.db.set('a', {'v': 1})
+        self.db.commit()
+        db = MeuhDb(self.filename)  # without the journal
+        db.set('a', {'v': 2})
+        db.commit()
+        self.assertFalse(exists(self.db._meta.journal_path))
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(db.get('a'), {'v': 2})
+
+    def test_compact(self):
+        self.db.set('one', {'name': 'Alice'})
+        self.db.commit()
+        self.db.set('two', {'name': 'Bob'})
+        self.db.compact()
+        self.assertFalse(exists(self.db._meta.journal_path))
+        data = json.load(open(self.filename))
+        self.assertEquals(
+            data['data'], {'one': {'name': 'Alice'}, 'two': {'name': 'Bob'}})
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertEquals(db.get('two'), {'name': 'Bob'})
+
+    def test_compact_then_replay(self):
+        self.db.set('one', {'name': 'Alice'})
+        self.db.compact()
+        self.db.delete('one')
+        self.db.commit()
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertFalse(db.exists('one'))
+
+
+class DatabaseJournalAutocommitTest(DatabaseJournalTest):
+
+    options = {'journal': True, 'autocommit': True}
+
+    def test_commit_appends(self):
+        self.db.set('key', {'hello': 'world'})
+        self.assertEquals(self.journal(), [['set', 'key', {'hello': 'world'}]])
+        self.db.delete('key')
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertFalse(db.exists('key'))
@@ -0,0 +1,154 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+
+from meuhdb.core import MeuhDb
+from meuhdb.exceptions import CorruptedDatabaseError
+from meuhdb.lazy import LazyData, scan
+from meuhdb.tests import TempStorageDatabase
+
+
+def decode(data):
+    return json.loads(data.decode('utf-8'))
+
+
+class ScanTest(TempStorageDatabase):
+
+    def test_scan(self):
+        data = {
+            'flat': {'name': 'Alice', 'tags': ['a', 'b'], 'score': 1.5},
+            'nested': {'user': {'address': {'country': 'FR'}}},
+            'unicode': {'name': 'Zoë "Z" \\ Martin'},
+            'é"\\': {'escaped': True},
+            'empty': {},
+        }
+        document = {'data': data, 'index_defs': {'name': {'type': 'lazy'}}}
+        for indent in (None, 2):
+            buf = json.dumps(document, indent=indent).encode('utf-8')
+            offsets, sections = scan(buf)
+            self.assertEquals(sections, {'index_defs': document['index_defs']})
+            self.assertEquals(sorted(offsets), sorted(data))
+            for key, (start, end) in offsets.items():
+                self.assertEquals(
+                    json.loads(buf[start:end].decode('utf-8')), data[key])
+
+    def test_scan_empty(self):
+        self.assertEquals(scan(b'{}'), ({}, {}))
+        self.assertEquals(scan(b' {"data": {}} '), ({}, {}))
+
+    def test_scan_invalid(self):
+        for buf in (b'{', b'[]', b'{"data": {}', b'{"data": {}}}',
+                    b'{"data": {"1": }}', b'{"data": {"1": {]}}}'):
+            with self.assertRaises(ValueError):
+                scan(buf)
+
+
+class LazyDataTest(TempStorageDatabase):
+
+    def setUp(self):
+        super(LazyDataTest, self).setUp()
+        buf = json.dumps({'data': {
+            'one': {'name': 'Alice'}, 'two': {'name': 'Bob'},
+        }}).encode('utf-8')
+        offsets = scan(buf)[0]
+        self.data = LazyData(buf, offsets, decode, cache_size=1)
+
+    def test_get(self):
+        self.assertEquals(self.data['one'], {'name': 'Alice'})
+        self.assertIs(self.data['one'], self.data['one'])  # cached
+        self.assertEquals(self.data['two'], {'name': 'Bob'})
+        self.assertEquals(list(self.data._cache), ['two'])
+        with self.assertRaises(KeyError):
+            self.data['three']
+
+    def test_overlay(self):
+        self.data['one'] = {'name': 'Alicia'}
+        self.data['three'] = {'name': 'Carl'}
+        del self.data['two']
+        self.assertEquals(self.data['one'], {'name': 'Alicia'})
+        self.assertNotIn('two', self.data)
+        with self.assertRaises(KeyError):
+            del self.data['two']
+        self.assertEquals(len(self.data), 2)
+        self.assertEquals(dict(self.data.items()), {
+            'one': {'name': 'Alicia'}, 'three': {'name': 'Carl'}})
+        self.data['two'] = {'name': 'Bobby'}
+        self.assertEquals(len(self.data), 3)
+        self.assertEquals(self.data['two'], {'name': 'Bobby'})
+
+    def test_items(self):
+        self.assertEquals(sorted(self.data.items()), [
+            ('one', {'name': 'Alice'}), ('two', {'name': 'Bob'})])
+        # Iterating doesn't fill the cache
+        self.assertEquals(len(self.data._cache), 0)
+
+
+class LazyOpenTest(TempStorageDatabase):
+
+    def setUp(self):
+        super(LazyOpenTest, self).setUp()
+        self.db.set('one', {'name': 'Alice', 'tags': ['a']})
+        self.db.set('two', {'name': 'Bob', 'tags': ['a', 'b']})
+        self.db.create_index('name')
+        self.db.create_index('tags', _type='lazy')
+        self.db.commit()
+        self.lazy_db = MeuhDb(self.filename, lazy_open=True)
+
+    def tearDown(self):
+        self.lazy_db.close()
+        super(LazyOpenTest, self).tearDown()
+
+    def test_read(self):
+        db = self.lazy_db
+        self.assertIsInstance(db.data, LazyData)
+        self.assertTrue(db.exists('one'))
+        self.assertFalse(db.exists('three'))
+        self.assertEquals(db.get('one'), {'name': 'Alice', 'tags': ['a']})
+        self.assertEquals(db.filter(name='Bob'), {
+            'two': {'name': 'Bob', 'tags': ['a', 'b']}})
+        self.assertEquals(db.filter_keys(tags__contains='b'), set(['two']))
+        self.assertEquals(db.indexes, self.db.indexes)
+        self.assertEquals(db.verify_indexes(), [])
+
+    def test_write(self):
+        db = self.lazy_db
+        db.set('three', {'name': 'Carl'})
+        db.update('one', {'name': 'Alicia'})
+        db.delete('two')
+        self.assertEquals(sorted(db.all()), ['one', 'three'])
+        self.assertEquals(db.filter_keys(name='Alicia'), set(['one']))
+        self.assertEquals(len(db.data._overlay), 2)
+        db.commit()
+        # The written records have been moved to the new file
+        self.assertEquals(db.data._overlay, {})
+        self.assertEquals(db.data._deleted, set())
+        self.assertEquals(db.get('one'), {'name': 'Alicia', 'tags': ['a']})
+        self.assertEquals(sorted(db.all()), ['one', 'three'])
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(sorted(db.all()), ['one', 'three'])
+        self.assertEquals(db.get('three'), {'name': 'Carl'})
+
+    def test_journal(self):
+        db = MeuhDb(self.filename, lazy_open=True, journal=True)
+        db.set('three', {'name': 'Carl'})
+        db.commit()
+        db = MeuhDb(self.filename, lazy_open=True, journal=True)  # reload
+        self.assertEquals(db.get('three'), {'name': 'Carl'})
+        db.compact()
+        self.assertEquals(db.data._overlay, {})
+        self.assertEquals(db.get('three'), {'name': 'Carl'})
+        db.close()
+
+    def test_empty(self):
+        with open(self.filename, 'w'):
+            pass
+        db = MeuhDb(self.filename, lazy_open=True)
+        self.assertEquals(db.all(), {})
+
+    def test_corrupted(self):
+        with open(self.filename, 'rb') as fd:
+            content = fd.read()
+        with open(self.filename, 'wb') as fd:
+            fd.write(content[:-5])
+        with self.assertRaises(CorruptedDatabaseError):
+            MeuhDb(self.filename, lazy_open=True)
@@ -0,0 +1,106 @@
+from meuhdb.core import MeuhDb
+from meuhdb.lookups import parse_lookup, sort_key, sorted_range
+from meuhdb.tests import InMemoryDatabase, TempStorageDatabase
+
+
+class LookupFunctionsTest(InMemoryDatabase):
+
+    def test_parse_lookup(self):
+        self.assertEquals(parse_lookup('score__gt'), ('score', 'gt'))
+        self.assertEquals(parse_lookup('score'), ('score', 'exact'))
+        self.assertEquals(parse_lookup('my__score'), ('my__score', 'exact'))
+        self.assertEquals(parse_lookup('__gt'), ('__gt', 'exact'))
+
+    def test_sorted_range(self):
+        keys = sorted(map(sort_key, [None, False, 1, 5, 10, 'a', 'ab', 'b']))
+        self.assertEquals(sorted_range(keys, 'gt', 1), [5, 10])
+        self.assertEquals(sorted_range(keys, 'gte', 5), [5, 10])
+        self.assertEquals(sorted_range(keys, 'lt', 10), [False, 1, 5])
+        self.assertEquals(sorted_range(keys, 'lte', 1), [False, 1])
+        self.assertEquals(sorted_range(keys, 'between', (2, 10)), [5, 10])
+        self.assertEquals(sorted_range(keys, 'between', (2, 'a')), [])
+        self.assertEquals(sorted_range(keys, 'startswith', 'a'), ['a', 'ab'])
+        self.assertEquals(sorted_range(keys, 'gt', 'a'), ['ab', 'b'])
+        self.assertEquals(sorted_range(keys, 'gt', [1]), [])
+
+
+class LookupTest(InMemoryDatabase):
+
+    def setUp(self):
+        super(LookupTest, self).setUp()
+        self.db.set('1', {'name': 'Alice', 'score': 12})
+        self.db.set('2', {'name': 'Albert', 'score': 50})
+        self.db.set('3', {'name': 'Bob', 'score': 3})
+        self.db.set('4', {'name': 'Carl', 'score': 'n/a'})
+        self.db.set('5', {'name': 'Dave'})
+
+    def check_lookups(self):
+        self.assertEquals(self.db.filter_keys(score__gt=10), set(['1', '2']))
+        self.assertEquals(self.db.filter_keys(score__gte=12), set(['1', '2']))
+        self.assertEquals(self.db.filter_keys(score__lt=12), set(['3']))
+        self.assertEquals(self.db.filter_keys(score__lte=12), set(['1', '3']))
+        self.assertEquals(
+            self.db.filter_keys(score__between=(1, 12)), set(['1', '3']))
+        self.assertEquals(
+            self.db.filter_keys(name__startswith='Al'), set(['1', '2']))
+        self.assertEquals(
+            self.db.filter_keys(name__in=['Bob', 'Dave', 'Nobody']),
+            set(['3', '5']))
+        self.assertEquals(
+            self.db.filter_keys(name__startswith='Al', score__lt=20),
+            set(['1']))
+        self.assertEquals(self.db.filter_keys(score__exact=3), set(['3']))
+
+    def test_scan(self):
+        self.check_lookups()
+        self.assertFalse(self.db._used_index)
+
+    def test_default_index(self):
+        self.db.create_index('name')
+        self.db.create_index('score')
+        self.check_lookups()
+        self.assertTrue(self.db._used_index)
+
+    def test_sorted_index(self):
+        self.db.create_index('name', _type='sorted')
+        self.db.create_index('score', _type='sorted')
+        self.assertEquals(self.db.index_defs['score'], {'type': 'sorted'})
+        self.assertEquals(self.db.lazy_indexes, set(['name', 'score']))
+        self.check_lookups()
+        self.assertTrue(self.db._used_index)
+
+    def test_sorted_index_update(self):
+        self.db.create_index('score', _type='sorted')
+        self.db.set('6', {'score': 30})
+        self.assertEquals(
+            self.db.filter_keys(score__gt=20), set(['2', '6']))
+        self.db.delete('2')
+        self.assertEquals(self.db.filter_keys(score__gt=20), set(['6']))
+        self.db.update('1', {'score': 100})
+        self.assertEquals(self.db.filter_keys(score__gt=20), set(['1', '6']))
+        self.assertEquals(self.db.filter_keys(score__lt=20), set(['3']))
+
+    def test_booleans(self):
+        # Booleans are numbers, and True shares the bucket of 1
+        for key, value in (('1', True), ('2', 1), ('3', 0), ('4', 5)):
+            self.db.set(key, {'y': value})
+        scanned = self.db.filter_keys(y__lte=2)
+        self.assertEquals(scanned, set(['1', '2', '3']))
+        self.db.create_index('y', _type='sorted')
+        self.assertEquals(self.db.filter_keys(y__lte=2), scanned)
+        self.assertEquals(self.db.filter_keys(y__gt=0), set(['1', '2', '4']))
+        self.assertEquals(list(self.db.query().order_by('y').keys()),
+                          ['3', '1', '2', '4', '5'])
+
+
+class SortedIndexStorageTest(TempStorageDatabase):
+
+    def test_reload(self):
+        self.db.set('1', {'score': 12})
+        self.db.set('2', {'score': 50})
+        self.db.create_index('score', _type='sorted')
+        self.db.commit()
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(db.index_defs['score'], {'type': 'sorted'})
+        self.assertEquals(db.filter_keys(score__gt=20), set(['2']))
+        self.assertTrue(db._used_index)
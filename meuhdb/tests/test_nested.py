@@ -0,0 +1,100 @@
+from meuhdb.core import MeuhDb
+from meuhdb.lookups import MISSING, resolve
+from meuhdb.tests import InMemoryDatabase, TempStorageDatabase
+
+
+class NestedDatabase(InMemoryDatabase):
+
+    def setUp(self):
+        super(NestedDatabase, self).setUp()
+        self.db.set('1', {'user': {'country': 'FR'}, 'tags': ['a', 'b']})
+        self.db.set('2', {'user': {'country': 'US'}, 'tags': ['b']})
+        self.db.set('3', {'user': {'name': 'Carl'}, 'tags': 'a'})
+        self.db.set('4', {'user': 'Dave', 'tags': [['a'], {'b': 1}]})
+
+
+class ResolveTest(InMemoryDatabase):
+
+    def test_resolve(self):
+        record = {'user': {'country': 'FR'}, 'a.b': 1, 'tags': ['a']}
+        self.assertEquals(resolve(record, 'user.country'), 'FR')
+        self.assertEquals(resolve(record, 'user'), {'country': 'FR'})
+        self.assertEquals(resolve(record, 'a.b'), 1)
+        self.assertIs(resolve(record, 'user.name'), MISSING)
+        self.assertIs(resolve(record, 'tags.name'), MISSING)
+        self.assertIs(resolve(record, 'missing'), MISSING)
+
+
+class NestedFilterTest(NestedDatabase):
+
+    def check_filters(self):
+        self.assertEquals(
+            self.db.filter_keys(**{'user.country': 'FR'}), set(['1']))
+        self.assertEquals(
+            self.db.filter_keys(**{'user.country__in': ['FR', 'US']}),
+            set(['1', '2']))
+        self.assertEquals(
+            self.db.filter_keys(tags__contains='a'), set(['1', '3']))
+        self.assertEquals(
+            self.db.filter_keys(tags__contains='b'), set(['1', '2']))
+        self.assertEquals(self.db.filter_keys(tags='a'), set(['3']))
+        self.assertEquals(self.db.filter_keys(tags=['b']), set(['2']))
+        self.assertEquals(self.db.filter_keys(tags=[['a'], {'b': 1}]),
+                          set(['4']))
+        self.assertEquals(
+            self.db.filter_keys(user={'name': 'Carl'}), set(['3']))
+
+    def test_scan(self):
+        self.check_filters()
+
+    def test_index(self):
+        self.db.create_index('user.country')
+        self.db.create_index('tags')
+        self.db.create_index('user')
+        self.assertEquals(self.db.indexes['user.country'], {
+            'FR': set(['1']), 'US': set(['2'])})
+        self.assertEquals(self.db.indexes['tags'], {
+            'a': set(['1', '3']), 'b': set(['1', '2'])})
+        self.assertTrue(self.db.index_defs['tags']['multi'])
+        self.assertNotIn('multi', self.db.index_defs['user.country'])
+        self.check_filters()
+        plan = self.db.explain(tags__contains='a')
+        self.assertEquals(plan['steps'][0]['index'], 'tags')
+        self.assertFalse(plan['full_scan'])
+        # The index gives candidates, they're checked
+        self.assertEquals(plan['scan'], ['tags__contains'])
+
+    def test_update(self):
+        self.db.create_index('user.country')
+        self.db.create_index('tags')
+        self.db.set('5', {'user': {'country': 'FR'}, 'tags': ['c', 'c']})
+        self.assertEquals(
+            self.db.filter_keys(**{'user.country': 'FR'}), set(['1', '5']))
+        self.assertEquals(self.db.filter_keys(tags__contains='c'), set(['5']))
+        self.assertEquals(self.db.indexes['tags']['c'], set(['5']))
+        self.db.delete('5')
+        self.assertNotIn('c', self.db.indexes['tags'])
+
+    def test_compound(self):
+        self.db.create_index(('user.country', 'tags'))
+        self.assertEquals(self.db.indexes['user.country,tags'], {
+            ('FR', 'a'): set(['1']),
+            ('FR', 'b'): set(['1']),
+            ('US', 'b'): set(['2']),
+        })
+        self.assertEquals(
+            self.db.filter_keys(**{'user.country': 'US', 'tags': ['b']}),
+            set(['2']))
+
+
+class NestedStorageTest(TempStorageDatabase):
+
+    def test_reload(self):
+        self.db.set('1', {'user': {'country': 'FR'}, 'tags': ['a', 'b']})
+        self.db.create_index('user.country')
+        self.db.create_index('tags')
+        self.db.commit()
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(db.indexes, self.db.indexes)
+        self.assertEquals(db.index_defs, self.db.index_defs)
+        self.assertEquals(db.filter_keys(tags__contains='b'), set(['1']))
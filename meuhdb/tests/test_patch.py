@@ -0,0 +1,94 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from meuhdb.core import MeuhDb
+from meuhdb.tests import InMemoryDatabase
+
+
+class PatchTest(InMemoryDatabase):
+
+    def setUp(self):
+        super(PatchTest, self).setUp()
+        self.db.set('one', {
+            'name': 'Alice', 'score': 12, 'user': {'country': 'fr'},
+            'history': [{'x': x} for x in range(100)]})
+        self.db.set('two', {'name': 'Bob', 'score': 8})
+        self.db.create_index('name')
+        self.db.create_index('score', _type='sorted')
+        self.db.create_index('user.country')
+        self.db.create_index(('name', 'score'))
+        self.updated = []
+        remove_from_index = self.db._remove_from_index
+
+        def counting_remove_from_index(idx_name, key, value):
+            self.updated.append(idx_name)
+            remove_from_index(idx_name, key, value)
+        self.db._remove_from_index = counting_remove_from_index
+
+    def test_update(self):
+        old = self.db.get('one')
+        self.db.update('one', {'score': 13, 'age': 42})
+        new = self.db.get('one')
+        self.assertEquals(new['score'], 13)
+        self.assertEquals(new['age'], 42)
+        # Only the indexes on the changed fields are updated
+        self.assertEquals(sorted(self.updated), ['name,score', 'score'])
+        # The unchanged fields aren't copied
+        self.assertIs(new['history'], old['history'])
+        self.assertEquals(old['score'], 12)
+        self.assertEquals(self.db.filter_keys(score__gt=12), set(['one']))
+        self.assertEquals(self.db.filter_keys(name='Alice', score=13),
+                          set(['one']))
+        self.assertEquals(self.db.verify_indexes(), [])
+
+    def test_unchanged(self):
+        self.db.update('one', {'name': 'Alice', 'age': 42})
+        self.assertEquals(self.updated, [])
+        self.assertEquals(self.db.get('one')['age'], 42)
+
+    def test_nested(self):
+        self.db.update('one', {'user': {'country': 'de'}})
+        self.assertEquals(self.updated, ['user.country'])
+        self.assertEquals(self.db.filter_keys(**{'user.country': 'de'}),
+                          set(['one']))
+        self.assertEquals(self.db.verify_indexes(), [])
+
+    def test_del_key(self):
+        self.db.del_key('two', 'score')
+        self.assertEquals(sorted(self.updated), ['name,score', 'score'])
+        self.assertEquals(self.db.get('two'), {'name': 'Bob'})
+        self.assertEquals(self.db.filter_keys(score=8), set())
+        self.assertEquals(self.db.verify_indexes(), [])
+
+    def test_copies(self):
+        patch = {'tags': ['a']}
+        self.db.update('two', patch)
+        patch['tags'].append('b')
+        self.assertEquals(self.db.get('two')['tags'], ['a'])
+
+    def test_transaction(self):
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.db.update('one', {'score': 1})
+                self.db.del_key('two', 'name')
+                raise ValueError
+        self.assertEquals(self.db.get('one')['score'], 12)
+        self.assertEquals(self.db.get('two'), {'name': 'Bob', 'score': 8})
+        self.assertEquals(self.db.verify_indexes(), [])
+
+
+class NoCopyTest(InMemoryDatabase):
+
+    def setUp(self):
+        self.db = MeuhDb(copy_on_write=False)
+
+    def test_no_copy(self):
+        value = {'name': 'Alice', 'tags': ['a']}
+        self.db.set('one', value)
+        self.assertIs(self.db.get('one'), value)
+        patch = {'tags': ['b']}
+        self.db.update('one', patch)
+        self.assertIs(self.db.get('one')['tags'], patch['tags'])
+        values = [{'name': 'Bob'}]
+        key, = self.db.insert_many(values)
+        self.assertIs(self.db.get(key), values[0])
@@ -0,0 +1,98 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+
+from meuhdb.core import MeuhDb
+from meuhdb.policies import EveryNWrites, EveryWrite, Interval, PendingSize
+from meuhdb.policies import WritesOrInterval
+from meuhdb.tests import TempStorageDatabase
+
+
+def stored(filename):
+    "Return the records stored in the DB file."
+    return MeuhDb(filename).all()
+
+
+def wait_for(condition, timeout=5):
+    "Wait until the condition is True. Return it."
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+class PolicyTest(TempStorageDatabase):
+
+    def test_default_policies(self):
+        self.assertIsInstance(
+            MeuhDb(autocommit=True)._meta.policy, EveryWrite)
+        policy = MeuhDb(autocommit_after=3)._meta.policy
+        self.assertIsInstance(policy, EveryNWrites)
+        self.assertEquals(
+            [policy.written() for x in range(4)], [False, False, True, False])
+        policy.committed()
+        self.assertFalse(policy.written())
+
+    def test_own_copy(self):
+        policy = WritesOrInterval(2, 60)
+        db = MeuhDb(self.filename, commit_policy=policy)
+        db.set('1', {})
+        self.assertIsNone(policy.first_write)
+        self.assertIsNotNone(db._meta.policy.first_write)
+        db.close()
+
+    def test_writes_or_interval(self):
+        db = MeuhDb(
+            self.filename, commit_policy=WritesOrInterval(3, seconds=60))
+        db.set('1', {})
+        db.set('2', {})
+        self.assertEquals(stored(self.filename), {})
+        db.set('3', {})
+        self.assertEquals(len(stored(self.filename)), 3)
+        # Uncommitted writes are committed at close
+        db.set('4', {})
+        db.close()
+        self.assertEquals(len(stored(self.filename)), 4)
+
+    def test_timer(self):
+        db = MeuhDb(
+            self.filename, commit_policy=WritesOrInterval(100, seconds=0.05))
+        db.set('1', {'name': 'Alice'})
+        self.assertEquals(stored(self.filename), {})
+        # The DB is idle, the timer commits anyway
+        self.assertTrue(wait_for(
+            lambda: stored(self.filename) == {'1': {'name': 'Alice'}}))
+        self.assertFalse(db.dirty)
+        db.close()
+
+    def test_interval(self):
+        db = MeuhDb(self.filename, commit_policy=Interval(0.2))
+        db.set('1', {})  # first commit
+        self.assertEquals(len(stored(self.filename)), 1)
+        db.set('2', {})
+        db.set('3', {})
+        self.assertEquals(len(stored(self.filename)), 1)
+        self.assertTrue(wait_for(lambda: len(stored(self.filename)) == 3))
+        db.close()
+
+    def test_pending_size(self):
+        db = MeuhDb(self.filename, commit_policy=PendingSize(100))
+        db.set('1', {'name': 'Alice'})
+        self.assertEquals(stored(self.filename), {})
+        self.assertTrue(db._meta.policy.pending_size > 10)
+        db.set('2', {'name': 'x' * 100})
+        self.assertEquals(len(stored(self.filename)), 2)
+        self.assertEquals(db._meta.policy.pending_size, 0)
+        self.assertIsNone(db._timer)
+
+    def test_batch(self):
+        db = MeuhDb(self.filename, commit_policy=WritesOrInterval(2, 60))
+        with db.batch():
+            for x in range(10):
+                db.set('%d' % x, {})
+            # Committed at the end of the batch only
+            self.assertEquals(stored(self.filename), {})
+        self.assertEquals(len(stored(self.filename)), 10)
+        db.set('10', {})
+        self.assertEquals(len(stored(self.filename)), 10)
+        db.close()
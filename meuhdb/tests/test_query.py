@@ -0,0 +1,111 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from meuhdb.core import MeuhDb
+from meuhdb.tests import InMemoryDatabase
+from meuhdb.views import FrozenMapping
+
+
+class QueryTest(InMemoryDatabase):
+
+    def setUp(self):
+        super(QueryTest, self).setUp()
+        for x in range(100):
+            record = {'name': 'user%d' % x, 'good': x % 2 == 0}
+            if x % 10:
+                # Every tenth record has no score
+                record['score'] = x % 7
+            self.db.set('%02d' % x, record)
+        self.expected = sorted(
+            ('%02d' % x for x in range(100) if x % 10),
+            key=lambda key: (int(key) % 7, key))
+        self.missing = ['%02d' % x for x in range(0, 100, 10)]
+
+    def keys(self, query):
+        keys = list(query.keys())
+        self.assertEquals([key for key, _ in query], keys)
+        return keys
+
+    def test_unordered(self):
+        query = self.db.query(good=True)
+        self.assertEquals(set(self.keys(query)),
+                          self.db.filter_keys(good=True))
+        self.assertEquals(query.count(), 50)
+        self.assertEquals(len(self.keys(query.limit(10))), 10)
+        self.assertEquals(len(self.keys(query.offset(45))), 5)
+        self.assertEquals(self.db.query().count(), 100)
+        self.assertEquals(list(self.db.query(name='user3')),
+                          [('03', self.db.get('03'))])
+
+    def order_by(self, field):
+        query = self.db.query().order_by(field)
+        self.assertEquals(self.keys(query), self.expected + self.missing)
+        self.assertEquals(self.keys(query.offset(5).limit(10)),
+                          self.expected[5:15])
+        self.assertEquals(self.keys(query.limit(10).offset(5)),
+                          self.expected[5:10])
+        self.assertEquals(self.keys(query.offset(85).limit(10)),
+                          self.expected[85:] + self.missing[:5])
+        self.assertEquals(self.keys(query.limit(3).filter(good=False)),
+                          ['07', '21', '35'])
+        descending = self.db.query().order_by('-score')
+        self.assertEquals(self.keys(descending.limit(5)),
+                          list(reversed(self.expected))[:5])
+        self.assertEquals(self.keys(descending)[-10:], self.missing)
+
+    def test_order_by(self):
+        self.order_by('score')
+
+    def test_order_by_index(self):
+        self.db.create_index('good')
+        self.db.create_index('score', _type='sorted')
+        self.order_by('score')
+        # The sorted index is walked when there's no selective criterion
+        query = self.db.query().order_by('score')
+        self.assertTrue(query._use_sorted_index(query._plan()))
+        query = self.db.query(good=True).order_by('score').limit(10)
+        self.assertTrue(query._use_sorted_index(query._plan()))
+        # The few matching records are sorted instead
+        self.db.create_index('name')
+        query = self.db.query(name='user3').order_by('score').limit(10)
+        self.assertEquals(self.keys(query), ['03'])
+        self.assertFalse(query._use_sorted_index(query._plan()))
+
+    def test_heap(self):
+        # Only the page is kept, not all the matching records
+        query = self.db.query().order_by('score').limit(5)
+        self.assertEquals(self.keys(query), self.expected[:5])
+        self.assertEquals(self.keys(query.order_by('name')),
+                          ['00', '01', '10', '11', '12'])
+
+    def test_count(self):
+        self.db.create_index('good')
+        query = self.db.query(good=True)
+        # Counted from the index, no record is read
+        data, self.db.raw['data'] = self.db.data, None
+        try:
+            self.assertEquals(query.count(), 50)
+            self.assertEquals(query.offset(10).limit(30).count(), 30)
+            self.assertEquals(query.offset(40).limit(30).count(), 10)
+            self.assertEquals(query.offset(60).count(), 0)
+        finally:
+            self.db.raw['data'] = data
+        self.assertEquals(query.filter(score__gt=3).count(), 17)
+
+    def test_first(self):
+        self.assertEquals(
+            self.db.query(good=True).order_by('-score').first(),
+            ('76', self.db.get('76')))
+        self.assertIsNone(self.db.query(name='nobody').first())
+
+    def test_read_policy(self):
+        db = MeuhDb(read_policy='frozen')
+        db.set('one', {'name': 'Alice'})
+        key, value = db.query().first()
+        self.assertIsInstance(value, FrozenMapping)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.db.query().limit(-1)
+        with self.assertRaises(ValueError):
+            self.db.query().offset(-1)
@@ -0,0 +1,172 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from os.path import exists
+from tempfile import mkdtemp
+from unittest import TestCase
+import os
+import shutil
+import threading
+
+from meuhdb import ShardedMeuhDb, sharding
+from meuhdb.policies import Interval, WritesOrInterval
+from meuhdb.sharding import shard_number, shard_path
+
+
+class ShardedDatabaseTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'db')
+        self.db = ShardedMeuhDb(self.path, shards=4)
+        self.db.set_many(dict(
+            ('%d' % x, {'name': 'name-%d' % (x % 10), 'score': x})
+            for x in range(100)))
+        self.db.create_index('name')
+        self.db.create_index('score', _type='sorted')
+        self.db.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_partition(self):
+        self.assertEquals(shard_number('12', 4), shard_number('12', 4))
+        for number, shard in enumerate(self.db.shards):
+            self.assertTrue(shard.all())
+            for key in shard.all():
+                self.assertEquals(shard_number(key, 4), number)
+            self.assertTrue(exists(shard_path(self.path, number)))
+        self.assertEquals(len(self.db.all()), 100)
+
+    def test_api(self):
+        db = self.db
+        self.assertEquals(db.get('12'), {'name': 'name-2', 'score': 12})
+        key = db.insert({'name': 'Alice'})
+        self.assertTrue(db.exists(key))
+        db.update(key, {'score': 1000})
+        self.assertEquals(db.get(key), {'name': 'Alice', 'score': 1000})
+        db.del_key(key, 'name')
+        self.assertEquals(db.get(key), {'score': 1000})
+        db.delete(key)
+        self.assertFalse(db.exists(key))
+        with self.assertRaises(KeyError):
+            db.get(key)
+        db.delete_many(['1', '2'])
+        with self.assertRaises(KeyError):
+            db.delete_many(['3', '1'])
+        self.assertTrue(db.exists('3'))
+        self.assertEquals(len(db.insert_many([{}, {}])), 2)
+        self.assertEquals(len(db.insert_many({} for x in range(2))), 2)
+        self.assertEquals(len(db.all()), 102)
+        self.assertEquals(db.verify_indexes(), [])
+
+    def test_filter(self):
+        self.assertEquals(
+            self.db.filter_keys(name='name-3'),
+            set('%d' % x for x in range(3, 100, 10)))
+        self.assertEquals(
+            self.db.filter(score__gte=98),
+            {'98': {'name': 'name-8', 'score': 98},
+             '99': {'name': 'name-9', 'score': 99}})
+        self.assertEquals(
+            self.db.keys_to_values(['1', '404']),
+            {'1': {'name': 'name-1', 'score': 1}})
+
+    def test_load(self):
+        for processes in (1, 4):
+            db = ShardedMeuhDb(self.path, shards=4, processes=processes)
+            self.assertEquals(db.all(), self.db.all())
+            self.assertEquals(db.filter_keys(score__lt=2), set(['0', '1']))
+            self.assertEquals(db.verify_indexes(), [])
+
+    def test_dirty_shards(self):
+        self.assertEquals(self.db.dirty_shards, set())
+        number = shard_number('12', 4)
+        other = (number + 1) % 4
+        for path in (shard_path(self.path, number),
+                     shard_path(self.path, other)):
+            os.utime(path, (0, 0))
+        self.db.set('12', {'name': 'Alice'})
+        self.assertEquals(self.db.dirty_shards, set([number]))
+        self.db.commit()
+        self.assertEquals(self.db.dirty_shards, set())
+        # Only the modified shard has been written
+        self.assertNotEquals(
+            os.path.getmtime(shard_path(self.path, number)), 0)
+        self.assertEquals(os.path.getmtime(shard_path(self.path, other)), 0)
+        db = ShardedMeuhDb(self.path, shards=4)
+        self.assertEquals(db.get('12'), {'name': 'Alice'})
+        self.assertEquals(db.filter_keys(name='Alice'), set(['12']))
+
+    def test_parallel_commit(self):
+        for options in ({}, {'lazy_open': True}, {'journal': True},
+                        {'format': 'binary'}):
+            db = ShardedMeuhDb(self.path, shards=4, processes=4, **options)
+            db.set_many(dict(('%d' % x, {'name': 'new'}) for x in range(50)))
+            db.commit()
+            self.assertEquals(db.get('1'), {'name': 'new'})
+            loaded = ShardedMeuhDb(self.path, shards=4)
+            self.assertEquals(loaded.all(), db.all())
+            self.assertEquals(len(loaded.filter_keys(name='new')), 50)
+            self.assertEquals(loaded.verify_indexes(), [])
+            db.close()
+            loaded.close()
+
+    def test_timers(self):
+        for processes in (1, 4):
+            db = ShardedMeuhDb(self.path, shards=4, processes=processes,
+                               commit_policy=Interval(60))
+            # Shards loaded in parallel too
+            for shard in db.shards:
+                self.assertIsNotNone(shard._timer)
+            db.close()
+
+    def test_parallel_commit_policy(self):
+        db = ShardedMeuhDb(self.path, shards=4, processes=4,
+                           commit_policy=WritesOrInterval(1000, 60))
+        db.set_many(dict(('%d' % x, {'name': 'new'}) for x in range(50)))
+        for shard in db.shards:
+            self.assertIsNotNone(shard._meta.policy.deadline())
+        db.commit()
+        for shard in db.shards:
+            self.assertIsNone(shard._meta.policy.deadline())
+            self.assertEquals(shard.stats()['commits'], 1)
+            self.assertTrue(shard.stats()['bytes_written'])
+        db.close()
+
+    def test_write_during_parallel_commit(self):
+        for options in ({}, {'lazy_open': True}):
+            db = ShardedMeuhDb(self.path, shards=4, processes=4, **options)
+            db.set_many(dict(('%d' % x, {'name': 'new'}) for x in range(50)))
+            number = shard_number('1', 4)
+            writer = threading.Thread(
+                target=db.set, args=('1', {'name': 'concurrent'}))
+            fork_pool = sharding._fork_pool
+
+            def forking_writer(*args):
+                # Written while the shards are committed
+                writer.start()
+                writer.join(0.2)
+                return fork_pool(*args)
+            sharding._fork_pool = forking_writer
+            try:
+                db.commit()
+            finally:
+                sharding._fork_pool = fork_pool
+            writer.join()
+            # Held back until the commit is done, then left to commit
+            self.assertEquals(db.dirty_shards, set([number]))
+            self.assertEquals(db.get('1'), {'name': 'concurrent'})
+            db.commit()
+            loaded = ShardedMeuhDb(self.path, shards=4)
+            self.assertEquals(loaded.get('1'), {'name': 'concurrent'})
+            self.assertEquals(loaded.get('2'), {'name': 'new'})
+            db.close()
+            loaded.close()
+
+    def test_options(self):
+        with self.assertRaises(ValueError):
+            ShardedMeuhDb(self.path, background_commit=True)
+        db = ShardedMeuhDb(shards=2)  # in-memory
+        db.set('1', {'name': 'Alice'})
+        db.commit()
+        self.assertEquals(db.get('1'), {'name': 'Alice'})
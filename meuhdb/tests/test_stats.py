@@ -0,0 +1,70 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+
+from meuhdb.core import MeuhDb
+from meuhdb.tests import TempStorageDatabase
+
+
+class WriteAccountingTest(TempStorageDatabase):
+
+    options = {'autocommit': True}
+
+    def test_nested_writes(self):
+        db = self.db
+        key = db.insert({'name': 'Alice'})  # calls set()
+        db.update(key, {'age': 42})  # calls set()
+        db.del_key(key, 'age')  # calls set()
+        db.create_index('name')  # calls build_index()
+        stats = db.stats()
+        self.assertEquals(stats['writes'], 4)
+        self.assertEquals(stats['commits_triggered'], 4)
+        self.assertEquals(stats['commits'], 4)
+
+    def test_autocommit_after(self):
+        db = MeuhDb(self.filename, autocommit_after=2)
+        db.insert({'name': 'Alice'})
+        self.assertEquals(db.stats()['commits'], 0)
+        db.update('nope', {'name': 'Bob'})
+        self.assertEquals(db.stats()['commits'], 1)
+        self.assertEquals(len(MeuhDb(self.filename).all()), 2)
+
+    def test_failed_write(self):
+        with self.assertRaises(KeyError):
+            self.db.delete('nope')
+        # The depth guard is reset
+        self.db.set('1', {})
+        self.assertEquals(self.db.stats()['commits'], 1)
+
+
+class StatsTest(TempStorageDatabase):
+
+    def test_stats(self):
+        db = self.db
+        self.assertEquals(db.stats(), {
+            'writes': 0, 'commits_triggered': 0, 'commits': 0,
+            'commits_skipped': 0, 'bytes_written': 0, 'commit_time': 0})
+        db.set_many({'1': {}, '2': {}})
+        with db.batch():
+            db.set('3', {})
+            db.set('4', {})
+        db.commit()
+        db.commit()
+        stats = db.stats()
+        self.assertEquals(stats['writes'], 3)
+        self.assertEquals(stats['commits_triggered'], 0)
+        self.assertEquals(stats['commits'], 1)
+        self.assertEquals(stats['commits_skipped'], 1)
+        self.assertEquals(
+            stats['bytes_written'], os.path.getsize(self.filename))
+        self.assertTrue(stats['commit_time'] > 0)
+
+    def test_journal(self):
+        db = MeuhDb(self.filename, journal=True)
+        db.set('1', {'name': 'Alice'})
+        db.commit()
+        self.assertEquals(
+            db.stats()['bytes_written'],
+            os.path.getsize(db._meta.journal_path))
+        db.compact()
+        self.assertEquals(db.stats()['commits'], 2)
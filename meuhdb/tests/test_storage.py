@@ -1,7 +1,11 @@
 import json
 import logging
+import os
+import warnings
 
 from meuhdb.core import MeuhDb
+from meuhdb.exceptions import CorruptedDatabaseError
+from meuhdb.storage import generation_path
 from meuhdb.tests import TempStorageDatabase
 
 logging.captureWarnings(True)
@@ -17,6 +21,21 @@ class DatabaseCommitTest(TempStorageDatabase):
         self.assertTrue(db.exists("key"))
         self.assertEquals(db.get('key'), {'hello': 'world'})
 
+    def test_commit_indexes(self):
+        self.db.set('1', {'name': 'Alice'})
+        self.db.set('2', {'name': 'Alice'})
+        self.db.create_index('name')
+        self.db.create_index('age', _type='lazy')
+        self.db.commit()
+        data = json.load(open(self.filename))
+        self.assertEquals(
+            data['data'], {'1': {'name': 'Alice'}, '2': {'name': 'Alice'}})
+        self.assertEquals(list(data['indexes']), ['name'])
+        self.assertEquals(sorted(data['indexes']['name']['Alice']), ['1', '2'])
+        # The live DB hasn't been touched
+        self.assertEquals(self.db.indexes['name'], {'Alice': set(['1', '2'])})
+        self.assertIn('age', self.db.indexes)
+
     def test_commit_delete(self):
         self.db.set('key', {'hello': 'world'})
         self.db.commit()
@@ -28,6 +47,91 @@ class DatabaseCommitTest(TempStorageDatabase):
         self.assertFalse(db.exists('key'))
 
 
+class DatabaseAtomicCommitTest(TempStorageDatabase):
+
+    def test_failed_commit(self):
+        self.db.set('key', {'hello': 'world'})
+        self.db.commit()
+        # sets aren't JSON serializable
+        self.db.set('other', {'hello': set(['world'])})
+        with self.assertRaises(TypeError):
+            self.db.commit()
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(db.all(), {'key': {'hello': 'world'}})
+        # the temporary file has been removed
+        directory, name = os.path.split(self.filename)
+        self.assertEquals(
+            [f for f in os.listdir(directory) if f.startswith('.' + name)],
+            [])
+
+    def test_keep_permissions(self):
+        os.chmod(self.filename, 0o644)
+        self.db.set('key', {'hello': 'world'})
+        self.db.commit()
+        self.assertEquals(os.stat(self.filename).st_mode & 0o777, 0o644)
+
+    def test_new_file_permissions(self):
+        os.unlink(self.filename)
+        umask = os.umask(0o022)
+        original = os.umask
+
+        def set_umask(mask):
+            # Process-wide: another thread would create files with it
+            self.fail('The umask is modified')
+        os.umask = set_umask
+        try:
+            self.db.set('key', {'hello': 'world'})
+            self.db.commit()
+        finally:
+            os.umask = original
+            os.umask(umask)
+        self.assertEquals(os.stat(self.filename).st_mode & 0o777, 0o644)
+
+    def test_corrupted(self):
+        with open(self.filename, 'w') as fd:
+            fd.write('{"data": {"key": {"hel')
+        with self.assertRaises(CorruptedDatabaseError):
+            MeuhDb(self.filename)
+
+
+class DatabaseGenerationsTest(TempStorageDatabase):
+
+    options = {'keep_generations': 2}
+
+    def tearDown(self):
+        for generation in (1, 2, 3):
+            path = generation_path(self.filename, generation)
+            if os.path.exists(path):
+                os.unlink(path)
+        super(DatabaseGenerationsTest, self).tearDown()
+
+    def test_generations(self):
+        for value in ('Alice', 'Bob', 'Carl', 'Dave'):
+            self.db.set('key', {'name': value})
+            self.db.commit()
+        self.assertFalse(
+            os.path.exists(generation_path(self.filename, 3)))
+        db = MeuhDb(generation_path(self.filename, 1))
+        self.assertEquals(db.get('key'), {'name': 'Carl'})
+        db = MeuhDb(generation_path(self.filename, 2))
+        self.assertEquals(db.get('key'), {'name': 'Bob'})
+        db = MeuhDb(self.filename)
+        self.assertEquals(db.get('key'), {'name': 'Dave'})
+
+    def test_fallback(self):
+        self.db.set('key', {'name': 'Alice'})
+        self.db.commit()
+        self.db.set('key', {'name': 'Bob'})
+        self.db.commit()
+        with open(self.filename, 'w') as fd:
+            fd.write('{"data": {"key": {"na')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            db = MeuhDb(self.filename, keep_generations=2)
+        self.assertEquals(db.get('key'), {'name': 'Alice'})
+        self.assertEquals(len(caught), 1)
+
+
 class DatabaseStoreChangeBackendTest(TempStorageDatabase):
 
     options = {'backend': 'json'}
@@ -137,3 +241,75 @@ class DatabaseStoreAutocommitAfterTest(TempStorageDatabase):
         self.db.delete('key3')
         db = MeuhDb(self.filename)  # reload
         self.assertTrue(db.exists('key3'))
+
+
+class DatabaseBackgroundCommitTest(TempStorageDatabase):
+
+    options = {'autocommit': True, 'background_commit': True}
+
+    def tearDown(self):
+        self.db.close()
+        super(DatabaseBackgroundCommitTest, self).tearDown()
+
+    def test_flush(self):
+        for x in range(50):
+            self.db.set('%d' % x, {'name': 'Alice'})
+        self.db.flush()
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(len(db.all()), 50)
+
+    def test_close(self):
+        self.db.set('key', {'name': 'Alice'})
+        self.db.close()
+        self.assertIsNone(self.db._committer)
+        db = MeuhDb(self.filename)  # reload
+        self.assertTrue(db.exists('key'))
+
+    def test_coalesce(self):
+        writes = []
+        write_snapshot = self.db._write_snapshot
+
+        def counting_write_snapshot(snapshot):
+            writes.append(len(snapshot['data']))
+            return write_snapshot(snapshot)
+        self.db._write_snapshot = counting_write_snapshot
+        # Block the commits while writing
+        with self.db._io_lock:
+            for x in range(10):
+                self.db.set('%d' % x, {'name': 'Alice'})
+        self.db.flush()
+        # At most one commit was waiting for the lock, all the following
+        # requests have been merged.
+        self.assertLessEqual(len(writes), 3)
+        self.assertEquals(writes[-1], 10)
+
+    def test_error(self):
+        self.db.set('key', {'name': set(['Alice'])})
+        with self.assertRaises(TypeError):
+            self.db.flush()
+        # The error is only raised once
+        self.db.delete('key')
+        self.db.flush()
+
+
+class DatabaseBackgroundJournalTest(TempStorageDatabase):
+
+    options = {'autocommit': True, 'background_commit': True,
+               'journal': True}
+
+    def tearDown(self):
+        self.db.close()
+        if os.path.exists(self.db._meta.journal_path):
+            os.unlink(self.db._meta.journal_path)
+        super(DatabaseBackgroundJournalTest, self).tearDown()
+
+    def test_journal(self):
+        for x in range(20):
+            self.db.set('%d' % x, {'name': 'Alice'})
+        self.db.delete('0')
+        self.db.flush()
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertEquals(len(db.all()), 19)
+        self.db.compact()
+        db = MeuhDb(self.filename)  # reload, without the journal
+        self.assertEquals(len(db.all()), 19)
@@ -0,0 +1,81 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from io import BytesIO
+import json
+
+from meuhdb.core import MeuhDb
+from meuhdb.exceptions import CorruptedDatabaseError
+from meuhdb.streaming import StreamReader, load
+from meuhdb.tests import TempStorageDatabase
+
+
+class StreamReaderTest(TempStorageDatabase):
+
+    def reader(self, document):
+        # A tiny chunk size, so that values span several chunks
+        return StreamReader(
+            BytesIO(json.dumps(document).encode('utf-8')), chunk_size=3)
+
+    def test_value(self):
+        document = [12345678, 'héllo wörld', {'a': [1.5, None, True]}]
+        self.assertEquals(self.reader(document).value(), document)
+
+    def test_mapping(self):
+        document = {'one': 1234, 'two': 'ünïcode', 'three': {}, 'four': []}
+        reader = self.reader(document)
+        self.assertEquals(dict(reader.mapping()), document)
+        self.assertEquals(reader.peek(), '')
+        self.assertEquals(list(self.reader({}).mapping()), [])
+
+    def test_load(self):
+        document = {
+            'data': {'1': {'name': 'Alice'}, '2': {'name': 'Alice'}},
+            'index_defs': {'name': {'type': 'default'}},
+            'indexes': {'name': {'Alice': ['1', '2']}},
+        }
+        loaded = load(BytesIO(json.dumps(document).encode('utf-8')))
+        self.assertEquals(loaded['data'], document['data'])
+        self.assertEquals(loaded['index_defs'], document['index_defs'])
+        self.assertEquals(
+            loaded['indexes'], {'name': {'Alice': set(['1', '2'])}})
+
+    def test_load_empty(self):
+        self.assertIsNone(load(BytesIO(b'  \n')))
+
+    def test_load_invalid(self):
+        for content in (b'{"data": {"1": {}', b'{"data": {}} {}', b'[]',
+                        b'{"data": {1: {}}}'):
+            with self.assertRaises(ValueError):
+                load(BytesIO(content))
+
+
+class StreamingLoadTest(TempStorageDatabase):
+
+    def test_load(self):
+        self.db.set('one', {'name': 'Alice', 'tags': ['a', 'b']})
+        self.db.set('two', {'name': 'Bob', 'score': 12})
+        self.db.create_index('name')
+        self.db.create_index('tags')
+        self.db.create_index(('name', 'score'))
+        self.db.create_index('score', _type='sorted')
+        self.db.commit()
+        db = MeuhDb(self.filename, streaming_load=True)  # reload
+        self.assertEquals(db.all(), self.db.all())
+        self.assertEquals(db.indexes, self.db.indexes)
+        self.assertEquals(db.index_defs, self.db.index_defs)
+        self.assertEquals(db.verify_indexes(), [])
+        self.assertEquals(db.filter_keys(name='Bob', score=12), set(['two']))
+
+    def test_load_empty(self):
+        db = MeuhDb(self.filename, streaming_load=True)
+        self.assertEquals(db.all(), {})
+
+    def test_corrupted(self):
+        self.db.set('one', {'name': 'Alice'})
+        self.db.commit()
+        with open(self.filename, 'rb') as fd:
+            content = fd.read()
+        with open(self.filename, 'wb') as fd:
+            fd.write(content[:-5])
+        with self.assertRaises(CorruptedDatabaseError):
+            MeuhDb(self.filename, streaming_load=True)
@@ -0,0 +1,159 @@
+from os import unlink
+from os.path import exists
+
+from meuhdb.core import MeuhDb
+from meuhdb.tests import InMemoryDatabaseData, TempStorageDatabase
+
+
+class Rollback(Exception):
+    pass
+
+
+class TransactionTest(InMemoryDatabaseData):
+
+    def setUp(self):
+        super(TransactionTest, self).setUp()
+        self.db.create_index('name')
+        self.db.create_index('good')
+
+    def test_commit(self):
+        with self.db.transaction():
+            self.db.set('four', {'name': 'Dave'})
+            self.db.delete('one')
+        self.assertTrue(self.db.exists('four'))
+        self.assertFalse(self.db.exists('one'))
+
+    def test_rollback(self):
+        original = self.db.get('two')
+        with self.assertRaises(Rollback):
+            with self.db.transaction():
+                self.db.set('four', {'name': 'Dave'})
+                self.db.update('two', {'name': 'Robert'})
+                self.db.del_key('three', 'good')
+                self.db.delete('one')
+                self.db.set_many({'five': {'name': 'Eve'}})
+                self.db.delete_many(['five', 'four'])
+                self.db.insert({'name': 'Fred'})
+                raise Rollback()
+        self.assertEquals(sorted(self.db.all()), ['one', 'three', 'two'])
+        self.assertIs(self.db.get('two'), original)
+        self.assertEquals(self.db.get('three'),
+                          {'name': 'Carl', 'good': False})
+        self.assertEquals(self.db.filter_keys(name='Alice'), set(['one']))
+        self.assertEquals(self.db.filter_keys(name='Robert'), set([]))
+        self.assertEquals(self.db.verify_indexes(), [])
+
+    def test_rollback_indexes(self):
+        with self.assertRaises(Rollback):
+            with self.db.transaction():
+                self.db.remove_index('name')
+                self.db.set('four', {'name': 'Dave', 'good': True})
+                self.db.create_index('good', recreate=True, _type='sorted')
+                self.db.create_index(('name', 'good'))
+                raise Rollback()
+        self.assertEquals(sorted(self.db.indexes), ['good', 'name'])
+        self.assertEquals(self.db.index_defs['name'], {'type': 'default'})
+        self.assertEquals(self.db.index_defs['good'], {'type': 'lazy'})
+        self.assertEquals(self.db._sorted_keys, {})
+        self.assertEquals(self.db.verify_indexes(), [])
+
+    def test_nested(self):
+        with self.assertRaises(Rollback):
+            with self.db.transaction():
+                self.db.set('four', {'name': 'Dave'})
+                try:
+                    with self.db.transaction():
+                        self.db.set('five', {'name': 'Eve'})
+                        self.db.delete('four')
+                        raise Rollback()
+                except Rollback:
+                    pass
+                self.assertTrue(self.db.exists('four'))
+                self.assertFalse(self.db.exists('five'))
+                with self.db.transaction():
+                    self.db.delete('one')
+                raise Rollback()
+        self.assertFalse(self.db.exists('four'))
+        self.assertTrue(self.db.exists('one'))
+        self.assertEquals(self.db.verify_indexes(), [])
+
+
+class TransactionStorageTest(TempStorageDatabase):
+
+    options = {'autocommit': True, 'journal': True}
+
+    def tearDown(self):
+        if exists(self.db._meta.journal_path):
+            unlink(self.db._meta.journal_path)
+        super(TransactionStorageTest, self).tearDown()
+
+    def test_single_commit(self):
+        commits = []
+        commit = self.db.commit
+
+        def counting_commit():
+            commits.append(1)
+            commit()
+        self.db.commit = counting_commit
+        with self.db.transaction():
+            self.db.set('one', {'name': 'Alice'})
+            self.db.update('one', {'age': 42})
+            self.assertEquals(commits, [])
+        self.assertEquals(commits, [1])
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertEquals(db.get('one'), {'name': 'Alice', 'age': 42})
+
+    def test_rollback_journal(self):
+        self.db.set('one', {'name': 'Alice'})
+        with self.assertRaises(Rollback):
+            with self.db.transaction():
+                self.db.set('two', {'name': 'Bob'})
+                self.db.delete('one')
+                raise Rollback()
+        self.assertEquals(self.db._journal, [])
+        self.db.set('three', {'name': 'Carl'})
+        db = MeuhDb(self.filename, journal=True)  # reload
+        self.assertEquals(sorted(db.all()), ['one', 'three'])
+
+
+class TransactionCommitTest(TempStorageDatabase):
+
+    def test_commit_without_autocommit(self):
+        with self.db.transaction():
+            self.db.set('one', {'name': 'Alice'})
+            with self.db.transaction():
+                self.db.set('two', {'name': 'Bob'})
+            # Committed by the outermost transaction only
+            self.assertTrue(self.db.dirty)
+        self.assertFalse(self.db.dirty)
+        self.assertEquals(self.db.stats()['commits'], 1)
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(sorted(db.all()), ['one', 'two'])
+
+    def test_no_commit_on_rollback(self):
+        with self.assertRaises(Rollback):
+            with self.db.transaction():
+                self.db.set('one', {'name': 'Alice'})
+                raise Rollback()
+        self.assertEquals(self.db.stats()['commits'], 0)
+
+    def test_within_batch(self):
+        with self.db.batch():
+            with self.db.transaction():
+                self.db.set('one', {'name': 'Alice'})
+            # The batch isn't committed partway through
+            self.assertTrue(self.db.dirty)
+
+    def test_rollback_dirty(self):
+        self.db.set('n', {'value': 1})
+        self.db.commit()
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.set('n', {'value': 2})
+                self.db.set('m', {'value': 2})
+                # Not committed within the transaction
+                self.db.commit()
+        self.assertEquals(self.db.dirty_keys, set(['n', 'm']))
+        self.db.commit()
+        db = MeuhDb(self.filename)  # reload
+        self.assertEquals(dict(db.all().items()), {'n': {'value': 1}})
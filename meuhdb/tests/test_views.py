@@ -0,0 +1,103 @@
+#-*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from copy import deepcopy
+import json
+
+from meuhdb.core import MeuhDb
+from meuhdb.views import FrozenList, FrozenMapping, copy_value
+from meuhdb.tests import InMemoryDatabase
+
+
+class ViewsTest(InMemoryDatabase):
+
+    def test_copy_value(self):
+        value = {'a': [1, {'b': None}], 'c': 'd', 'e': (1, 2)}
+        copied = copy_value(value)
+        self.assertEquals(copied, value)
+        self.assertIsNot(copied['a'], value['a'])
+        self.assertIsNot(copied['a'][1], value['a'][1])
+
+    def test_frozen(self):
+        record = {'name': 'Alice', 'tags': ['a', {'b': 1}], 'user': {'id': 1}}
+        view = FrozenMapping(record)
+        self.assertEquals(view, record)
+        self.assertEquals(record, view)
+        self.assertEquals(view['name'], 'Alice')
+        self.assertIsInstance(view['user'], FrozenMapping)
+        self.assertIsInstance(view['tags'], FrozenList)
+        self.assertEquals(view['tags'], ['a', {'b': 1}])
+        self.assertNotEquals(view['tags'], ['a'])
+        self.assertIsInstance(view['tags'][1], FrozenMapping)
+        self.assertEquals(view['tags'][:1], ['a'])
+        with self.assertRaises(TypeError):
+            view['name'] = 'Bob'
+        with self.assertRaises(AttributeError):
+            view['tags'].append('c')
+        with self.assertRaises(TypeError):
+            view['user']['id'] = 2
+        self.assertEquals(sorted(view), ['name', 'tags', 'user'])
+        self.assertTrue('name' in view)
+        self.assertEquals(len(view), 3)
+
+    def test_thaw(self):
+        record = {'tags': ['a'], 'user': {'id': 1}}
+        view = FrozenMapping(record)
+        for thawed in (view.thaw(), deepcopy(view)):
+            self.assertEquals(thawed, record)
+            self.assertIs(type(thawed), dict)
+            thawed['tags'].append('b')
+            self.assertEquals(record['tags'], ['a'])
+        self.assertEquals(json.dumps(view.thaw()), json.dumps(record))
+
+
+class ReadPolicyTest(InMemoryDatabase):
+
+    def fill(self, read_policy):
+        db = MeuhDb(read_policy=read_policy)
+        db.set('one', {'name': 'Alice', 'tags': ['a']})
+        db.set('two', {'name': 'Bob', 'tags': []})
+        db.create_index('name')
+        return db
+
+    def test_live(self):
+        db = self.fill('live')
+        self.assertIs(db.get('one'), db.data['one'])
+        self.assertIs(db.all(), db.data)
+        self.assertIs(db.filter(name='Alice')['one'], db.data['one'])
+
+    def test_copy(self):
+        db = self.fill('copy')
+        for record in (db.get('one'), db.all()['one'],
+                       db.filter(name='Alice')['one']):
+            self.assertEquals(record, {'name': 'Alice', 'tags': ['a']})
+            record['name'] = 'Carl'
+            record['tags'].append('b')
+        self.assertEquals(db.data['one'], {'name': 'Alice', 'tags': ['a']})
+        self.assertEquals(db.filter_keys(name='Alice'), set(['one']))
+
+    def test_frozen(self):
+        db = self.fill('frozen')
+        for record in (db.get('one'), db.all()['one'],
+                       db.filter(name='Alice')['one']):
+            self.assertIsInstance(record, FrozenMapping)
+            self.assertEquals(record, {'name': 'Alice', 'tags': ['a']})
+            with self.assertRaises(TypeError):
+                record['name'] = 'Carl'
+        self.assertEquals(len(db.all()), 2)
+        with self.assertRaises(TypeError):
+            db.all()['three'] = {}
+        # Writing a view back
+        record = db.get('one')
+        db.update('two', {'tags': record['tags']})
+        db.set('three', deepcopy(record))
+        self.assertEquals(db.data['two']['tags'], ['a'])
+        self.assertIs(type(db.data['two']['tags']), list)
+        self.assertIs(type(db.data['three']), dict)
+        db.update('one', {'name': 'Carl'})
+        self.assertEquals(db.get('one')['name'], 'Carl')
+        db.del_key('one', 'tags')
+        self.assertEquals(db.get('one'), {'name': 'Carl'})
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            MeuhDb(read_policy='borrowed')
@@ -0,0 +1,114 @@
+#-*- coding: utf-8 -*-
+"""
+Read-only views of the stored records, and copies of them, returned by the
+read methods depending on the ``read_policy`` option.
+"""
+from __future__ import unicode_literals
+from copy import deepcopy
+
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:  # Python 2
+    from collections import Mapping, Sequence
+
+#: How the read methods return the records: the stored ones, copies of them,
+#: or read-only views of them.
+READ_POLICIES = ('live', 'copy', 'frozen')
+
+
+def copy_value(value):
+    """Return a deep copy of a JSON value. Much faster than ``deepcopy()``,
+    which handles any kind of object."""
+    if type(value) is dict:
+        return dict((key, copy_value(item)) for key, item in value.items())
+    if type(value) is list:
+        return [copy_value(item) for item in value]
+    if isinstance(value, (dict, list, set, tuple)):
+        return deepcopy(value)
+    return value
+
+
+def freeze(value):
+    "Return a read-only view of the value, if it's a dict or a list."
+    if isinstance(value, dict):
+        return FrozenMapping(value)
+    if isinstance(value, list):
+        return FrozenList(value)
+    return value
+
+
+class FrozenMapping(Mapping):
+    """
+    A read-only view of a mapping (e.g. a record).
+
+    It's made without copying anything, and its dicts and lists are returned
+    as read-only views too. ``thaw()`` returns a modifiable copy.
+    """
+    __slots__ = ('_mapping',)
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+
+    def __getitem__(self, key):
+        return freeze(self._mapping[key])
+
+    def __contains__(self, key):
+        return key in self._mapping
+
+    def __iter__(self):
+        return iter(self._mapping)
+
+    def __len__(self):
+        return len(self._mapping)
+
+    def __repr__(self):
+        return 'FrozenMapping({!r})'.format(self._mapping)
+
+    def thaw(self):
+        "Return a (deep) copy of the mapping, as a dict."
+        return dict(
+            (key, copy_value(value)) for key, value in self._mapping.items())
+
+    def __deepcopy__(self, memo):
+        return self.thaw()
+
+
+class FrozenList(Sequence):
+    """A read-only view of a list. Its dicts and lists are returned as
+    read-only views too."""
+    __slots__ = ('_list',)
+
+    def __init__(self, values):
+        self._list = values
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return FrozenList(self._list[index])
+        return freeze(self._list[index])
+
+    def __len__(self):
+        return len(self._list)
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenList):
+            other = other._list
+        if not isinstance(other, (list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            value == item for value, item in zip(self, other))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FrozenList({!r})'.format(self._list)
+
+    def thaw(self):
+        "Return a (deep) copy of the list."
+        return copy_value(self._list)
+
+    def __deepcopy__(self, memo):
+        return self.thaw()
@@ -1,29 +1,391 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
+from __future__ import print_function
+from copy import deepcopy
+from multiprocessing import Process, Queue
 from os import unlink
-from tempfile import mkstemp
+from os.path import exists, getsize, join
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+from timeit import default_timer as clock
 import random
-import time
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+from meuhdb import aggregation
 from meuhdb.core import MeuhDb
+from meuhdb.sharding import ShardedMeuhDb
 from meuhdb.backends import BACKENDS
+from meuhdb.compression import COMPRESSIONS
+from meuhdb.storage import to_bytes
 
 
-def dump_load(backend):
+def dump_load(backend, **options):
+    "Return the load time, the commit time and the file size of a DB."
     fd, filename = mkstemp()
-    db = MeuhDb(filename, backend=backend)
+    db = MeuhDb(filename, backend=backend, **options)
     for x in range(200000):
-        db.set("%d" % x, {'score': random.randrange(1, 100)})
-    t0 = time.clock()
+        db.set("%d" % x, {
+            'name': 'name-%d' % (x % 1000), 'score': random.randrange(1, 100)})
+    db.create_index('name')
+    t0 = clock()
     db.commit()
-    t1 = time.clock()
-    t2 = time.clock()
+    t1 = clock()
+    t2 = clock()
+    db = MeuhDb(filename, backend=backend, **options)
+    t3 = clock()
+    size = getsize(filename)
+    unlink(filename)
+    return t3 - t2, t1 - t0, size
+
+
+def deepcopy_commit(db):
+    "The commit path used up to v0.3.0: serialize a deep copy of the DB."
+    raw = deepcopy(db.raw)
+    for index_name, values in raw['indexes'].items():
+        for value, keys in values.items():
+            raw['indexes'][index_name][value] = list(keys)
+    with open(db._meta.path, 'wb') as fd:
+        fd.write(to_bytes(db.serialize(raw)))
+
+
+def measure(func, *args):
+    """Return the time spent and the peak memory allocated by `func`.
+    Memory tracing slows everything down, so it's done in a separate run.
+    """
+    t0 = clock()
+    func(*args)
+    t1 = clock()
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return t1 - t0, peak
+
+
+def commit_copy(backend):
+    fd, filename = mkstemp()
     db = MeuhDb(filename, backend=backend)
-    t3 = time.clock()
+    for x in range(200000):
+        db.set("%d" % x, {'name': 'name-%d' % (x % 1000)})
+    db.create_index('name')
+
+    def commit():
+        # Both runs write the DB, an unmodified DB isn't committed
+        db._dirty = True
+        db.commit()
+    results = measure(deepcopy_commit, db), measure(commit)
     unlink(filename)
-    return t3 - t2, t1 - t0
+    return results
+
+
+def indexed_filter(size, repeat=1000):
+    "Return the average time of an indexed filter matching 10 records."
+    db = MeuhDb()
+    for x in range(size):
+        db.set("%d" % x, {'name': 'name-%d' % (x % (size // 10))})
+    db.create_index('name')
+    t0 = clock()
+    for x in range(repeat):
+        db.filter(name='name-%d' % x)
+    return (clock() - t0) / repeat
+
+
+def load(bulk, size=200000):
+    "Return the number of records loaded per second, with 2 indexes."
+    db = MeuhDb()
+    db.create_index('name')
+    db.create_index('score', _type='sorted')
+    values = [
+        {'name': 'name-%d' % (x % 1000), 'score': random.randrange(1, 100)}
+        for x in range(size)]
+    t0 = clock()
+    if bulk:
+        db.insert_many(values)
+    else:
+        for value in values:
+            db.insert(value)
+    return size / (clock() - t0)
+
+
+STARTUP_OPTIONS = (
+    ('full', {}),
+    ('streaming', {'streaming_load': True}),
+    ('lazy', {'lazy_open': True}),
+    ('binary', {'format': 'binary'}),
+)
+
+
+def _open(filename, options, queue):
+    t0 = clock()
+    db = MeuhDb(filename, **options)
+    # A few reads, as a process opening the DB only to read some keys would
+    for x in range(0, 100000, 1000):
+        db.get("%d" % x)
+    elapsed = clock() - t0
+    peak = None
+    if resource is not None:
+        # Kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((elapsed, peak))
+
+
+def startup(size):
+    """Return the file size for each format, and the startup time and peak
+    RSS of a process opening the DB with each of the `STARTUP_OPTIONS`.
+    About 10 million records make a 1 GB JSON file.
+    """
+    records = dict(
+        ("%d" % x, {
+            'name': 'name-%d' % (x % 1000), 'score': random.randrange(1, 100),
+            'tags': ['tag-%d' % (x % 7), 'tag-%d' % (x % 11)]})
+        for x in range(size))
+    filenames = {}
+    for file_format in ('json', 'binary'):
+        fd, filenames[file_format] = mkstemp()
+        db = MeuhDb(filenames[file_format], format=file_format)
+        db.set_many(records)
+        db.create_index('name')
+        db.commit()
+    del db, records
+    results = []
+    for name, options in STARTUP_OPTIONS:
+        filename = filenames[options.get('format', 'json')]
+        # A fresh process for each run, the peak RSS never decreases
+        queue = Queue()
+        process = Process(target=_open, args=(filename, options, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    file_sizes = {}
+    for file_format, filename in filenames.items():
+        file_sizes[file_format] = getsize(filename)
+        unlink(filename)
+    return file_sizes, results
+
+
+def sharded(size, shards=8, updates=1):
+    """Return the time of a full commit, of a commit after an update, and
+    of a load, for a single DB and for a sharded one (one process, and one
+    per CPU)."""
+    directory = mkdtemp()
+    records = dict(
+        ("%d" % x, {'name': 'name-%d' % (x % 1000)}) for x in range(size))
+    results = []
+    for name, factory in (
+            ('single', lambda: MeuhDb(join(directory, 'single'))),
+            ('sharded, 1 process', lambda: ShardedMeuhDb(
+                join(directory, 'sharded'), shards=shards, processes=1)),
+            ('sharded', lambda: ShardedMeuhDb(
+                join(directory, 'sharded'), shards=shards))):
+        db = factory()
+        db.set_many(records)
+        db.create_index('name')
+        t0 = clock()
+        db.commit()
+        t1 = clock()
+        for x in range(updates):
+            db.set("%d" % x, {'name': 'updated'})
+        db.commit()
+        t2 = clock()
+        factory()
+        t3 = clock()
+        results.append((name, t1 - t0, t2 - t1, t3 - t2))
+    rmtree(directory)
+    return results
+
+
+def patch_updates(size=1000, repeat=10, **options):
+    "Return the number of small updates of large records per second."
+    db = MeuhDb(**options)
+    for x in range(size):
+        record = dict(('field-%d' % f, 'value-%d' % f) for f in range(200))
+        record.update({'name': 'name-%d' % x, 'score': x, 'counter': 0})
+        db.set("%d" % x, record)
+    db.create_index('name')
+    db.create_index('score', _type='sorted')
+    t0 = clock()
+    for counter in range(repeat):
+        for x in range(size):
+            db.update("%d" % x, {'counter': counter})
+    return size * repeat / (clock() - t0)
+
+
+def reads(read_policy, size=10000, repeat=10):
+    """Return the number of records read per second by ``get()``, and by a
+    filter matching 10% of the records, with the `read_policy`."""
+    db = MeuhDb(read_policy=read_policy)
+    for x in range(size):
+        db.set("%d" % x, {
+            'name': 'name-%d' % (x % 10), 'score': x,
+            'tags': ['tag-%d' % t for t in range(10)],
+            'user': {'id': x, 'country': 'fr'}})
+    db.create_index('name')
+    t0 = clock()
+    for counter in range(repeat):
+        for x in range(size):
+            db.get("%d" % x)
+    t1 = clock()
+    for counter in range(repeat):
+        db.filter(name='name-%d' % counter)
+    t2 = clock()
+    return size * repeat / (t1 - t0), size * repeat / 10 / (t2 - t1)
+
+
+def write_mix(size=1000, **options):
+    "Return the I/O stats of a mix of write operations, with autocommit."
+    fd, filename = mkstemp()
+    db = MeuhDb(filename, autocommit=True, **options)
+    keys = [db.insert({'name': 'name-%d' % x}) for x in range(size // 2)]
+    for key in keys:
+        db.update(key, {'score': random.randrange(1, 100)})
+    db.commit()  # at shutdown
+    db.close()
+    unlink(filename)
+    if exists(db._meta.journal_path):
+        unlink(db._meta.journal_path)
+    return db.stats()
+
+
+def paginate(size, page=10, offset=1000):
+    """Return the time and peak memory of a page of a query, ordered by a
+    field: sorting the whole filter() result, with a heap, and walking a
+    sorted index."""
+    db = MeuhDb()
+    for x in range(size):
+        db.set("%d" % x, {'good': x % 2 == 0, 'score': random.random()})
+    db.create_index('good')
+
+    def filter_sort():
+        values = db.filter(good=True)
+        keys = sorted(values, key=lambda key: values[key]['score'])
+        return keys[offset:offset + page]
+
+    def query():
+        return list(db.query(good=True).order_by('score')
+                    .offset(offset).limit(page))
+
+    results = []
+    for name, func in (('filter + sort', filter_sort), ('heap', query),
+                       ('sorted index', query)):
+        if name == 'sorted index':
+            db.create_index('score', _type='sorted')
+        if tracemalloc is not None:
+            tracemalloc.start()
+        t0 = clock()
+        func()
+        t = clock() - t0
+        peak = None
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results.append((name, t, peak))
+    return results
+
+
+def aggregates(size, repeat=10):
+    """Return the average time of aggregates grouped by an indexed field:
+    counts, and sums computed in a single pass and with NumPy."""
+    db = MeuhDb()
+    for x in range(size):
+        db.set("%d" % x, {'status': 'status-%d' % (x % 10), 'amount': x})
+    db.create_index('status')
+    numpy = aggregation.numpy
+    results = []
+    for name, vectorized in (('count', False), ('sum', False),
+                             ('sum (numpy)', True)):
+        if vectorized and numpy is None:
+            continue
+        aggregation.numpy = numpy if vectorized else None
+        fields = {} if name == 'count' else {'sum': 'amount'}
+        t0 = clock()
+        for counter in range(repeat):
+            db.aggregate(group_by='status', count=True, **fields)
+        results.append((name, (clock() - t0) / repeat))
+    aggregation.numpy = numpy
+    return results
+
+
+def show_memory(peak):
+    if peak is None:
+        return 'n/a'
+    return '%.1f MiB' % (peak / 1024. / 1024.)
 
 if __name__ == '__main__':
+    print('backends: load, commit, file size')
     result = ((dump_load(backend), backend) for backend in BACKENDS)
     result = sorted(result)
-    for t, backend in result:
-        print t, backend
+    for (t_load, t_commit, size), backend in result:
+        print(backend, t_load, t_commit, show_memory(size))
+
+    print()
+    print('compression: load, commit, file size')
+    for backend in sorted(BACKENDS):
+        for compression in sorted(COMPRESSIONS):
+            t_load, t_commit, size = dump_load(
+                backend, compression=compression)
+            print(backend, compression, t_load, t_commit, show_memory(size))
+
+    print()
+    print('commit: deepcopy vs. copy-free (time, peak memory)')
+    for backend in BACKENDS:
+        (t_copy, m_copy), (t_free, m_free) = commit_copy(backend)
+        print(backend, 'deepcopy:', t_copy, show_memory(m_copy),
+              '/ copy-free:', t_free, show_memory(m_free))
+
+    print()
+    print('startup and 100 reads (time, peak RSS)')
+    file_sizes, results = startup(500000)
+    for file_format, file_size in sorted(file_sizes.items()):
+        print(file_format, 'file:', show_memory(file_size))
+    for (name, options), (t, peak) in zip(STARTUP_OPTIONS, results):
+        print(name, t, show_memory(peak))
+
+    print()
+    print('sharding: full commit, commit of 1 update, load')
+    for name, t_full, t_updates, t_load in sharded(1000000):
+        print(name, t_full, t_updates, t_load)
+
+    print()
+    print('small updates of large records (updates/s)')
+    print('copy on write:', patch_updates())
+    print('no copy:', patch_updates(copy_on_write=False))
+
+    print()
+    print('read policies: get(), filter() (records/s)')
+    for read_policy in ('live', 'copy', 'frozen'):
+        print(read_policy, *reads(read_policy))
+
+    print()
+    print('write mix with autocommit: writes, commits, bytes written, time')
+    for name, options in (('snapshots', {}), ('journal', {'journal': True})):
+        stats = write_mix(**options)
+        print(name, stats['writes'], stats['commits'],
+              show_memory(stats['bytes_written']), stats['commit_time'])
+
+    print()
+    print('page of 10 records, ordered, at offset 1000 (time, peak memory)')
+    for name, t, peak in paginate(1000000):
+        print(name, t, show_memory(peak))
+
+    print()
+    print('aggregates grouped by an indexed field (time)')
+    for name, t in aggregates(1000000):
+        print(name, t)
+
+    print()
+    print('load throughput (records/s)')
+    print('per item:', load(bulk=False))
+    print('bulk:', load(bulk=True))
+
+    print()
+    print('indexed filter, 10 matches (should not grow with the DB size)')
+    for size in (10000, 100000, 1000000):
+        print(size, 'records:', indexed_filter(size))